@@ -0,0 +1,159 @@
+"""
+Sparse activity matrices.
+
+An activity matrix counts the messages sent by each sender on each day.
+Most senders post on few days, so over a long-lived list the dense
+days x senders DataFrame returned by Archive.get_activity is mostly
+zeros, and can be too large for memory. SparseActivity holds the same
+counts in a scipy.sparse CSR matrix, built from integer day and sender
+codes, and only makes the dense DataFrame on request.
+"""
+import bigbang.parse as parse
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+# proleptic Gregorian ordinal of 1970-01-01, the day of epoch 0
+EPOCH_ORDINAL = 719163
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def datetimes_to_epochs(dates):
+    """
+    Returns the UTC datetimes *dates* (a Series) as an array of int64
+    seconds since the epoch, with parse.MISSING_EPOCH for missing dates.
+    """
+    dates = pd.to_datetime(dates, utc=True)
+    epochs = dates.values.astype('int64') // 10 ** 9
+    epochs[dates.isnull().values] = parse.MISSING_EPOCH
+    return epochs
+
+
+class SparseActivity(object):
+    """
+    A days x senders matrix of message counts.
+
+    *matrix* is a scipy.sparse CSR matrix whose rows are the days
+    *days* (proleptic Gregorian ordinals, as in Archive.get_activity)
+    and whose columns are the senders *columns* (a pandas Index).
+
+    *integer_counts* says whether the equivalent dense activity
+    DataFrame has integer rather than float columns.
+    """
+
+    def __init__(self, matrix, days, columns, integer_counts=False):
+        self.matrix = matrix
+        self.days = days
+        self.columns = columns
+        self.integer_counts = integer_counts
+
+    @classmethod
+    def from_messages(cls, senders, dates, clean=True, now=None):
+        """
+        Returns the activity of messages with the given *senders* (From
+        values, or a Categorical of them) and UTC *dates* (a Series or
+        an array of epoch seconds), counted like Archive.compute_activity.
+
+        Messages without a sender or date are not counted. If *clean* is
+        True, neither are messages dated after *now* (by default, the
+        current time).
+        """
+        if isinstance(senders, pd.Categorical):
+            sender_codes, categories = senders.codes, senders.categories
+        else:
+            sender_codes, categories = pd.factorize(np.asarray(senders, dtype=object),
+                                                    sort=True)
+        if not isinstance(dates, np.ndarray) or dates.dtype != np.int64:
+            dates = datetimes_to_epochs(dates)
+
+        keep = (dates != parse.MISSING_EPOCH) & (sender_codes != -1)
+        if clean:
+            now = now if now is not None else pd.Timestamp.utcnow().value // 10 ** 9
+            keep &= dates < now
+
+        days = dates[keep] // SECONDS_PER_DAY + EPOCH_ORDINAL
+        sender_codes = sender_codes[keep]
+
+        # only senders that occur, in sorted order, as in a groupby
+        used_senders = np.unique(sender_codes)
+        column_of = np.full(len(categories), -1, dtype='int64')
+        column_of[used_senders] = np.arange(len(used_senders))
+        columns = pd.Index(categories[used_senders], name='From')
+
+        if len(days) == 0:
+            return cls(scipy.sparse.csr_matrix((0, 0), dtype='int64'),
+                       np.arange(0), columns, integer_counts=True)
+
+        first = days.min()
+        rows = days - first
+        cols = column_of[sender_codes]
+        n_days = rows.max() + 1
+
+        matrix = scipy.sparse.coo_matrix((np.ones(len(rows), dtype='int64'), (rows, cols)),
+                                         shape=(n_days, len(used_senders))).tocsr()
+        matrix.sum_duplicates()
+
+        # a groupby leaves gaps, and so floats, unless every sender
+        # sent messages on every day that has any
+        active_days = np.count_nonzero(np.diff(matrix.indptr))
+        integer_counts = matrix.nnz == active_days * len(used_senders)
+
+        # like compute_activity, the range of days stops before the last one
+        return cls(matrix[:-1], np.arange(first, first + n_days - 1), columns,
+                   integer_counts=integer_counts)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def sum(self, axis=0):
+        """
+        Returns the total messages of each sender (*axis* 0) or on each
+        day (*axis* 1) as a Series, like the sum of the dense DataFrame.
+        """
+        if axis == 0:
+            totals = np.bincount(self.matrix.indices, weights=self.matrix.data,
+                                 minlength=len(self.columns))
+            index = self.columns
+        else:
+            totals = np.asarray(self.matrix.sum(1)).ravel()
+            index = pd.Index(self.days, name='Date')
+        return pd.Series(totals.astype(self.dtype()), index=index)
+
+    def dtype(self):
+        return np.dtype('int64') if self.integer_counts else np.dtype('float64')
+
+    def to_dense(self):
+        """
+        Returns the activity as a dense DataFrame, identical to the one
+        computed by Archive.compute_activity.
+        """
+        return pd.DataFrame(self.matrix.toarray().astype(self.dtype()),
+                            index=pd.Index(self.days, name='Date'),
+                            columns=self.columns)
+
+    def repartition(self, partition):
+        """
+        Returns a SparseActivity whose columns are the keys of the dict
+        *partition*, each combining the columns of the senders listed
+        for it, as utils.repartition_dataframe does for a DataFrame.
+        """
+        column_of = dict((name, i) for i, name in enumerate(self.columns))
+        rows, cols, weights = [], [], []
+        for j, (key, names) in enumerate(partition.items()):
+            # the same combination of columns as repartition_dataframe
+            combined = [names[0]] + [names[i] for i in range(len(names) - 1)]
+            for name in combined:
+                rows.append(column_of[name])
+                cols.append(j)
+                weights.append(1)
+
+        combination = scipy.sparse.csr_matrix((weights, (rows, cols)),
+                                              shape=(len(self.columns), len(partition)))
+        return SparseActivity(self.matrix.dot(combination).tocsr(), self.days,
+                              pd.Index(list(partition.keys())),
+                              integer_counts=self.integer_counts)
@@ -1,18 +1,31 @@
-from bigbang.thread import Node
-from bigbang.thread import Thread
+from bigbang.activity import SparseActivity
+from bigbang.cache import ArchiveCache
+from bigbang.thread import ThreadIndex
 from config.config import CONFIG
+from contextlib import contextmanager
+import bigbang.compact as compact
 import bigbang.process as process
+import bigbang.replies as replies
+import collections
 import datetime
 import mailbox
 import mailman
-import numpy as np
 import pandas as pd
 import pytz
+import storage
+import time
 import utils
 import logging
 
-def load(path):
-    data = pd.read_csv(path)
+def load(path, columns=None):
+    """
+    Loads an Archive saved with Archive.save.
+
+    The storage format is given by the extension of *path*
+    (.parquet, .feather or .csv). If *columns* is given, only those
+    columns are loaded.
+    """
+    data = storage.read_archive_data(path, columns=columns)
     return Archive(data)
 
 
@@ -24,10 +37,15 @@ class Archive(object):
 
     data = None
     activity = None
+    sparse_activity = None
     threads = None
+    thread_index = None
     entities = None
+    index = None
+    compacted = None
 
-    def __init__(self, data, archive_dir=CONFIG.mail_path, mbox=False):
+    def __init__(self, data, archive_dir=CONFIG.mail_path, mbox=False, workers=1,
+                 cache=None, index=None, headers_only=False, copy=True):
         """
         Initializes an Archive object.
 
@@ -37,78 +55,139 @@ class Archive(object):
         If data is a Pandas DataFrame, it is treated as a representation of
         email messages with columns for Message-ID, From, Date, In-Reply-To,
         References, and Body. The created Archive becomes a wrapper around a
-        copy of the input DataFrame.
+        copy of the input DataFrame, or, if *copy* is False, around the
+        input DataFrame itself, which is then modified in place.
 
         If data is a string, then it is interpreted as a path to either a
         single .mbox file (if the optional argument single_file is True) or
         else to a directory of .mbox files (also in .mbox format). Note that
         the file extensions need not be .mbox; frequently they will be .txt.
+        Files in a directory are parsed by *workers* processes in parallel,
+        and are read from *cache* (an ArchiveCache, or True for the default
+        cache) when they have been parsed before.
 
-        Upon initialization, the Archive object drops duplicate entries
-        and sorts its member variable *data* by Date.
-        """
-          
-        if isinstance(data, pd.core.frame.DataFrame):
-            self.data = data.copy()
-        elif isinstance(data, str):
-            self.data = mailman.load_data(data,archive_dir=archive_dir,mbox=mbox)
-        
-        try:
-            self.data['Date'] = pd.to_datetime(self.data['Date'], errors='coerce', infer_datetime_format=True, utc=True)
-        except:
-            #TODO: writing a CSV file was for debugging purposes, should be removed
-            out_path = 'datetime-exception.csv'
-            with open(out_path, 'w') as f:
-                self.data.to_csv(f, encoding='utf-8')
-            
-            logging.error('Error while converting to datetime, despite coerce mode.')
-            raise
-
-        try:
-            self.data.drop_duplicates(inplace=True)
-        except:
-            logging.error('Error while removing duplicate messages, maybe timezone issues?', exc_info=True)
+        If *headers_only* is True, message bodies are not loaded and the
+        Body column is None, which is enough for activity, threads and
+        interaction graphs.
 
-        # Drops any entries with no Date field.
-        # It may be wiser to optionally
-        # do interpolation here.
-        if self.data['Date'].isnull().any():
-            #self.data.dropna(subset=['Date'], inplace=True)
-            self.data = self.data[self.data['Date'].notnull()]
-            # workaround for https://github.com/pandas-dev/pandas/issues/13407
+        *index* is an index of the list's raw mbox files (a
+        mbox_index.ArchiveIndex), from which get_body and the nodes of
+        get_threads read message bodies missing from the data, for
+        example when it was loaded without its Body column.
 
-        #convert any null fields to None -- csv saves these as nan sometimes
-        self.data = self.data.where(pd.notnull(self.data),None)
+        Upon initialization, the Archive object drops duplicate entries
+        and sorts its member variable *data* by Date. The time taken by
+        each step of this is recorded in *timings*.
+        """
+        self.index = index
+        self.timings = collections.OrderedDict()
+
+        with self._timed('load'):
+            if isinstance(data, pd.core.frame.DataFrame):
+                self.data = data.copy() if copy else data
+            elif isinstance(data, str):
+                self.data = mailman.load_data(data,archive_dir=archive_dir,mbox=mbox,
+                                              workers=workers,cache=cache,
+                                              headers_only=headers_only)
+
+        with self._timed('dates'):
+            try:
+                # data read from columnar storage already has UTC dates
+                if not storage.is_utc_datetime(self.data['Date']):
+                    self.data['Date'] = pd.to_datetime(self.data['Date'], errors='coerce', infer_datetime_format=True, utc=True)
+            except:
+                #TODO: writing a CSV file was for debugging purposes, should be removed
+                out_path = 'datetime-exception.csv'
+                with open(out_path, 'w') as f:
+                    self.data.to_csv(f, encoding='utf-8')
 
-        try:
-            #set the index to be the Message-ID column
-            self.data.set_index('Message-ID',inplace=True)
-        except KeyError:
-            #will get KeyError if Message-ID is already index
-            pass
+                logging.error('Error while converting to datetime, despite coerce mode.')
+                raise
 
-        # let's do a pass to try to find bad tzinfo's
-        bad_indices = []
-        for i, row in self.data.iterrows():
+        with self._timed('duplicates'):
+            try:
+                duplicated = duplicated_messages(self.data)
+                if duplicated.any():
+                    # a shallow copy, so that the steps below can modify it
+                    self.data = self.data[~duplicated].copy(deep=False)
+            except:
+                logging.error('Error while removing duplicate messages, maybe timezone issues?', exc_info=True)
+
+        with self._timed('missing dates'):
+            # Drops any entries with no Date field.
+            # It may be wiser to optionally
+            # do interpolation here.
+            if self.data['Date'].isnull().any():
+                #self.data.dropna(subset=['Date'], inplace=True)
+                self.data = self.data[self.data['Date'].notnull()]
+                # workaround for https://github.com/pandas-dev/pandas/issues/13407
+
+                # a shallow copy, which pandas doesn't flag as a slice, so
+                # that the steps below can modify it in place
+                self.data = self.data.copy(deep=False)
+
+        with self._timed('nulls'):
+            #convert any null fields to None -- csv saves these as nan sometimes
+            self.data = nulls_to_none(self.data)
+
+        with self._timed('index'):
             try:
-                future_comparison = row['Date'] < datetime.datetime.now(pytz.utc)
+                #set the index to be the Message-ID column
+                self.data.set_index('Message-ID',inplace=True)
+            except KeyError:
+                #will get KeyError if Message-ID is already index
+                pass
+
+        with self._timed('timezones'):
+            # a UTC datetime column compares with any aware datetime, so
+            # only other dates need checking for bad tzinfo's
+            if not storage.is_utc_datetime(self.data['Date']):
+                self._drop_bad_timezones()
+
+        with self._timed('sort'):
+            try:
+                self.data.sort_values(by='Date', inplace=True)
             except:
-                logging.error('Error timezone issues while detecting bad rows', exc_info=True)
-                bad_indices.append(i)
-                logging.info('Bad timezone on %s', row['Date'])
-        if len(bad_indices) > 0:
-            # drop those rows that threw an error
-            self.data = self.data.drop(bad_indices)
-            logging.info('Dropped %d rows', len(bad_indices))
+                logging.error('Error while sorting, maybe timezone issues?', exc_info=True)
+
+        logging.debug('Archive construction timings: %s', dict(self.timings))
 
-        try:
-            self.data.sort_values(by='Date', inplace=True)
-        except:
-            logging.error('Error while sorting, maybe timezone issues?', exc_info=True)
-        
         if self.data.empty:
             raise mailman.MissingDataException('Archive after initial processing is empty. Was data collected properly?')
 
+    @contextmanager
+    def _timed(self, step):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[step] = time.time() - start
+
+    def _drop_bad_timezones(self):
+        now = datetime.datetime.now(pytz.utc)
+        dates = self.data['Date']
+        try:
+            # one comparison of the whole column, if every date allows it
+            dates.values < now
+            return
+        except Exception:
+            pass
+
+        def comparable(date):
+            try:
+                date < now
+                return True
+            except Exception:
+                return False
+
+        bad = ~dates.map(comparable).values.astype(bool)
+        logging.error('Error timezone issues while detecting bad rows')
+        for date in dates[bad]:
+            logging.info('Bad timezone on %s', date)
+        # drop those rows that threw an error
+        self.data = self.data.drop(self.data.index[bad])
+        logging.info('Dropped %d rows', bad.sum())
+
     def resolve_entities(self,inplace=True):
         if self.entities is None:
             if self.activity is None:
@@ -129,6 +208,8 @@ class Archive(object):
 
         # clear and replace activity with resolved activity
         self.activity = None
+        self.sparse_activity = None
+        self.compacted = None
         self.get_activity()
 
         if inplace:
@@ -136,7 +217,16 @@ class Archive(object):
         else:
             return data
 
-    def get_activity(self,resolved=False):
+    def get_compact(self):
+        """
+        Returns the archive's messages in compact, integer-coded form
+        (a compact.CompactArchive), computing it on first use.
+        """
+        if self.compacted is None:
+            self.compacted = compact.CompactArchive(self.data)
+        return self.compacted
+
+    def get_activity(self, resolved=False, sparse=False):
         """
         Get the activity matrix of an Archive.
         Columns of the returned DataFrame are the Senders of emails.
@@ -145,84 +235,357 @@ class Archive(object):
 
         If *resolved* is true, then default entity resolution is run on the
         activity matrix before it is returned.
+
+        If *sparse* is true, the matrix is returned as an
+        activity.SparseActivity, which never holds the dense
+        days x senders matrix; use its sum() for the totals per sender,
+        or to_dense() for the DataFrame.
         """
-        if self.activity is None:
-            self.activity = self.compute_activity(self)
+        if sparse:
+            if self.sparse_activity is None:
+                self.sparse_activity = self.compute_activity(sparse=True)
+            activity = self.sparse_activity
+        else:
+            if self.activity is None:
+                self.activity = self.compute_activity()
+            activity = self.activity
 
         if resolved:
-            self.entities = process.resolve_sender_entities(self.activity)
-            eact = utils.repartition_dataframe(self.activity,self.entities)
-            
-            return eact
+            self.entities = process.resolve_sender_entities(activity)
+            if sparse:
+                return activity.repartition(self.entities)
+            return utils.repartition_dataframe(activity, self.entities)
 
-        return self.activity
+        return activity
 
-    def compute_activity(self, clean=True):
-        mdf = self.data
+    def compute_activity(self, clean=True, sparse=False):
+        """
+        Computes the activity matrix of the archive, counting messages
+        by sender and ordinal date. If *clean* is true, messages dated
+        in the future are not counted.
 
-        if clean:
-            # unnecessary?
-            if mdf['Date'].isnull().any():
-                mdf = mdf.dropna(subset=['Date'])
+        The counts are made on integer day and sender codes, as a
+        SparseActivity, which is returned as a DataFrame unless
+        *sparse* is true.
+        """
+        activity = SparseActivity.from_messages(self.data['From'], self.data['Date'],
+                                                clean=clean)
+        return activity if sparse else activity.to_dense()
 
-            mdf = mdf[
-                mdf['Date'] < datetime.datetime.now(
-                    pytz.utc)]  # drop messages apparently in the future
-        
-        mdf2 = mdf.reindex(columns = ['From', 'Date'])
-        mdf2['Date'] = mdf['Date'].apply(lambda x: x.toordinal())
+    def get_body(self, message_id):
+        """
+        Returns the body of the message with *message_id*, from the data
+        or, if the data does not include it, from the archive's index.
+        """
+        if 'Body' in self.data.columns:
+            body = self.data.loc[message_id, 'Body']
+            if isinstance(body, pd.Series):
+                body = body.iloc[0]
+            if body is not None:
+                return body
+        if self.index is not None:
+            return self.index.get_body(message_id)
+        return None
+
+    def get_thread_index(self):
+        """
+        Returns the parent, root and thread of every message as a
+        thread.ThreadIndex, computing it on first use.
+        """
+        if self.thread_index is None:
+            self.thread_index = ThreadIndex(self.data, self.get_compact(), index=self.index)
+        return self.thread_index
 
-        activity = mdf2.groupby(
-            ['From', 'Date']).size().unstack('From').fillna(0)
-        new_date_range = np.arange(mdf2['Date'].min(), mdf2['Date'].max())
-        # activity.set_index('Date')
-        activity = activity.reindex(new_date_range, fill_value=0)
+    def thread_metrics(self):
+        """
+        Returns a dataframe of measures of each thread, in the order of
+        get_threads(): root, known_root, size, depth, senders, start,
+        end, duration and median_reply_latency. See
+        thread.ThreadIndex.metrics.
+        """
+        return self.get_thread_index().metrics()
 
-        return activity
+    def reply_edges(self):
+        """
+        Returns a dataframe with a row for each reply to a message of
+        the archive: the two messages, their thread and senders, and the
+        reply's date and latency. See the replies module for statistics
+        on it.
+        """
+        return replies.reply_edges(self.get_thread_index())
 
     def get_threads(self, verbose=False):
-
+        """
+        Returns the threads of the archive, as a list of Threads in the
+        order of their first messages.
+        """
         if self.threads is not None:
             return self.threads
 
-        df = self.data
+        thread_index = self.get_thread_index()
+        self.threads = thread_index.threads()
 
-        threads = list()
-        visited = dict()
+        if verbose:
+            print "Threaded %d messages into %d threads" % (len(self.data), len(thread_index))
 
-        total = df.shape[0]
-        c = 0
+        return self.threads
 
-        for i in df.iterrows():
+    def save(self, path, encoding='utf-8', fmt=None):
+        """
+        Saves the archive's data to *path*, as CSV or in the columnar
+        format given by *fmt* or by the extension of *path*
+        ('parquet' or 'feather').
+        """
+        storage.write_archive_data(self.data, path, fmt=fmt, encoding=encoding)
 
-            if verbose:
-                c += 1
-                if c % 1000 == 0:
-                    print "Processed %d of %d" %(c,total)
+    def save_partitions(self, directory):
+        """
+        Saves the archive's data to *directory* as monthly Parquet
+        partitions, which a LazyArchive can load a range of months from.
+        """
+        return storage.write_partitions(self.data, directory)
 
-            if(i[1]['In-Reply-To'] is None):
-                root = Node(i[0], i[1])
-                visited[i[0]] = root
-                threads.append(Thread(root))
-            elif(i[1]['In-Reply-To'] not in visited.keys()):
-                root = Node(i[1]['In-Reply-To'])
-                succ = Node(i[0],i[1], root)
-                root.add_successor(succ)
-                visited[i[1]['In-Reply-To']] = root
-                visited[i[0]] = succ
-                threads.append(Thread(root, known_root=False))
-            else:
-                parent = visited[i[1]['In-Reply-To']]
-                node = Node(i[0],i[1], parent)
-                parent.add_successor(node)
-                visited[i[0]] = node
+    def between(self, start=None, end=None):
+        """
+        Returns an Archive of the messages sent from *start* (inclusive)
+        until *end* (exclusive). Either may be None for an open range.
 
-        self.threads = threads
+        *start* and *end* may be datetimes or date strings; naive ones
+        are taken to be in UTC.
 
-        return threads
+        As an Archive can't be empty, raises MissingDataException if no
+        messages were sent in the range.
+        """
+        return Archive(messages_between(self.data, start, end), index=self.index)
 
-    def save(self, path,encoding='utf-8'):
-        self.data.to_csv(path, ",",encoding=encoding)
+    def since(self, start):
+        """
+        Returns an Archive of the messages sent from *start* on.
+        """
+        return self.between(start, None)
+
+    def until(self, end):
+        """
+        Returns an Archive of the messages sent before *end*.
+        """
+        return self.between(None, end)
+
+
+def messages_between(data, start, end):
+    """
+    Returns the rows of *data* dated from *start* until *end*, raising
+    MissingDataException if there are none.
+    """
+    data = data[date_range_mask(data['Date'], start, end)]
+    if data.empty:
+        raise mailman.MissingDataException(
+            'No messages between %s and %s' % (start, end))
+    return data
+
+
+def duplicated_messages(data):
+    """
+    Returns a boolean array marking the rows of *data* that repeat an
+    earlier row, like data.duplicated(). Bodies are only compared, by a
+    64-bit hash, for the rows whose other columns are repeated.
+    """
+    if 'Body' not in data.columns:
+        return data.duplicated().values
+
+    headers = data.drop('Body', axis=1)
+    candidates = headers.duplicated(keep=False).values
+    duplicated = candidates.copy()
+    if candidates.any():
+        keys = headers[candidates].copy(deep=False)
+        keys['Body'] = pd.util.hash_array(data['Body'].values[candidates], categorize=False)
+        duplicated[candidates] = keys.duplicated().values
+    return duplicated
+
+
+def nulls_to_none(data):
+    """
+    Returns *data* with null values replaced by None, as by
+    data.where(pd.notnull(data), None), but only converting the columns
+    that need it: those with nulls other than None, and, as
+    DataFrame.where converts a dtype's columns together, the other
+    columns of a non-object dtype among them.
+    """
+    def has_nulls(column):
+        values = data[column]
+        nulls = values.isnull().values
+        if values.dtype == object:
+            # the nulls of object columns may already be None
+            return any(value is not None for value in values.values[nulls])
+        return nulls.any()
+
+    with_nulls = set(column for column in data.columns if has_nulls(column))
+    dtypes = set(data[column].dtype for column in with_nulls)
+    columns = [column for column in data.columns
+               if column in with_nulls or
+               (data[column].dtype in dtypes and data[column].dtype != object)]
+    if not columns:
+        return data
+
+    converted = data[columns]
+    converted = converted.where(pd.notnull(converted), None)
+    for column in columns:
+        data[column] = converted[column]
+    return data
+
+
+def utc_timestamp(value):
+    """
+    Returns *value* (a datetime or date string) as a UTC pandas Timestamp,
+    taking naive values to be in UTC.
+    """
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC')
+
+
+def date_range_mask(dates, start=None, end=None):
+    """
+    Returns a boolean Series that is True where *dates* fall from
+    *start* (inclusive) until *end* (exclusive).
+    """
+    mask = pd.Series(True, index=dates.index)
+    if start is not None:
+        mask &= dates >= utc_timestamp(start)
+    if end is not None:
+        mask &= dates < utc_timestamp(end)
+    return mask
+
+
+def add_months(month, n):
+    """
+    Returns the first day of the month *n* months after *month*.
+    """
+    index = month.year * 12 + month.month - 1 + n
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+class LazyArchive(object):
+
+    """
+    A mailing list archive whose messages are loaded a month at a time,
+    when a date range that needs them is requested.
+
+    *path* is either a directory of monthly Parquet partitions written by
+    Archive.save_partitions, or a list's directory of raw mbox files named
+    after their months (e.g. 2001-November.txt.gz or 2001-11.mail).
+    Partitions are used if there are any.
+
+    Raw files are parsed as by mailman.open_list_archives, using *workers*
+    processes and the parsed-file *cache*. Only *columns* are read from
+    Parquet partitions, if given.
+    """
+
+    def __init__(self, path, workers=1, cache=None, columns=None):
+        self.path = path
+        self.workers = workers
+        self.cache = ArchiveCache() if cache is True else cache
+        self.columns = columns
+
+        partitions = storage.list_partitions(path)
+        if partitions:
+            self.columnar = True
+        else:
+            self.columnar = False
+            partitions = [(mailman.archive_file_month(txt), txt)
+                          for txt in mailman.sort_archive_files(
+                              mailman.list_archive_files(path))]
+
+        if not partitions:
+            raise mailman.MissingDataException(
+                'No monthly partitions or archive files in %s' % path)
+
+        # month (or None, for files not named after one) -> paths
+        self.partitions = collections.OrderedDict()
+        for month, partition_path in partitions:
+            self.partitions.setdefault(month, []).append(partition_path)
+
+        # path -> dataframe of the partitions loaded so far
+        self.loaded = {}
+
+    def months(self):
+        """
+        Returns the months that the archive has partitions for.
+        """
+        return [month for month in self.partitions.keys() if month is not None]
+
+    def partition_paths(self, start=None, end=None):
+        """
+        Returns the paths of the partitions that may hold messages sent
+        from *start* until *end*.
+
+        Messages in raw archive files may be dated a little outside the
+        month the file is named after (for example in another timezone),
+        so files for the months either side of the range are included too.
+        """
+        margin = 0 if self.columnar else 1
+        first = last = None
+        if start is not None:
+            start = utc_timestamp(start)
+            first = add_months(datetime.datetime(start.year, start.month, 1), -margin)
+        if end is not None:
+            end = utc_timestamp(end) - pd.Timedelta(1, 'ns')
+            last = add_months(datetime.datetime(end.year, end.month, 1), margin)
+
+        paths = []
+        for month, month_paths in self.partitions.items():
+            if month is None or ((first is None or month >= first) and
+                                 (last is None or month <= last)):
+                paths.extend(month_paths)
+        return paths
+
+    def _load(self, paths):
+        to_load = [path for path in paths if path not in self.loaded]
+        if self.columnar:
+            frames = [storage.read_archive_data(path, columns=self.columns)
+                      for path in to_load]
+        else:
+            frames = mailman.parse_archive_files(to_load, workers=self.workers,
+                                                 cache=self.cache)
+        for path, frame in zip(to_load, frames):
+            self.loaded[path] = frame
+        return [self.loaded[path] for path in paths]
+
+    def between(self, start=None, end=None):
+        """
+        Returns an Archive of the messages sent from *start* (inclusive)
+        until *end* (exclusive), loading only the partitions that overlap
+        that range. Either may be None for an open range.
+
+        Raises MissingDataException if no messages were sent in the range.
+        """
+        paths = self.partition_paths(start, end)
+        if not paths:
+            raise mailman.MissingDataException(
+                'No partitions of %s between %s and %s' % (self.path, start, end))
+
+        data = pd.concat(self._load(paths))
+        if not storage.is_utc_datetime(data['Date']):
+            storage.normalize_dates(data)
+        return Archive(messages_between(data, start, end))
+
+    def since(self, start):
+        """
+        Returns an Archive of the messages sent from *start* on.
+        """
+        return self.between(start, None)
+
+    def until(self, end):
+        """
+        Returns an Archive of the messages sent before *end*.
+        """
+        return self.between(None, end)
+
+    def load(self):
+        """
+        Returns an Archive of all the messages.
+        """
+        return self.between(None, None)
 
 
 def find_footer(messages,number=1):
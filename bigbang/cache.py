@@ -0,0 +1,190 @@
+"""
+An on-disk cache of dataframes parsed from raw mbox archive files.
+
+Parsing a monthly archive file is expensive, but only the newest month of
+a list usually changes between loads. ArchiveCache stores the dataframe
+parsed from each file in Parquet format, keyed on the file's path, size,
+modification time and content hash, so that only changed files need to
+be parsed again.
+"""
+from config.config import CONFIG
+import hashlib
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+INDEX_FILENAME = 'index.json'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """
+    Returns the SHA-1 hex digest of the contents of the file at *path*.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def path_name(path):
+    """
+    Returns the absolute path of *path* as unicode, as it is read back
+    from the JSON index. Byte string paths are taken to be UTF-8.
+    """
+    path = os.path.abspath(path)
+    if isinstance(path, str):
+        path = path.decode('utf-8', 'replace')
+    return path
+
+
+class ArchiveCache(object):
+    """
+    A size-bounded cache of parsed archive files in directory *cache_dir*.
+
+    A file's content hash is only recomputed when its size or modification
+    time differ from those recorded when it was last seen, so a file that
+    is touched or downloaded again without changing still hits the cache.
+
+    When the cached dataframes take up more than *max_bytes*, the least
+    recently used ones are evicted.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or CONFIG.cache_path
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.index = self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILENAME)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'files': {}, 'entries': {}}
+
+    def flush(self):
+        """
+        Writes the cache index to disk.
+        """
+        path = self._index_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.parquet')
+
+    def key(self, path):
+        """
+        Returns the cache key for the current contents of the file at *path*.
+        """
+        name = path_name(path)
+        stat = os.stat(path)
+
+        seen = self.index['files'].get(name)
+        if seen is None or seen['size'] != stat.st_size or seen['mtime'] != stat.st_mtime:
+            seen = {'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'digest': file_digest(path)}
+            self.index['files'][name] = seen
+
+        return hashlib.sha1('\0'.join([name.encode('utf-8'),
+                                       str(seen['size']),
+                                       str(seen['digest'])])).hexdigest()
+
+    def get(self, path):
+        """
+        Returns the cached dataframe for the file at *path*, or None.
+        """
+        key = self.key(path)
+        entry = self.index['entries'].get(key)
+        if entry is None:
+            return None
+
+        try:
+            frame = pd.read_parquet(self._entry_path(key))
+        except Exception:
+            logging.warning('Could not read cache entry for %s', path, exc_info=True)
+            self._remove(key)
+            return None
+
+        entry['accessed'] = time.time()
+        return frame
+
+    def put(self, path, frame):
+        """
+        Stores *frame* as the parsed contents of the file at *path*,
+        replacing any entry for an earlier version of the file.
+        """
+        abspath = path_name(path)
+        key = self.key(path)
+
+        for old_key, entry in self.index['entries'].items():
+            if entry['path'] == abspath and old_key != key:
+                self._remove(old_key)
+
+        entry_path = self._entry_path(key)
+        frame.to_parquet(entry_path)
+        self.index['entries'][key] = {'path': abspath,
+                                      'bytes': os.path.getsize(entry_path),
+                                      'accessed': time.time()}
+        self.evict()
+
+    def _remove(self, key):
+        self.index['entries'].pop(key, None)
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def size(self):
+        """
+        Returns the total size in bytes of the cached dataframes.
+        """
+        return sum(entry['bytes'] for entry in self.index['entries'].values())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits
+        within *max_bytes*.
+        """
+        total = self.size()
+        by_age = sorted(self.index['entries'].items(), key=lambda item: item[1]['accessed'])
+        for key, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            logging.info('Evicting cached archive %s', entry['path'])
+            self._remove(key)
+            total -= entry['bytes']
+
+    def invalidate(self, path=None):
+        """
+        Removes the cached dataframes for the file at *path*, or every
+        cached dataframe if *path* is None.
+        """
+        if path is None:
+            keys = list(self.index['entries'].keys())
+            self.index['files'] = {}
+        else:
+            path = path_name(path)
+            keys = [key for key, entry in self.index['entries'].items()
+                    if entry['path'] == path]
+            self.index['files'].pop(path, None)
+
+        for key in keys:
+            self._remove(key)
+        self.flush()
@@ -0,0 +1,231 @@
+"""
+A compact, integer-coded representation of an Archive's messages.
+
+Archive.data holds senders, Message-IDs and references as Python
+unicode objects, one per message. CompactArchive instead stores:
+
+- From (and Subject) as pandas Categoricals, whose integer codes index
+  a single copy of each distinct value
+- Message-ID, In-Reply-To and References as integer codes into one
+  shared dictionary of Message-IDs, with the references of all messages
+  in a single array (CSR-style: each message's codes lie between two
+  offsets)
+- Date as int64 UTC seconds since the epoch
+
+Activity, reply parents, thread roots and entity resolution are
+computed on the codes.
+"""
+from bigbang.activity import SparseActivity
+from bigbang.activity import datetimes_to_epochs
+import bigbang.parse as parse
+import bigbang.process as process
+import numpy as np
+import pandas as pd
+
+NO_CODE = -1
+
+
+class CompactArchive(object):
+    """
+    The messages of the dataframe *data* (an Archive's data, indexed by
+    Message-ID) in compact form.
+
+    Attributes:
+    ids -- the dictionary of Message-IDs, an array of strings
+    id_codes -- the code of each message's Message-ID
+    reply_codes -- the code of each message's In-Reply-To, or NO_CODE
+    reference_offsets, reference_codes -- the codes of message i's
+        References are reference_codes[reference_offsets[i]:reference_offsets[i + 1]]
+    senders -- the From of each message, a Categorical
+    subjects -- the Subject of each message, a Categorical
+    dates -- the Date of each message in UTC seconds since the epoch
+    """
+
+    def __init__(self, data):
+        message_ids = data.index.values if 'Message-ID' not in data.columns \
+            else data['Message-ID'].values
+        replies = data['In-Reply-To'].values
+
+        references = []
+        if 'References' in data.columns:
+            references = [parse.split_references(refs) if refs else []
+                          for refs in data['References'].values]
+        else:
+            references = [[] for i in range(len(data))]
+        reference_counts = np.array([len(refs) for refs in references], dtype='int64')
+        flat_references = [ref for refs in references for ref in refs]
+
+        # one factorization of every ID, so equal IDs get equal codes
+        all_ids = np.concatenate([np.asarray(message_ids, dtype=object),
+                                  np.asarray(replies, dtype=object),
+                                  np.asarray(flat_references, dtype=object)])
+        codes, self.ids = pd.factorize(all_ids)
+        codes = codes.astype('int32')
+
+        n = len(data)
+        self.id_codes = codes[:n]
+        self.reply_codes = codes[n:2 * n]
+        self.reference_codes = codes[2 * n:]
+        self.reference_offsets = np.concatenate([[0], np.cumsum(reference_counts)])
+
+        self.senders = pd.Categorical(data['From'].values)
+        self.subjects = pd.Categorical(data['Subject'].values) \
+            if 'Subject' in data.columns else None
+        self.dates = datetimes_to_epochs(data['Date'])
+
+    def __len__(self):
+        return len(self.id_codes)
+
+    def message_id(self, code):
+        return self.ids[code]
+
+    def references(self, i):
+        """
+        Returns the codes of the References of the i-th message.
+        """
+        return self.reference_codes[self.reference_offsets[i]:self.reference_offsets[i + 1]]
+
+    def positions(self):
+        """
+        Returns an array giving, for each Message-ID code, the position
+        of the first message with that ID, or NO_CODE if no message in
+        the archive has it.
+        """
+        positions = np.full(len(self.ids), NO_CODE, dtype='int64')
+        # assign in reverse so that the first message with an ID wins
+        order = np.arange(len(self))[::-1]
+        positions[self.id_codes[order]] = order
+        return positions
+
+    def parents(self):
+        """
+        Returns the position of the message each message replies to,
+        or NO_CODE if it replies to none in the archive.
+
+        The parent is the message named by In-Reply-To or, if that is
+        not in the archive, the last of the References that is.
+        """
+        positions = self.positions()
+        parents = np.full(len(self), NO_CODE, dtype='int64')
+        replying = self.reply_codes != NO_CODE
+        parents[replying] = positions[self.reply_codes[replying]]
+
+        # the last reference of each message that is in the archive
+        reference_positions = positions[self.reference_codes]
+        owners = np.repeat(np.arange(len(self)), np.diff(self.reference_offsets))
+        found = np.flatnonzero(reference_positions != NO_CODE)
+        last_found = np.full(len(self), NO_CODE, dtype='int64')
+        np.maximum.at(last_found, owners[found], found)
+
+        fallback = (parents == NO_CODE) & (last_found != NO_CODE)
+        parents[fallback] = reference_positions[last_found[fallback]]
+        return parents
+
+    def missing_parents(self):
+        """
+        Returns the code of the Message-ID each message names as its
+        parent, by In-Reply-To or else its last reference, or NO_CODE if
+        it names none. For messages whose parents() is NO_CODE, this is
+        a message missing from the archive.
+        """
+        missing = self.reply_codes.astype('int64')
+        counts = np.diff(self.reference_offsets)
+        by_reference = (missing == NO_CODE) & (counts > 0)
+        missing[by_reference] = self.reference_codes[self.reference_offsets[1:][by_reference] - 1]
+        return missing
+
+    def roots(self, parents=None):
+        """
+        Returns the position of the root message of each message's
+        thread, following reply *parents* (by default, parents()) by
+        pointer jumping.
+
+        Messages in, or replying into, reply cycles are their own roots.
+        """
+        parents = parents if parents is not None else self.parents()
+        roots = np.where(parents == NO_CODE, np.arange(len(self)), parents)
+
+        # each pass doubles the distance followed, so about log2(n)
+        # passes reach the roots
+        for i in range(int(np.ceil(np.log2(max(len(self), 2)))) + 1):
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                break
+            roots = jumped
+
+        # messages that did not reach one without a parent are in, or
+        # reply into, a cycle
+        cyclic = parents[roots] != NO_CODE
+        roots[cyclic] = np.arange(len(self))[cyclic]
+        return roots
+
+    def activity(self, clean=True, now=None, sparse=False):
+        """
+        Returns the activity matrix of the messages, as by
+        Archive.compute_activity, counted on the sender codes and dates.
+
+        If *sparse* is True, it is returned as an activity.SparseActivity.
+        """
+        activity = SparseActivity.from_messages(self.senders, self.dates, clean=clean, now=now)
+        return activity if sparse else activity.to_dense()
+
+    def resolve_entities(self, activity=None):
+        """
+        Merges senders that process.resolve_sender_entities finds to be
+        the same entity, by recoding the sender categories.
+
+        Returns the dict of entities.
+        """
+        activity = activity if activity is not None else self.activity(sparse=True)
+        entities = process.resolve_sender_entities(activity)
+
+        category_of = dict((name, i) for i, name in enumerate(self.senders.categories))
+        labels = list(self.senders.categories)
+        recode = np.arange(len(labels))
+        for label, names in entities.items():
+            for name in names:
+                recode[category_of[name]] = category_of[label]
+
+        used = np.unique(recode)
+        new_code = np.full(len(labels), NO_CODE, dtype='int64')
+        new_code[used] = np.arange(len(used))
+
+        codes = np.where(self.senders.codes == NO_CODE, NO_CODE,
+                         new_code[recode[self.senders.codes]])
+        self.senders = pd.Categorical.from_codes(codes, [labels[i] for i in used])
+
+        return entities
+
+    def memory_usage(self):
+        """
+        Returns a Series of the bytes used by each component.
+        """
+        usage = pd.Series([self.id_codes.nbytes,
+                           self.reply_codes.nbytes,
+                           self.reference_codes.nbytes + self.reference_offsets.nbytes,
+                           pd.Series(self.ids).memory_usage(index=False, deep=True),
+                           self.senders.memory_usage(deep=True),
+                           self.subjects.memory_usage(deep=True) if self.subjects is not None else 0,
+                           self.dates.nbytes],
+                          index=['Message-ID', 'In-Reply-To', 'References', 'ID dictionary',
+                                 'From', 'Subject', 'Date'])
+        return usage
+
+
+def memory_report(data, compact=None):
+    """
+    Returns a dataframe of the memory used by the non-Body columns of
+    the message dataframe *data* and by its compact form, in total and
+    per message.
+    """
+    compact = compact or CompactArchive(data)
+    columns = [c for c in ['From', 'Subject', 'Date', 'In-Reply-To', 'References']
+               if c in data.columns]
+    data_bytes = data[columns].memory_usage(index=True, deep=True).sum()
+    compact_bytes = compact.memory_usage().sum()
+    n = max(len(data), 1)
+
+    return pd.DataFrame({'bytes': [data_bytes, compact_bytes],
+                         'bytes per message': [float(data_bytes) / n, float(compact_bytes) / n]},
+                        index=['data', 'compact'],
+                        columns=['bytes', 'bytes per message'])
@@ -0,0 +1,406 @@
+"""
+Helpers for downloading archive files over HTTP.
+
+Downloads share a requests.Session so that connections to the same host
+are reused, and a HostLimiter that caps how many requests are in flight
+to any one host at a time. Requests are made conditional on validators
+(ETag, Last-Modified) recorded from earlier downloads.
+"""
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import email.utils
+import logging
+import os
+import threading
+import time
+import urlparse
+
+import requests
+from requests.packages.urllib3.exceptions import ProtocolError
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+
+PART_SUFFIX = '.part'
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TIMEOUT = 60
+
+
+def new_session(pool_size=10):
+    """
+    Returns a requests.Session whose connection pool keeps up to
+    *pool_size* connections open per host.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def host_of(url):
+    return urlparse.urlparse(url).netloc.lower()
+
+
+class TokenBucket(object):
+    """
+    Allows events at an average of *rate* per second, in bursts of up
+    to *burst* events.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until an event is allowed.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter(object):
+    """
+    Limits the requests made to each host.
+
+    *per_host* is the maximum number of requests in flight to a single
+    host, and *rate* the maximum average number of requests per second
+    to a single host (allowing bursts of *burst* requests). None means
+    no limit. *host_rates* maps hosts to rates that replace *rate* for
+    them.
+
+    One HostLimiter can be shared by several collections running at
+    once, so that their combined requests respect the limits.
+    """
+
+    def __init__(self, per_host=None, rate=None, burst=1, host_rates=None):
+        self.per_host = per_host
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = dict(host_rates or {})
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._buckets = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+    def rate_for(self, host):
+        """
+        Returns the maximum request rate to *host*, or None.
+        """
+        return self.host_rates.get(host, self.rate)
+
+    def _bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate_for(host), self.burst)
+            return self._buckets[host]
+
+    @contextmanager
+    def slot(self, url):
+        """
+        Context manager that waits for the host of *url* to allow
+        another request and holds one of its request slots.
+        """
+        host = host_of(url)
+        semaphore = self._semaphore(host) if self.per_host is not None else None
+
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            if self.rate_for(host) is not None:
+                self._bucket(host).acquire()
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+
+class IncompleteDownloadException(IOError):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def replace_file(src, dst):
+    """
+    Renames *src* to *dst*, replacing *dst* if it exists.
+    The rename is atomic on POSIX systems.
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+class Download(object):
+    """
+    A single file to be downloaded from *url* to *path*.
+
+    *validators* is a dict with any of the keys 'etag', 'last_modified'
+    and 'size' recorded from an earlier download of the same file. They
+    are used to make the request conditional, so that an unchanged file
+    costs a single 304 response, and to resume an interrupted transfer
+    with a Range request.
+
+    After the download is attempted, *status* is one of 'downloaded',
+    'resumed' or 'not-modified', or None if *error* is set.
+    """
+
+    def __init__(self, url, path, validators=None):
+        self.url = url
+        self.path = path
+        self.validators = dict(validators or {})
+        self.status = None
+        self.transferred = 0
+        self.error = None
+
+    @property
+    def part_path(self):
+        return self.path + PART_SUFFIX
+
+    def request_headers(self):
+        """
+        Returns the conditional or range headers for this download.
+        """
+        headers = {}
+        etag = self.validators.get('etag')
+        last_modified = self.validators.get('last_modified')
+
+        if os.path.isfile(self.path):
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            elif not etag:
+                # no recorded validators; fall back on the local copy's age
+                headers['If-Modified-Since'] = email.utils.formatdate(
+                    os.path.getmtime(self.path), usegmt=True)
+        elif os.path.isfile(self.part_path) and (etag or last_modified):
+            headers['Range'] = 'bytes=%d-' % os.path.getsize(self.part_path)
+            headers['If-Range'] = etag or last_modified
+
+        return headers
+
+    def record_response(self, response):
+        """
+        Updates *validators* from the headers of *response*.
+        """
+        for header, key in [('ETag', 'etag'), ('Last-Modified', 'last_modified')]:
+            value = response.headers.get(header)
+            if value:
+                self.validators[key] = value
+
+
+def download_to_file(download, session=None, limiter=None):
+    """
+    Streams the resource described by *download* (a Download) to its path.
+
+    The body is written to a temporary file next to the path and renamed
+    into place once the transfer is complete, so the path never holds a
+    partially downloaded file. An interrupted transfer leaves the
+    temporary file behind to be resumed by a later call.
+
+    Returns *download*, with its status and validators updated. Raises
+    requests.RequestException on HTTP or connection errors, and
+    IncompleteDownloadException if the body is cut short.
+    """
+    session = session or new_session()
+    limiter = limiter or HostLimiter()
+
+    headers = download.request_headers()
+    # archive files are stored as served, so ask for them uncompressed
+    # unless they are compressed files themselves
+    headers['Accept-Encoding'] = 'identity'
+
+    with limiter.slot(download.url):
+        response = session.get(download.url, headers=headers,
+                               stream=True, timeout=DEFAULT_TIMEOUT)
+        try:
+            if response.status_code == 304:
+                download.status = 'not-modified'
+                download.record_response(response)
+                return download
+
+            if response.status_code == 416 and 'Range' in headers:
+                # the partial file can't be resumed; start over below
+                restart = True
+            elif response.status_code == 206 and 'Range' in headers \
+                    and decodes_content(download, response):
+                # the encoded bytes sent don't continue the decoded
+                # partial file; start over below
+                restart = True
+            else:
+                restart = False
+                write_response(download, response)
+        finally:
+            response.close()
+
+    if restart:
+        os.remove(download.part_path)
+        return download_to_file(download, session=session, limiter=limiter)
+
+    replace_file(download.part_path, download.path)
+    download.validators['size'] = os.path.getsize(download.path)
+    return download
+
+
+def write_response(download, response):
+    """
+    Writes the body of *response* to the temporary file of *download*,
+    appending to it if the response is a partial one.
+
+    The validators of the response are only recorded once the whole
+    body has been written. Raises IncompleteDownloadException if the
+    temporary file ends up shorter or longer than the response
+    declared, and requests.ConnectionError if the connection fails
+    while the body is being read.
+    """
+    response.raise_for_status()
+
+    if response.status_code == 206:
+        download.status = 'resumed'
+        mode = 'ab'
+    else:
+        download.status = 'downloaded'
+        mode = 'wb'
+
+    decode = decodes_content(download, response)
+
+    with open(download.part_path, mode) as f:
+        try:
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=decode):
+                f.write(chunk)
+                download.transferred += len(chunk)
+        except (ProtocolError, ReadTimeoutError) as e:
+            # raised by urllib3 rather than wrapped by requests, as
+            # the raw stream is read directly
+            raise requests.ConnectionError(e)
+
+    if decode:
+        # a decoded body has its own size; check the bytes received
+        # against the Content-Length instead (decoded responses are
+        # never partial ones)
+        expected = expected_size(response) if response.status_code == 200 else None
+        size = response.raw.tell()
+    else:
+        expected = expected_size(response)
+        size = os.path.getsize(download.part_path)
+    if expected is not None and size != expected:
+        raise IncompleteDownloadException(
+            '%s: %d bytes received, %d expected' % (download.url, size, expected))
+
+    download.validators.pop('size', None)
+    download.record_response(response)
+
+
+def decodes_content(download, response):
+    """
+    Returns True if the body of *response* is to be decoded before it
+    is written: a server may compress a file on the fly even when asked
+    not to, which is undone unless the file is a compressed file itself.
+    """
+    return response.headers.get('Content-Encoding', 'identity').lower() != 'identity' \
+        and not download.path.endswith('.gz')
+
+
+def expected_size(response):
+    """
+    Returns the size the downloaded file should have after writing
+    *response*, from its Content-Range or Content-Length, or None if it
+    declares neither.
+    """
+    content_range = response.headers.get('Content-Range')
+    if response.status_code == 206 and content_range:
+        # bytes START-END/TOTAL
+        try:
+            return int(content_range.split('/')[0].split('-')[1]) + 1
+        except (IndexError, ValueError):
+            return None
+
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return int(content_length)
+    return None
+
+
+def get_page(url, validators=None, session=None, limiter=None):
+    """
+    Fetches the page at *url*, conditional on *validators* as for Download.
+
+    Returns a tuple (text, validators), where text is None if the page
+    has not changed since the validators were recorded.
+    """
+    session = session or new_session()
+    limiter = limiter or HostLimiter()
+    validators = dict(validators or {})
+
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    with limiter.slot(url):
+        response = session.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()
+
+    for header, key in [('ETag', 'etag'), ('Last-Modified', 'last_modified')]:
+        validators.pop(key, None)
+        if response.headers.get(header):
+            validators[key] = response.headers[header]
+
+    return response.content, validators
+
+
+def download_files(downloads, workers=1, per_host=None, session=None, limiter=None):
+    """
+    Performs a list of Downloads using a pool of *workers* threads,
+    with at most *per_host* concurrent requests to any one host, or
+    within the limits of *limiter* (a HostLimiter) if one is given.
+
+    Returns the list of Downloads in their original order; failed
+    downloads have their error attribute set.
+    """
+    session = session or new_session(pool_size=max(workers, per_host or 1))
+    limiter = limiter or HostLimiter(per_host)
+
+    def fetch(download):
+        try:
+            download_to_file(download, session=session, limiter=limiter)
+            logging.info('%s %s (%d bytes transferred)',
+                         download.status, download.url, download.transferred)
+        except (requests.RequestException, IOError, ProtocolError, ReadTimeoutError) as e:
+            logging.warning('Failed to download %s: %s', download.url, e)
+            download.error = e
+        return download
+
+    if workers <= 1:
+        return [fetch(download) for download in downloads]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(fetch, downloads)
+    finally:
+        pool.close()
+        pool.join()
@@ -1,18 +1,31 @@
-from bigbang.parse import get_date
+from bigbang.cache import ArchiveCache
 from config.config import CONFIG
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from pprint import pprint as pp
+import bz2
+import collections
 import datetime
+import email.parser
+import fetch
 import gzip
+import itertools
 import logging
 import mailbox
+import multiprocessing
 import os
 import fnmatch
+import functools
 import mailbox
 import parse
 import pandas as pd
 import parse
 import re
+import requests
+import shutil
+import storage
 import subprocess
+import time
 import urllib
 import urllib2
 import validators
@@ -50,67 +63,103 @@ class MissingDataException(Exception):
         return repr(self.value)
 
 
-def load_data(name,archive_dir=CONFIG.mail_path,mbox=False):
+def load_data(name,archive_dir=CONFIG.mail_path,mbox=False,workers=1,cache=None,
+              columns=None,headers_only=False):
     """
     Loads the data associated with an archive name, given
     as a string.
 
-    Attempts to open {archives-directory}/NAME.csv as data.
+    Attempts to open {archives-directory}/NAME.parquet, NAME.feather
+    or NAME.csv as data, in that order. If *columns* is given, only those
+    columns are read.
 
     Failing that, if the the name is a URL, it will try to derive
-    the list name from that URL and load the .csv again.
+    the list name from that URL and load the stored data again.
 
     Failing that, it will collect the data from the web and create the CSV archive.
     BUG: I don't think this method will trigger collection from the Web
+
+    If *mbox* is True, the data is instead parsed from the raw mbox files,
+    using *workers* processes and the parsed-file *cache*
+    (see open_list_archives).
+
+    If *headers_only* is True, message bodies are neither parsed nor
+    read from stored data, and the Body column is None.
     """
 
     if mbox:
-        return open_list_archives(name, archive_dir=archive_dir, mbox=True)
+        return open_list_archives(name, archive_dir=archive_dir, mbox=True,
+                                  workers=workers, cache=cache,
+                                  headers_only=headers_only)
+
+    if headers_only:
+        columns = [c for c in (columns or MESSAGE_COLUMNS) if c != 'Body']
 
     # a first pass at detecting if the string is a URL...
     if not (name.startswith("http://") or name.startswith("https://")):
-        path = os.path.join(archive_dir,name + ".csv")
+        path = storage.find_archive_data(archive_dir, name)
 
-        if os.path.exists(path):
-            data = pd.read_csv(path)
+        if path is not None:
+            data = storage.read_archive_data(path, columns=columns)
+            if headers_only:
+                data['Body'] = None
             return data
         else:
-            print "No data available at %s" % (path)
+            print "No data available at %s" % (os.path.join(archive_dir, name))
     else:
-        path = os.path.join(archive_dir,get_list_name(name) + ".csv")
+        path = storage.find_archive_data(archive_dir, get_list_name(name))
 
-        if os.path.exists(path):
-            data = pd.read_csv(path)
+        if path is not None:
+            data = storage.read_archive_data(path, columns=columns)
+            if headers_only:
+                data['Body'] = None
             return data
         else:
             #BUG: proper warning/logging needed here, not just print
             print "No data found at %s. Check if directory name is correct and if you really collected archives!" % (name)
-            
 
 
-def collect_from_url(url, archive_dir=CONFIG.mail_path, notes=None):
+
+def collect_from_url(url, archive_dir=CONFIG.mail_path, notes=None,
+                     workers=1, per_host_limit=None, unzip=False, fmt='csv',
+                     rate=None, limiter=None, session=None, stats=None):
+    """
+    Collects the archives of the mailing list at *url* and stores its
+    messages as {archive_dir}/LIST_NAME.csv, or in the columnar format
+    *fmt* ('parquet' or 'feather'; see bigbang.storage).
+
+    See collect_archive_from_url for the remaining arguments.
+    """
     url = url.rstrip()
     try:
-        has_archives = collect_archive_from_url(url, archive_dir=archive_dir, notes=notes)
-    except urllib2.HTTPError as e:
+        has_archives = collect_archive_from_url(url, archive_dir=archive_dir, notes=notes,
+                                                workers=workers,
+                                                per_host_limit=per_host_limit,
+                                                rate=rate, limiter=limiter, session=session,
+                                                stats=stats)
+    except (urllib2.HTTPError, requests.HTTPError) as e:
         # BUG: this error code/message is misleading
         print "HTTP 404 Error: %s" % (url)
+        if stats is not None:
+            stats['error'] = str(e)
         return None
 
     if has_archives:
-        unzip_archive(url)
+        if unzip:
+            unzip_archive(url, archive_dir=archive_dir)
         try:
-            data = open_list_archives(url)
+            data = open_list_archives(url, archive_dir=archive_dir)
         except MissingDataException as e:   # don't strictly need to open the archives during the collection process, so catch the Exception and return
             print e
             return None
 
         # hard coding the archives directory in too many places
         # need to push this default to a configuration file
-        path = os.path.join(archive_dir, get_list_name(url) + ".csv").replace("\\","/")
+        path = os.path.join(archive_dir, get_list_name(url) +
+                            storage.FORMAT_EXTENSIONS[fmt]).replace("\\","/")
 
         try:
-            data.to_csv(path, ",", encoding="utf-8")
+            storage.write_archive_data(data, path, fmt=fmt, encoding="utf-8")
         except Exception as e:
             print e
             # if encoding doesn't work...don't encode? ----better not not encode !!
@@ -139,10 +188,77 @@ def urls_to_collect(urls_file):
         urls.append(url)
     return urls
 
-def collect_from_file(urls_file, archive_dir=CONFIG.mail_path, notes=None):
-    urls = urls_to_collect(urls_file)
+def interleave_by_host(urls):
+    """
+    Reorders *urls* to alternate between hosts, keeping the order of
+    the urls for each host.
+    """
+    by_host = collections.OrderedDict()
     for url in urls:
-        collect_from_url(url, archive_dir=archive_dir, notes=notes)
+        by_host.setdefault(fetch.host_of(url), []).append(url)
+
+    interleaved = []
+    for i in range(max([len(host_urls) for host_urls in by_host.values()] or [0])):
+        for host_urls in by_host.values():
+            if i < len(host_urls):
+                interleaved.append(host_urls[i])
+    return interleaved
+
+REPORT_COLUMNS = ['list', 'url', 'host', 'files', 'not_modified', 'bytes',
+                  'failures', 'error', 'duration']
+
+def collect_from_file(urls_file, archive_dir=CONFIG.mail_path, notes=None,
+                      workers=1, per_host_limit=None, unzip=False, fmt='csv',
+                      lists=1, rate=None):
+    """
+    Collects the archives of every mailing list in *urls_file*.
+
+    Up to *lists* lists are collected at once, each with *workers*
+    download threads. Requests for all lists share one HostLimiter, so
+    at most *per_host_limit* requests are in flight to a host, and at
+    most *rate* requests per second are made to it, however many of its
+    lists are being collected. Without a *rate*, the hosts of W3C lists
+    get w3crawl.DEFAULT_RATE. Lists are taken from the different hosts
+    in turn.
+
+    Returns a dataframe reporting, for each list, the number of files
+    downloaded and found unchanged, the bytes transferred, the number
+    of failed downloads, any error, and the time taken in seconds.
+    """
+    urls = interleave_by_host(urls_to_collect(urls_file))
+    w3c_hosts = set(fetch.host_of(url) for url in urls if w3c_archives_exp.search(url))
+    limiter = fetch.HostLimiter(per_host_limit, rate=rate,
+                                host_rates=dict((host, rate or w3crawl.DEFAULT_RATE)
+                                                for host in w3c_hosts))
+    session = fetch.new_session(pool_size=max(workers, per_host_limit or 1))
+
+    def collect(url):
+        stats = {'list': get_list_name(url), 'url': url, 'host': fetch.host_of(url)}
+        start = time.time()
+        try:
+            collect_from_url(url, archive_dir=archive_dir, notes=notes,
+                             workers=workers, per_host_limit=per_host_limit,
+                             unzip=unzip, fmt=fmt, rate=rate,
+                             limiter=limiter, session=session, stats=stats)
+        except Exception as e:
+            logging.warning('Failed to collect %s', url, exc_info=True)
+            stats['error'] = str(e)
+        stats['duration'] = time.time() - start
+        return stats
+
+    if lists > 1:
+        pool = ThreadPool(lists)
+        try:
+            rows = pool.map(collect, urls)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rows = [collect(url) for url in urls]
+
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    logging.info('Collection report:\n%s', report.to_string())
+    return report
 
 def get_list_name(url):
     """
@@ -238,11 +354,34 @@ def update_provenance(directory, provenance):
     logging.info('Updated provenance file in %s', directory)
     file_handle.close()
 
-def collect_archive_from_url(url, archive_dir=CONFIG.mail_path, notes=None):
+def collect_archive_from_url(url, archive_dir=CONFIG.mail_path, notes=None,
+                             workers=1, per_host_limit=None, rate=None,
+                             limiter=None, session=None, stats=None):
     """
     Collects archives (generally tar.gz) files from mailmain
     archive page.
 
+    Monthly archive files are downloaded by a pool of *workers* threads
+    sharing one HTTP connection pool, with at most *per_host_limit*
+    concurrent requests to the archive host (no limit beyond *workers*
+    if None), and at most *rate* requests per second to it. W3C
+    archives are crawled at w3crawl.DEFAULT_RATE requests per second
+    unless *rate* is given. A *limiter* passed in is used as it is, with
+    its own rates.
+
+    The ETag, Last-Modified and size of the index page and of each
+    archive file are recorded in the list's provenance file. On later
+    collections requests are made conditional on those validators, so
+    unchanged files are not transferred again and interrupted downloads
+    are resumed.
+
+    A HostLimiter and requests session shared with other collections may
+    be passed as *limiter* and *session*. If *stats* is a dict, the
+    number of files downloaded ('files') and found unchanged
+    ('not_modified'), the bytes transferred and the number of failed
+    downloads ('failures') are stored in it; for W3C archives, these
+    count message pages.
+
     Returns True if archives were downloaded, False otherwise
     (for example if the page lists no accessible archive files).
     """
@@ -250,14 +389,30 @@ def collect_archive_from_url(url, archive_dir=CONFIG.mail_path, notes=None):
     pp("Getting archive page for %s" % list_name)
 
     if w3c_archives_exp.search(url):
-        return w3crawl.collect_from_url(url, archive_dir, notes=notes)
-
-    response = urllib2.urlopen(url)
-    html = response.read()
-
-    results = []
-    for exp in mailing_list_path_expressions:
-        results.extend(exp.findall(html))
+        # W3C archives are crawled page by page, politely; a shared
+        # limiter sets its own rate for the host
+        if limiter is None:
+            limiter = fetch.HostLimiter(per_host_limit, rate=rate or w3crawl.DEFAULT_RATE)
+        return w3crawl.collect_from_url(url, archive_dir, notes=notes,
+                                        workers=workers, session=session,
+                                        limiter=limiter, stats=stats)
+
+    provenance = access_provenance(os.path.join(archive_dir, list_name)) or {}
+    files = provenance.get('files') or {}
+
+    session = session or fetch.new_session(pool_size=max(workers, per_host_limit or 1))
+    limiter = limiter or fetch.HostLimiter(per_host_limit, rate=rate)
+    html, index_validators = fetch.get_page(url, provenance.get('index'),
+                                            session=session, limiter=limiter)
+
+    if html is None:
+        # index page unchanged since last collection
+        results = sorted(files.keys())
+        logging.info('Archive index for %s is unchanged', list_name)
+    else:
+        results = []
+        for exp in mailing_list_path_expressions:
+            results.extend(exp.findall(html))
 
     pp(results)
 
@@ -266,54 +421,74 @@ def collect_archive_from_url(url, archive_dir=CONFIG.mail_path, notes=None):
 
     populate_provenance(directory=arc_dir, list_name=list_name, list_url=url, notes=notes)
 
-    encountered_error = False
-    # download monthly archives
+    # download monthly archives; files collected before are only
+    # transferred again if the server reports they have changed
+    downloads = []
     for res in results:
         result_path = os.path.join(arc_dir, res)
-        # this check is redundant with urlretrieve
-        if not os.path.isfile(result_path):
-            gz_url = "/".join([url.strip("/"),res])
-            pp('retrieving %s' % gz_url)
-            resp = urllib2.urlopen(gz_url)
-            if resp.getcode() == 200:
-                print("200 - writing file to %s" % (result_path))
-                output = open(result_path, 'wb')
-                output.write(resp.read())
-                output.close()
-            else:
-                print("%s error code trying to retrieve %s" %
-                      (str(resp.getcode(), gz_url)))
-                encountered_error = True
+        gz_url = "/".join([url.strip("/"),res])
+        downloads.append(fetch.Download(gz_url, result_path, files.get(res)))
+
+    fetch.download_files(downloads, workers=workers, session=session, limiter=limiter)
 
+    if stats is not None:
+        stats['files'] = len([d for d in downloads if d.status in ('downloaded', 'resumed')])
+        stats['not_modified'] = len([d for d in downloads if d.status == 'not-modified'])
+        stats['bytes'] = sum(d.transferred for d in downloads)
+        stats['failures'] = len([d for d in downloads if d.error is not None])
+
+    encountered_error = False
+    for download in downloads:
+        if download.error is not None:
+            # keep the validators of the file as it was, if any, so
+            # that the next collection retries the download
+            encountered_error = True
+            continue
+        files[os.path.basename(download.path)] = download.validators
+
+    provenance = access_provenance(arc_dir)
+    provenance['files'] = files
     if not encountered_error:   # mark that all available archives were collected
-        provenance = access_provenance(arc_dir)
+        provenance['index'] = index_validators
         provenance['complete'] = True
-        update_provenance(arc_dir, provenance)
+    else:
+        # fetch the whole index next time, to list the failed files again
+        provenance.pop('index', None)
+    update_provenance(arc_dir, provenance)
 
     # return True if any archives collected, false otherwise
     return len(results) > 0
 
 
 def unzip_archive(url, archive_dir=CONFIG.mail_path):
+    """
+    Writes a decompressed .txt copy next to each .txt.gz archive file
+    of a list, streaming the contents rather than reading them into memory.
+
+    Archive files whose decompressed copy is at least as new as the
+    compressed file are skipped.
+
+    This step is optional: open_list_archives reads compressed archive
+    files directly.
+    """
     arc_dir = archive_directory(archive_dir, get_list_name(url))
 
     gzs = [os.path.join(arc_dir, fn) for fn
            in os.listdir(arc_dir)
            if fn.endswith('.txt.gz')]
 
-    print 'unzipping %d archive files' % (len(gzs))
-
-    for gz in gzs:
-        try:
-            f = gzip.open(gz, 'rb')
-            content = f.read()
-            f.close()
+    stale = [gz for gz in gzs
+             if not os.path.isfile(gz[:-3])
+             or os.path.getmtime(gz[:-3]) < os.path.getmtime(gz)]
 
-            txt_fn = str(gz[:-3])
+    print 'unzipping %d of %d archive files' % (len(stale), len(gzs))
 
-            f2 = open(txt_fn, 'w')
-            f2.write(content)
-            f2.close()
+    for gz in stale:
+        txt_fn = str(gz[:-3])
+        try:
+            with closing(gzip.open(gz, 'rb')) as f, open(txt_fn + fetch.PART_SUFFIX, 'wb') as f2:
+                shutil.copyfileobj(f, f2)
+            fetch.replace_file(txt_fn + fetch.PART_SUFFIX, txt_fn)
         except Exception as e:
             print e
 
@@ -338,7 +513,138 @@ def recursive_get_payload(x):
         print x
         return None
 
-def open_list_archives(url, archive_dir=CONFIG.mail_path, mbox=False):
+MBOX_EXTENSIONS = ['.txt', '.mail', '.mbox']
+
+COMPRESSED_OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.BZ2File,
+}
+
+def open_mbox_file(path):
+    """
+    Opens an mbox file for reading, decompressing it on the fly if its
+    extension is that of a known compression format (.gz, .bz2).
+    """
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1], open)
+    return opener(path, 'rb')
+
+def iter_mbox(path, headers_only=False):
+    """
+    Yields the messages of the mbox file at *path* as mailbox.mboxMessage
+    objects, reading the file as a stream.
+
+    Messages are split on "From " lines as by mailbox.mbox, but the file
+    need not be seekable, so compressed files are read without first
+    being decompressed to disk.
+
+    If *headers_only* is True, only the header block of each message is
+    kept and parsed, and the messages have empty bodies.
+    """
+    header_parser = email.parser.HeaderParser(_class=mailbox.mboxMessage)
+
+    def to_message(from_line, lines):
+        if headers_only:
+            msg = header_parser.parsestr(''.join(lines).replace(os.linesep, '\n'))
+        else:
+            if lines and lines[-1] == os.linesep:
+                lines.pop()
+            msg = mailbox.mboxMessage(''.join(lines).replace(os.linesep, '\n'))
+        msg.set_from(from_line.replace(os.linesep, '')[5:])
+        return msg
+
+    with closing(open_mbox_file(path)) as f:
+        from_line = None
+        lines = []
+        in_headers = False
+        for line in f:
+            if line.startswith('From '):
+                if from_line is not None:
+                    yield to_message(from_line, lines)
+                from_line = line
+                lines = []
+                in_headers = True
+            elif from_line is not None and (in_headers or not headers_only):
+                if line == os.linesep:
+                    in_headers = False
+                lines.append(line)
+
+        if from_line is not None:
+            yield to_message(from_line, lines)
+
+def list_archive_files(arc_dir):
+    """
+    Returns the paths of the mbox files in directory *arc_dir*.
+
+    Files may be compressed (e.g. 2001-November.txt.gz). If both a
+    compressed file and its decompressed copy are present, only one of
+    them is returned: the decompressed copy if it is at least as new as
+    the compressed file, otherwise the compressed file.
+    """
+    candidates = {}
+
+    for fn in os.listdir(arc_dir):
+        base, ext = os.path.splitext(fn)
+        if ext in COMPRESSED_OPENERS:
+            compressed = True
+        else:
+            base = fn
+            compressed = False
+
+        if not any([base.endswith(extension) for extension in MBOX_EXTENSIONS]):
+            continue
+
+        candidates.setdefault(base, {})[compressed] = os.path.join(arc_dir, fn)
+
+    paths = []
+    for base, versions in candidates.items():
+        plain = versions.get(False)
+        packed = versions.get(True)
+
+        if plain is not None and (packed is None or
+                                  os.path.getmtime(plain) >= os.path.getmtime(packed)):
+            paths.append(plain)
+        else:
+            paths.append(packed)
+
+    return paths
+
+def archive_file_month(path):
+    """
+    Returns the month (as a datetime.datetime) that an archive file is named
+    after, e.g. 2001-November.txt.gz or 2001-11.mail, or None if the
+    file name does not name a month.
+    """
+    name = os.path.basename(path).split('.')[0]
+    for month_format in ['%Y-%B', '%Y-%m']:
+        try:
+            return datetime.datetime.strptime(name, month_format)
+        except ValueError:
+            pass
+    return None
+
+def sort_archive_files(paths):
+    """
+    Sorts archive file paths by the month they are named after.
+    Files not named after a month come last, in lexical order.
+    """
+    def key(path):
+        month = archive_file_month(path)
+        return (month is None, month, path)
+    return sorted(paths, key=key)
+
+def open_archive_file(path, decoder=None, parser=None, headers_only=False):
+    """
+    Returns a dataframe of the messages in a single mbox file.
+
+    If *headers_only* is True, message bodies are not parsed and the
+    Body column is None.
+    """
+    return messages_to_dataframe(iter_mbox(path, headers_only=headers_only),
+                                 decoder=decoder, parser=parser,
+                                 headers_only=headers_only)
+
+def open_list_archives(url, archive_dir=CONFIG.mail_path, mbox=False, workers=1,
+                       cache=None, headers_only=False):
     """
     Returns a list of all email messages contained in the specified directory.
 
@@ -348,43 +654,99 @@ def open_list_archives(url, archive_dir=CONFIG.mail_path, mbox=False):
     This directory is expected to contain files with extensions .txt,
     .mail, or .mbox. These files are all expected to be in mbox format--
     i.e. a series of blocks of text starting with headers (colon-separated
-    key-value pairs) followed by an email body.
+    key-value pairs) followed by an email body. Files compressed with
+    gzip or bzip2 (e.g. .txt.gz) are read directly.
+
+    If *workers* is greater than 1, the files are parsed in parallel by
+    a pool of that many processes. Either way the messages of each file
+    are concatenated in month order.
+
+    If *cache* is an ArchiveCache (or True, for the default cache), files
+    that have been parsed before and not changed since are read from the
+    cache instead of being parsed again. Dates in the returned dataframe
+    are then normalized to UTC.
+
+    If *headers_only* is True, only the header block of each message is
+    parsed and the Body column is None. This is much faster, and enough
+    for activity, interaction graphs and threads; bodies can be read
+    later from an mbox_index.ArchiveIndex.
     """
-
-    messages = None
+    if cache is True:
+        cache = ArchiveCache()
 
     if mbox and (os.path.isfile(os.path.join(archive_dir, url))):
         # treat string as the path to a file that is an mbox
-        box = mailbox.mbox(os.path.join(archive_dir, url), create=False)
-        messages = box.values()
-    else:
-        # assume string is the path to a directory with many
+        return open_archive_file(os.path.join(archive_dir, url),
+                                 headers_only=headers_only)
 
-        list_name = get_list_name(url)
+    # assume string is the path to a directory with many
 
-        arc_dir = archive_directory(archive_dir, list_name)
+    list_name = get_list_name(url)
 
+    arc_dir = archive_directory(archive_dir, list_name)
 
-        file_extensions = [".txt", ".mail", ".mbox"]
+    txts = sort_archive_files(list_archive_files(arc_dir))
 
-        txts = [os.path.join(arc_dir, fn) for fn in os.listdir(arc_dir) if any([fn.endswith(extension) for extension in file_extensions])]
+    print 'Opening %d archive files' % (len(txts))
 
-        print len(txts)
+    if len(txts) == 0:
+        raise MissingDataException(
+            ("No messages in %s under %s. Did you run the "
+             "collect_mail.py script?") %
+            (archive_dir, list_name))
 
-        print 'Opening %d archive files' % (len(txts))
-        arch = [mailbox.mbox(txt, create=False).values() for txt in txts]
+    frames = parse_archive_files(txts, workers=workers, cache=cache,
+                                 headers_only=headers_only)
+    return pd.concat(frames)
 
+def parse_archive_files(txts, workers=1, cache=None, headers_only=False):
+    """
+    Returns a list of dataframes of the messages in each of the mbox
+    files *txts*, in the same order.
 
-        if len(arch) == 0:
-            raise MissingDataException(
-                ("No messages in %s under %s. Did you run the "
-                 "collect_mail.py script?") %
-                (archive_dir, list_name))
+    Files are parsed by *workers* processes, or read from *cache* (an
+    ArchiveCache) as described for open_list_archives. Only fully
+    parsed files are added to the cache, so *headers_only* frames are
+    never stored there.
+    """
+    frames = dict()
+    if cache is not None:
+        for txt in txts:
+            frame = cache.get(txt)
+            if frame is not None:
+                if headers_only:
+                    frame['Body'] = None
+                frames[txt] = frame
+        logging.info('Found %d of %d archive files in cache', len(frames), len(txts))
+
+    to_parse = [txt for txt in txts if txt not in frames]
+
+    if workers > 1 and len(to_parse) > 1:
+        pool = multiprocessing.Pool(min(workers, len(to_parse)))
+        try:
+            parsed = pool.map(functools.partial(open_archive_file,
+                                                headers_only=headers_only),
+                              to_parse)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        # share one decoder and date parser, and what they learn, across the files
+        decoder = BodyDecoder()
+        parser = parse.DateParser()
+        parsed = [open_archive_file(txt, decoder, parser, headers_only)
+                  for txt in to_parse]
+        logging.info('Body decoding paths: %s', dict(decoder.counts))
 
+    for txt, frame in zip(to_parse, parsed):
+        if cache is not None and not headers_only:
+            cache.put(txt, storage.normalize_dates(frame))
+        frames[txt] = frame
 
-        messages = [item for sublist in arch for item in sublist]
+    if cache is not None:
+        cache.flush()
 
-    return messages_to_dataframe(messages)
+    return [frames[txt] for txt in txts]
 
 def open_activity_summary(url, archive_dir=CONFIG.mail_path):
     """
@@ -407,82 +769,254 @@ def open_activity_summary(url, archive_dir=CONFIG.mail_path):
     activity_frame = pd.read_csv(path, index_col=0, encoding='utf-8')
     return activity_frame
 
-def get_text(msg):
-    ## This code for character detection and dealing with exceptions is terrible
-    ## It is in need of refactoring badly. - sb
-    import chardet
-    text = u""
+def rejects_lone_bytes(charset):
+    """
+    Returns True if *charset* fails to decode each byte above 0x7F on
+    its own, as multi-byte charsets do, so that decoding bytes in
+    another charset with it is likely to fail.
+    """
+    for byte in range(0x80, 0x100):
+        try:
+            chr(byte).decode(charset)
+            return False
+        except UnicodeDecodeError:
+            pass
+    return True
+
+class BodyDecoder(object):
+    """
+    Decodes message bodies to unicode, trying cheap decodings first.
+
+    Text parts are decoded with their declared charset if there is one.
+    Otherwise ASCII and then UTF-8 are tried, then any multi-byte
+    charsets that statistical detection (chardet) has found for earlier
+    parts, and only then chardet itself. Because detected charsets are
+    remembered, a single decoder should be used for all the messages of
+    a list. Single-byte charsets are not remembered: they decode almost
+    any bytes, so they would be used for text in any other charset.
+
+    *counts* records how often each decoding path is taken.
+    """
+
+    def __init__(self):
+        self.detected = []
+        self.counts = collections.Counter()
+
+    def decode(self, payload, charset=None, message_id=None):
+        """
+        Returns the byte string *payload* decoded to unicode.
+        """
+        if payload is None:
+            return u""
+
+        if charset is not None:
+            try:
+                text = unicode(payload, str(charset), "ignore")
+                self.counts['declared'] += 1
+                return text
+            except LookupError as e:
+                print "%s unknown encoding in message %s, using UTF-8 instead" % (charset,message_id)
+                self.counts['unknown'] += 1
+                return unicode(payload, "utf-8", "ignore")
+
+        for path, candidate in [('ascii', 'ascii'), ('utf-8', 'utf-8')]:
+            try:
+                text = unicode(payload, candidate)
+                self.counts[path] += 1
+                return text
+            except UnicodeDecodeError:
+                pass
+
+        for candidate in self.detected:
+            try:
+                text = unicode(payload, candidate)
+                self.counts['cached'] += 1
+                return text
+            except UnicodeDecodeError:
+                pass
+
+        import chardet
+        detected = chardet.detect(payload)['encoding']
+        if detected is not None:
+            try:
+                text = unicode(payload, detected, "ignore")
+                self.counts['detected'] += 1
+                if detected not in self.detected and rejects_lone_bytes(detected):
+                    self.detected.append(detected)
+                return text
+            except LookupError:
+                pass
+
+        self.counts['fallback'] += 1
+        return unicode(payload, "utf-8", "ignore")
+
+    def html_to_text(self, html):
+        import html2text
+        h = html2text.HTML2Text()
+        h.encoding = 'utf-8'
+        self.counts['html'] += 1
+        return unicode(h.handle(html))
+
+def get_text(msg, decoder=None):
+    """
+    Returns the text of the body of a message, as unicode.
+
+    For multipart messages, this is the text/plain part. Only if there
+    is none is a text/html part decoded and converted to text.
+
+    *decoder* is a BodyDecoder; pass the same one for all the messages
+    of a list to reuse the charsets it detects.
+    """
+    decoder = decoder or BodyDecoder()
+
     if msg.is_multipart():
+        plain = None
         html = None
         for part in msg.walk():
-            if part.get_content_charset() is None:
-                charset = chardet.detect(str(part))['encoding']
-            else:
-                charset = part.get_content_charset()
-            if part.get_content_type() == 'text/plain':
-                try:
-                    text = unicode(part.get_payload(decode=True), str(charset), "ignore")
-                except LookupError as e:
-                    print "%s unknown encoding in message %s, using UTF-8 instead" % (charset,msg['Message-ID'])
-                    charset = "utf-8"
-                    text = unicode(part.get_payload(decode=True), str(charset), "ignore")
-
-            if part.get_content_type() == 'text/html':
-                try:
-                    html = unicode(part.get_payload(decode=True), str(charset), "ignore")
-                except LookupError as e:
-                    print "%s unknown encoding in message %s, using UTF-8 instead" % (charset,msg['Message-ID'])
-                    charset = "utf-8"
-                    html = unicode(part.get_payload(decode=True), str(charset), "ignore")
-
-        if text is not None:
+            content_type = part.get_content_type()
+            if content_type == 'text/plain':
+                plain = part
+            elif content_type == 'text/html':
+                html = part
+
+        if plain is not None:
+            text = decoder.decode(plain.get_payload(decode=True),
+                                  plain.get_content_charset(), msg['Message-ID'])
             return text.strip()
+        elif html is not None:
+            text = decoder.decode(html.get_payload(decode=True),
+                                  html.get_content_charset(), msg['Message-ID'])
+            return decoder.html_to_text(text)
         else:
-            import html2text
-            h = html2text.HTML2Text()
-            h.encoding = 'utf-8'
-            return unicode(h.handle(html))
+            decoder.counts['no-text'] += 1
+            return u""
     else:
         charset = msg.get_content_charset() or 'utf-8'
-        try:
-            text = unicode(msg.get_payload(), encoding=charset, errors='ignore')
-        except LookupError as e:
-            print "%s unknown encoding in message %s, using UTF-8 instead" % (charset,msg['Message-ID'])
-            charset = "utf-8"
-            text = unicode(msg.get_payload(), encoding=charset, errors='ignore')
+        text = decoder.decode(msg.get_payload(), charset, msg['Message-ID'])
         return text.strip()
 
-def messages_to_dataframe(messages):
+MESSAGE_COLUMNS = ['Message-ID', 'From',
+                   'Subject',
+                   'Date',
+                   'In-Reply-To',
+                   'References',
+                   'Body']
+
+DEFAULT_CHUNK_SIZE = 10000
+
+def safe_unicode(t):
+    return t and unicode(t, 'utf-8', 'replace')
+
+def message_to_record(m, decoder=None, parser=None, headers_only=False):
+    """
+    Returns a tuple of the values of MESSAGE_COLUMNS for a parsed message.
+
+    The date is given in UTC seconds since the epoch, as parsed by
+    *parser* (a parse.DateParser); records_to_dataframe converts it to a
+    timestamp. If *headers_only* is True, the body is not decoded and
+    is given as None.
+    """
+    parser = parser or parse.DateParser()
+    epoch = parser.epoch(m.get('Date'))
+
+    return (m.get('Message-ID'),
+            safe_unicode(m.get('From')).replace('\\', ' '),
+            safe_unicode(m.get('Subject')),
+            parse.MISSING_EPOCH if epoch is None else epoch,
+            safe_unicode(m.get('In-Reply-To')),
+            safe_unicode(m.get('References')),
+            None if headers_only else get_text(m, decoder))
+
+def records_to_dataframe(records):
+    mdf = pd.DataFrame.from_records(records,
+                                    index='Message-ID',
+                                    columns=MESSAGE_COLUMNS)
+    mdf.index.name = 'Message-ID'
+
+    # dates are normalized to UTC in one pass
+    mdf['Date'] = parse.epochs_to_datetimes(mdf['Date'].values)
+
+    return mdf
+
+def messages_to_dataframe(messages, decoder=None, parser=None, headers_only=False):
     """
     Turn a list of parsed messages into a dataframe of message data,
     indexed by message-id, with column-names from headers.
 
+    Bodies are decoded with *decoder*, a BodyDecoder, and dates parsed
+    by *parser*, a parse.DateParser. Dates are returned as UTC timestamps.
+    If *headers_only* is True, bodies are not decoded and the Body
+    column is None.
     """
-    def safe_unicode(t):
-        return t and unicode(t, 'utf-8', 'replace')
+    decoder = decoder or BodyDecoder()
+    parser = parser or parse.DateParser()
+
     # extract data into a list of tuples -- records -- with
     # the Message-ID separated out as an index
-    #valid_messages = [m for m in messages if m.get() 
-
-    
-    pm = [(m.get('Message-ID'),
-           safe_unicode(m.get('From')).replace('\\', ' '),
-           safe_unicode(m.get('Subject')),
-           get_date(m),
-           safe_unicode(m.get('In-Reply-To')),
-           safe_unicode(m.get('References')),
-           get_text(m))
+    pm = [message_to_record(m, decoder, parser, headers_only)
           for m in messages if m.get('From')]
 
- 
-    mdf = pd.DataFrame.from_records(list(pm),
-                                    index='Message-ID',
-                                    columns=['Message-ID', 'From',
-                                             'Subject',
-                                             'Date',
-                                             'In-Reply-To',
-                                             'References',
-                                             'Body'])
-    mdf.index.name = 'Message-ID'
+    logging.debug('Body decoding paths: %s', dict(decoder.counts))
+    logging.debug('Date parsing paths: %s', dict(parser.counts))
 
-    return mdf
+    return records_to_dataframe(pm)
+
+def iter_message_dataframes(messages, chunksize=DEFAULT_CHUNK_SIZE, decoder=None,
+                            parser=None):
+    """
+    Turn an iterable of parsed messages into a sequence of dataframes
+    of at most *chunksize* messages each, in the format of
+    messages_to_dataframe.
+
+    Messages are consumed lazily, so only one chunk of records is held
+    in memory at a time.
+    """
+    decoder = decoder or BodyDecoder()
+    parser = parser or parse.DateParser()
+    records = []
+    yielded = False
+
+    for m in messages:
+        if not m.get('From'):
+            continue
+        records.append(message_to_record(m, decoder, parser))
+        if len(records) >= chunksize:
+            yield records_to_dataframe(records)
+            yielded = True
+            records = []
+
+    if records or not yielded:
+        yield records_to_dataframe(records)
+
+def messages_to_storage(messages, path, chunksize=DEFAULT_CHUNK_SIZE, fmt=None):
+    """
+    Writes the message data of an iterable of parsed messages to *path*,
+    in Parquet or CSV format (see bigbang.storage), *chunksize* messages
+    at a time.
+
+    Returns the number of messages written.
+    """
+    return storage.write_archive_chunks(iter_message_dataframes(messages, chunksize),
+                                        path, fmt=fmt)
+
+def list_archives_to_storage(url, path, archive_dir=CONFIG.mail_path,
+                             chunksize=DEFAULT_CHUNK_SIZE, fmt=None):
+    """
+    Parses all the archive files of a list, as open_list_archives does,
+    and writes their messages to *path* chunk by chunk, without holding
+    the whole list in memory.
+
+    Returns the number of messages written.
+    """
+    list_name = get_list_name(url)
+    arc_dir = archive_directory(archive_dir, list_name)
+    txts = sort_archive_files(list_archive_files(arc_dir))
+
+    if len(txts) == 0:
+        raise MissingDataException(
+            ("No messages in %s under %s. Did you run the "
+             "collect_mail.py script?") %
+            (archive_dir, list_name))
+
+    messages = itertools.chain.from_iterable(iter_mbox(txt) for txt in txts)
+    return messages_to_storage(messages, path, chunksize=chunksize, fmt=fmt)
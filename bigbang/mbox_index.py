@@ -0,0 +1,228 @@
+"""
+Byte-offset indexes of raw mbox files, for reading single messages
+without parsing whole files.
+
+An MboxIndex records, for each message of an mbox file, its Message-ID,
+the byte offset and length of the message in the file, and a few header
+fields. The index is found by scanning a memory map of the file for
+"From " separator lines, and saved next to the file as
+FILE.index.json. It is only rebuilt when the file's size or
+modification time change.
+"""
+from email.parser import HeaderParser
+import json
+import logging
+import mailbox
+import mmap
+import os
+
+import mailman
+import pandas as pd
+
+INDEX_SUFFIX = '.index.json'
+
+HEADER_FIELDS = ['From', 'Subject', 'Date', 'In-Reply-To', 'References']
+
+
+class UnindexableFileException(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def find_separators(mm):
+    """
+    Returns the offsets of the "From " lines in the memory map *mm*.
+    """
+    offsets = []
+    if mm[:5] == 'From ':
+        offsets.append(0)
+
+    position = mm.find('\nFrom ')
+    while position != -1:
+        offsets.append(position + 1)
+        position = mm.find('\nFrom ', position + 1)
+    return offsets
+
+
+def message_from_bytes(raw):
+    """
+    Returns an mboxMessage from the bytes of one message of an mbox file,
+    starting with its "From " line, as split by mailman.iter_mbox.
+    """
+    from_line, newline, text = raw.partition('\n')
+    if text.endswith('\n\n') or text == '\n':
+        # the blank line before the next "From " line
+        text = text[:-1]
+    msg = mailbox.mboxMessage(text)
+    msg.set_from(from_line[5:])
+    return msg
+
+
+class MboxIndex(object):
+    """
+    The index of the mbox file at *path*.
+
+    Compressed files can't be memory mapped, and raise an
+    UnindexableFileException.
+    """
+
+    def __init__(self, path):
+        if os.path.splitext(path)[1] in mailman.COMPRESSED_OPENERS:
+            raise UnindexableFileException(path)
+
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+
+        stat = os.stat(path)
+        index = self._load_index()
+        if index is None or index['size'] != stat.st_size or index['mtime'] != stat.st_mtime:
+            index = self.build(stat)
+
+        self.messages = index['messages']
+        # Message-ID -> position in messages, of its first occurrence
+        self.positions = {}
+        for i, entry in enumerate(self.messages):
+            self.positions.setdefault(entry['Message-ID'], i)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def build(self, stat=None):
+        """
+        Scans the mbox file, writes its index and returns it.
+        """
+        stat = stat or os.stat(self.path)
+        logging.info('Indexing %s', self.path)
+
+        messages = []
+        if stat.st_size > 0:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    offsets = find_separators(mm)
+                    ends = offsets[1:] + [len(mm)]
+                    for start, end in zip(offsets, ends):
+                        messages.append(self._entry(mm, start, end))
+                finally:
+                    mm.close()
+
+        index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'messages': messages}
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        if os.name == 'nt' and os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(self.index_path + '.tmp', self.index_path)
+
+        return index
+
+    def _entry(self, mm, start, end):
+        header_start = mm.find('\n', start, end) + 1
+        header_end = mm.find('\n\n', header_start, end)
+        if header_end == -1:
+            header_end = end
+        headers = HeaderParser().parsestr(mm[header_start:header_end])
+
+        entry = {'offset': start, 'length': end - start,
+                 'Message-ID': mailman.safe_unicode(headers.get('Message-ID'))}
+        for field in HEADER_FIELDS:
+            entry[field] = mailman.safe_unicode(headers.get(field))
+        return entry
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __contains__(self, message_id):
+        return message_id in self.positions
+
+    def message_ids(self):
+        return [entry['Message-ID'] for entry in self.messages]
+
+    def headers(self):
+        """
+        Returns a dataframe of the indexed header fields, with the
+        offset and length of each message, indexed by Message-ID.
+        """
+        return pd.DataFrame.from_records(
+            self.messages, index='Message-ID',
+            columns=['Message-ID'] + HEADER_FIELDS + ['offset', 'length'])
+
+    def get_bytes(self, message_id):
+        """
+        Returns the raw bytes of the message with *message_id*,
+        starting with its "From " line.
+        """
+        entry = self.messages[self.positions[message_id]]
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            return f.read(entry['length'])
+
+    def get_message(self, message_id):
+        """
+        Returns the message with *message_id* as an mboxMessage.
+        """
+        return message_from_bytes(self.get_bytes(message_id))
+
+    def get_body(self, message_id, decoder=None):
+        """
+        Returns the text of the body of the message with *message_id*,
+        as in the Body column of mailman.messages_to_dataframe.
+        """
+        return mailman.get_text(self.get_message(message_id), decoder)
+
+
+class ArchiveIndex(object):
+    """
+    The indexes of the mbox files of a list, in directory *arc_dir*.
+
+    Files that are only present compressed are not indexed; decompress
+    them first (e.g. with bin/collect_mail.py --unzip).
+    """
+
+    def __init__(self, arc_dir):
+        self.indexes = []
+        for path in mailman.sort_archive_files(mailman.list_archive_files(arc_dir)):
+            try:
+                self.indexes.append(MboxIndex(path))
+            except UnindexableFileException:
+                logging.warning('Not indexing compressed archive file %s', path)
+
+        self.decoder = mailman.BodyDecoder()
+
+    def __len__(self):
+        return sum(len(index) for index in self.indexes)
+
+    def __contains__(self, message_id):
+        return self.locate(message_id) is not None
+
+    def locate(self, message_id):
+        """
+        Returns the MboxIndex of the file holding *message_id*, or None.
+        """
+        for index in self.indexes:
+            if message_id in index:
+                return index
+        return None
+
+    def headers(self):
+        """
+        Returns a dataframe of the indexed header fields of all files.
+        """
+        return pd.concat([index.headers() for index in self.indexes])
+
+    def get_body(self, message_id):
+        """
+        Returns the text of the body of the message with *message_id*,
+        or None if it is not in any indexed file.
+        """
+        index = self.locate(message_id)
+        if index is None:
+            return None
+        return index.get_body(message_id, self.decoder)
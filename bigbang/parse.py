@@ -1,7 +1,13 @@
 from pprint import pprint as pp
+import calendar
+import collections
+import datetime
 import email
+import email.utils
 import re
 import dateutil.parser as dp
+import numpy as np
+import pandas as pd
 import pytz
 import warnings
 
@@ -79,30 +85,133 @@ def guess_first_name(cleaned_from):
     else:   # no spaces or commas? with a single name, more likely to be a handle than a given name
         return None
 
-def get_date(message):
-    def safe_unicode(t):
-        return t and unicode(t, 'utf-8', 'ignore')
-    try:
-        # some mail clients add a parenthetical timezone
-        ds = safe_unicode(message.get('Date'))
-        ds = re.sub("\(.*$", "", ds)
-        ds = re.sub("--", "-", ds)
-        ds = re.sub(" Hora.*$", "", ds)
+# epoch value standing in for a missing or unparseable date;
+# equal to pandas' NaT when read as nanoseconds
+MISSING_EPOCH = np.iinfo(np.int64).min
 
-        date = dp.parse(ds)
+# range of seconds since the epoch representable as pandas timestamps
+MIN_EPOCH = pd.Timestamp.min.value // 10 ** 9 + 1
+MAX_EPOCH = pd.Timestamp.max.value // 10 ** 9
 
-        # this adds noise and could raise trouble
-        if date.tzinfo is None:
-            date = pytz.utc.localize(date)
+# number of date strings a DateParser remembers
+DEFAULT_MAX_MEMO = 100000
 
-        return date
-    except TypeError:
-        print "Date parsing error on: "
-        print ds
 
-        return None
-    except ValueError:
-        print "Date parsing error on: "
-        print ds
+class DateParser(object):
+    """
+    Parses the values of Date headers to UTC seconds since the epoch.
 
-        return None
+    Most archives use a handful of RFC 2822 variants, which are parsed
+    by email.utils.parsedate_tz. Only strings it can't handle go to the
+    slower dateutil parser. Results are memoized by raw string, so one
+    parser should be used for all the messages of a list. The memo is
+    cleared whenever it holds *max_memo* strings, to bound its memory
+    over long-running collections.
+
+    *counts* records how often each path is taken.
+    """
+
+    def __init__(self, max_memo=DEFAULT_MAX_MEMO):
+        self.memo = {}
+        self.max_memo = max_memo
+        self.counts = collections.Counter()
+
+    def epoch(self, ds):
+        """
+        Returns the date string *ds* as UTC seconds since the epoch,
+        or None if it can't be parsed.
+        """
+        if ds is None:
+            return None
+
+        try:
+            result = self.memo[ds]
+            self.counts['memo'] += 1
+            return result
+        except KeyError:
+            pass
+
+        result = self._parse_rfc2822(ds)
+        if result is not None:
+            self.counts['rfc2822'] += 1
+        else:
+            result = self._parse_dateutil(ds)
+            self.counts['dateutil' if result is not None else 'failed'] += 1
+
+        if len(self.memo) >= self.max_memo:
+            self.memo.clear()
+        self.memo[ds] = result
+        return result
+
+    def _parse_rfc2822(self, ds):
+        parsed = email.utils.parsedate_tz(ds)
+        # leave strings with a missing or unrecognized timezone to dateutil
+        if parsed is None or parsed[9] is None:
+            return None
+        try:
+            # validates the fields
+            date = datetime.datetime(*parsed[:6])
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+        return calendar.timegm(date.timetuple()) - parsed[9]
+
+    def _parse_dateutil(self, ds):
+        try:
+            # some mail clients add a parenthetical timezone
+            ds = unicode(ds, 'utf-8', 'ignore')
+            ds = re.sub("\(.*$", "", ds)
+            ds = re.sub("--", "-", ds)
+            ds = re.sub(" Hora.*$", "", ds)
+
+            date = dp.parse(ds)
+
+            # this adds noise and could raise trouble
+            if date.tzinfo is None:
+                date = pytz.utc.localize(date)
+
+            return calendar.timegm(date.utctimetuple())
+        except (TypeError, ValueError, OverflowError):
+            print "Date parsing error on: "
+            print ds
+
+            return None
+
+    def epochs(self, date_strings):
+        """
+        Returns an int64 array of the UTC epoch seconds of an iterable of
+        date strings, with MISSING_EPOCH for those that can't be parsed.
+        """
+        epochs = [self.epoch(ds) for ds in date_strings]
+        return np.array([MISSING_EPOCH if e is None else e for e in epochs],
+                        dtype=np.int64)
+
+    def parse(self, ds):
+        """
+        Returns the date string *ds* as a UTC datetime, or None.
+        """
+        epoch = self.epoch(ds)
+        if epoch is None:
+            return None
+        return datetime.datetime.fromtimestamp(epoch, pytz.utc)
+
+
+def epochs_to_datetimes(epochs):
+    """
+    Converts an array of UTC epoch seconds, as produced by
+    DateParser.epochs, to a DatetimeIndex of UTC timestamps, with NaT for
+    missing dates and those outside the range pandas can represent.
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    valid = (epochs >= MIN_EPOCH) & (epochs <= MAX_EPOCH)
+    nanoseconds = np.where(valid, epochs * 10 ** 9, MISSING_EPOCH)
+    return pd.to_datetime(nanoseconds, utc=True)
+
+
+def get_date(message, parser=None):
+    """
+    Returns the date of a message as a UTC datetime, or None if its
+    Date header can't be parsed. *parser* is a DateParser.
+    """
+    parser = parser or DateParser()
+    return parser.parse(message.get('Date'))
@@ -1,9 +1,9 @@
 from bigbang.parse import get_date
 import pandas as pd
 import datetime
-import networkx as nx
 import numpy as np
 import email.utils
+import logging
 import re
 
 import Levenshtein
@@ -68,75 +68,183 @@ def sorted_matrix(from_dataframe,limit=None,sort_key=None):
 
     return new_df
 
-def resolve_sender_entities(act, lexical_distance=0):
+# blocks of more senders than this, like the n-gram 'com', are too
+# common to tell senders apart, and are not compared
+DEFAULT_MAX_BLOCK = 100
+
+NGRAM_SIZE = 3
+
+
+class UnionFind(object):
+    """
+    Disjoint sets of the integers 0 to n - 1, merged by union(), with
+    path halving and union by size.
+    """
+
+    def __init__(self, n):
+        self.parent = range(n)
+        self.size = [1] * n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return False
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        return True
+
+    def components(self):
+        """
+        Returns the sets as lists, each in increasing order.
+        """
+        components = {}
+        for i in range(len(self.parent)):
+            components.setdefault(self.find(i), []).append(i)
+        return components.values()
+
+
+def sender_keys(sender, fuzzy=False):
+    """
+    Returns the blocking keys of the 'From' header *sender*, as two
+    lists of (kind, value) pairs.
+
+    The exact keys are only shared by headers at distance 0 by
+    from_header_distance: the same address, the same name of more
+    than 5 characters, or the same unparsed header. If *fuzzy* is
+    True, the second list has keys shared by headers likely to be
+    close: the local part of the address, the words of the name and
+    the character n-grams of the address.
+    """
+    normal = normalize_from_header(sender)
+    match = re.match(ren, normal)
+
+    if match is None:
+        exact = [('raw', normal)]
+        address, local, words = normal, None, re.findall('\w+', normal)
+    else:
+        address, at, name = match.groups()
+        exact = [('address', address)]
+        if len(name) > 5:
+            exact.append(('name', name))
+        local, words = address.split('@')[0], re.findall('\w+', name)
+
+    if not fuzzy:
+        return exact, []
+
+    keys = set(('word', word) for word in words if len(word) > 1)
+    if local:
+        keys.add(('local', local))
+    keys.update(('gram', address[i:i + NGRAM_SIZE])
+                for i in range(len(address) - NGRAM_SIZE + 1))
+    return exact, list(keys)
+
+
+def resolve_sender_entities(act, lexical_distance=0, max_block=DEFAULT_MAX_BLOCK):
     """
     Given an Archive's activity matrix, return a dict of lists, each containing
     message senders ('From' fields) that have been groups to be
     probably the same entity.
+
+    Senders are the same entity when connected by pairs within
+    *lexical_distance* by from_header_distance. Only senders that share
+    a blocking key (see sender_keys) are compared, and blocks of more
+    than *max_block* senders are skipped, so memory and time grow with
+    the number of candidate pairs rather than the square of the number
+    of senders.
     """
-    
-    # senders orders by descending total activity
-    senders = act.sum(0).sort_values(ascending=False)
-    senders_act = senders.index
+    totals = act.sum(0)
+    totals = dict(zip(totals.index, totals.values))
 
     # senders in lexical order
     senders_lex = act.columns.sort_values()
-    senders_lex_dict = dict([(p[1],p[0]) for p in enumerate(senders_lex)])
-
-    n = len(senders)
-    # binary matrix of similarity between entries
-    sim = np.zeros((n,n))
-
-    # find similarity 
-    for i in range(n):
-        name = senders_act[i]
-        i = senders_lex_dict[name]
-    
-        # checking only lexically close entries and
-        # in proportion to total activity
-        # is a performance hack.
-        for j in range(i - (n - i + 1) / 2, i + (n - i + 1) / 2):
-            d = from_header_distance(senders_lex[i],senders_lex[j])
-            sim[i,j] = (d <= lexical_distance)
-
-    # An entity is a connected component of the resulting graph
-    G = nx.Graph(sim)
-    entities_list = [[senders_lex[j] for j in x] for x in nx.connected_components(G)]
-
-    # given each entity a label based on its most active 'member'
+    fuzzy = lexical_distance > 0
+
+    exact_blocks = {}
+    fuzzy_blocks = {}
+    for i, sender in enumerate(senders_lex):
+        exact, candidates = sender_keys(sender, fuzzy)
+        for key in exact:
+            exact_blocks.setdefault(key, []).append(i)
+        for key in candidates:
+            fuzzy_blocks.setdefault(key, []).append(i)
+
+    components = UnionFind(len(senders_lex))
+
+    # senders sharing an exact key are all at distance 0
+    for block in exact_blocks.values():
+        for i in block[1:]:
+            components.union(block[0], i)
+
+    # the similar pairs among candidates from the blocks, as an edge list
+    checked = set()
+    edges = []
+    for block in fuzzy_blocks.values():
+        if len(block) > max_block:
+            continue
+        for x in range(len(block)):
+            for y in range(x + 1, len(block)):
+                pair = (block[x], block[y])
+                if pair in checked:
+                    continue
+                checked.add(pair)
+                if components.find(pair[0]) == components.find(pair[1]):
+                    continue
+                a, b = senders_lex[pair[0]], senders_lex[pair[1]]
+                # the distance is not symmetric, and either way will do
+                if min(from_header_distance(a, b),
+                       from_header_distance(b, a)) <= lexical_distance:
+                    edges.append(pair)
+                    components.union(*pair)
+
+    logging.debug('Entity resolution: %d senders, %d candidate pairs, %d edges',
+                  len(senders_lex), len(checked), len(edges))
+
+    # An entity is a connected component of the similarity edges
     entities_dict = {}
-    for e in entities_list:
+    for component in components.components():
+        e = [senders_lex[j] for j in component]
+        # given each entity a label based on its most active 'member'
         # TODO: tighten up this labeling function
-        label = sorted(e,key=lambda n:senders[n],reverse=True)[0]
+        label = sorted(e, key=lambda n: totals[n], reverse=True)[0]
         entities_dict[label] = e
 
     return entities_dict
 
 
-ren = "([\w\+\.\-]+(\@| at )[\w+\.\-]*) \((.*)\)"
-def from_header_distance(a, b,verbose=False):
+def normalize_from_header(value):
     """
-    A distance measure specifically for the 'From' header of emails.
-    Normalizes based on common differences in client handling of email,
-    then computes Levenshtein distance between components of the field.
+    Returns the 'From' header *value* in lower case, without quotes
+    and angle brackets, and with ' at ' replaced by '@'.
     """
     # this translate table is one way you are supposed to
     # delete characters from a unicode string
     stop_characters = unicode('"<>')
     stop_characters_map = dict((ord(char), None) for char in stop_characters)
 
-    a_normal = ""
-    b_normal = ""
-
     try:
-        a_normal = unicode(a).lower().translate(stop_characters_map).replace(' at ','@')
+        return unicode(value).lower().translate(stop_characters_map).replace(' at ','@')
     except UnicodeDecodeError as e:
-        a_normal = a.decode("utf-8").lower().translate(stop_characters_map).replace(' at ','@')
+        return value.decode("utf-8").lower().translate(stop_characters_map).replace(' at ','@')
 
-    try:
-        b_normal = unicode(b).lower().translate(stop_characters_map).replace(' at ','@')
-    except UnicodeDecodeError as e:
-        b_normal = b.decode("utf-8").lower().translate(stop_characters_map).replace(' at ','@')
+
+ren = "([\w\+\.\-]+(\@| at )[\w+\.\-]*) \((.*)\)"
+def from_header_distance(a, b,verbose=False):
+    """
+    A distance measure specifically for the 'From' header of emails.
+    Normalizes based on common differences in client handling of email,
+    then computes Levenshtein distance between components of the field.
+    """
+    a_normal = normalize_from_header(a)
+    b_normal = normalize_from_header(b)
 
     ag = re.match(ren,a_normal)
     bg = re.match(ren,b_normal)
@@ -0,0 +1,167 @@
+"""
+Reply edges and response times.
+
+Each message that replies to another message of the archive, as
+threaded by a thread.ThreadIndex, makes an edge from the message
+replied to (the parent) to the reply. reply_edges() makes a table of
+these edges with their senders and latencies, and the other functions
+compute response-time statistics on it with array operations, without
+looping over messages, senders or threads.
+"""
+from bigbang.compact import NO_CODE
+import numpy as np
+import pandas as pd
+
+EDGE_COLUMNS = ['message', 'parent', 'thread', 'sender', 'parent_sender', 'date', 'latency']
+
+DEFAULT_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+def quantile_label(q):
+    return '%g%%' % (q * 100)
+
+
+def reply_edges(thread_index):
+    """
+    Returns a dataframe of the reply edges of the archive threaded by
+    *thread_index*, one row per reply, with columns:
+
+    message, parent -- the Message-IDs of the reply and of its parent
+    thread -- the number of their thread in thread_index
+    sender, parent_sender -- their senders, as Categoricals with the
+        same categories
+    date -- the date of the reply
+    latency -- the time from the parent to the reply, which is negative
+        when the reply is dated before its parent
+    """
+    compacted = thread_index.compacted
+    message_ids = thread_index.data.index.values
+    senders = compacted.senders
+
+    replies = np.flatnonzero(thread_index.parents != NO_CODE)
+    parents = thread_index.parents[replies]
+
+    edges = pd.DataFrame({'message': message_ids[replies],
+                          'parent': message_ids[parents],
+                          'thread': thread_index.thread_ids[replies]})
+    edges['sender'] = pd.Categorical.from_codes(senders.codes[replies], senders.categories)
+    edges['parent_sender'] = pd.Categorical.from_codes(senders.codes[parents], senders.categories)
+    edges['date'] = pd.to_datetime(compacted.dates[replies], unit='s', utc=True)
+    edges['latency'] = pd.to_timedelta(compacted.dates[replies] - compacted.dates[parents],
+                                       unit='s')
+    return edges[EDGE_COLUMNS]
+
+
+def latency_seconds(edges):
+    return edges['latency'].values.astype('int64') / 1e9
+
+
+def grouped_quantiles(codes, values, quantiles, n_groups):
+    """
+    Returns an n_groups x len(quantiles) array of the *quantiles* of
+    the *values* in each group, where *codes* gives the group of each
+    value, interpolated linearly as by numpy.percentile. Groups without
+    values get NaN.
+    """
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    result = np.full((n_groups, len(quantiles)), np.nan)
+    present = counts > 0
+    starts, counts = starts[present], counts[present]
+    for j, q in enumerate(quantiles):
+        position = starts + q * (counts - 1)
+        lower = np.floor(position).astype('int64')
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        result[present, j] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return result
+
+
+def response_times(edges, by='sender', quantiles=DEFAULT_QUANTILES):
+    """
+    Returns a dataframe of the distribution of reply latencies for each
+    sender with replies: their count, mean and *quantiles*.
+
+    With *by* 'sender' (the default), these are the latencies of each
+    sender's replies, i.e. how quickly they respond; with
+    'parent_sender', those of the replies each sender receives.
+    """
+    categories = edges[by].cat.categories
+    codes = edges[by].cat.codes.values
+    seconds = latency_seconds(edges)
+    known = codes != NO_CODE
+    codes, seconds = codes[known], seconds[known]
+
+    counts = np.bincount(codes, minlength=len(categories))
+    totals = np.bincount(codes, weights=seconds, minlength=len(categories))
+    present = counts > 0
+
+    times = pd.DataFrame({'count': counts[present]},
+                         index=pd.Index(categories[present], name=by))
+    times['mean'] = pd.to_timedelta(totals[present] / counts[present], unit='s')
+    values = grouped_quantiles(codes, seconds, quantiles, len(categories))[present]
+    for j, q in enumerate(quantiles):
+        times[quantile_label(q)] = pd.to_timedelta(values[:, j], unit='s')
+    return times
+
+
+def rolling_quantiles(edges, window='30D', quantiles=(0.5, 0.9), freq='D'):
+    """
+    Returns a time series of the *quantiles* of the latencies of the
+    replies dated within a sliding *window* (a pandas offset), one row
+    per period of frequency *freq*.
+
+    The value for a period is that of the window ending at the last
+    reply in the period; periods without replies are NaT.
+    """
+    seconds = pd.Series(latency_seconds(edges), index=pd.DatetimeIndex(edges['date']))
+    seconds = seconds.sort_index()
+
+    series = pd.DataFrame(index=seconds.resample(freq).last().index)
+    for q in quantiles:
+        rolling = seconds.rolling(window).quantile(q)
+        series[quantile_label(q)] = pd.to_timedelta(rolling.resample(freq).last(), unit='s')
+    return series
+
+
+def first_responses(thread_index, others_only=True):
+    """
+    Returns a dataframe, with a row per thread of *thread_index*, of the
+    first reply to a root message of the thread: its Message-ID
+    ('first_reply'), sender ('responder') and latency
+    ('first_response_time'), or None and NaT if there is none.
+
+    If *others_only* is True, replies from the sender of the message
+    they reply to are not counted.
+    """
+    compacted = thread_index.compacted
+    parents = thread_index.parents
+    senders = compacted.senders.codes
+
+    replies = np.flatnonzero((parents != NO_CODE) & (parents == thread_index.roots))
+    if others_only:
+        replies = replies[senders[replies] != senders[parents[replies]]]
+    latencies = compacted.dates[replies] - compacted.dates[parents[replies]]
+    threads = thread_index.thread_ids[replies]
+
+    # the fastest reply of each thread comes first in this order
+    order = np.lexsort((latencies, threads))
+    answered, first = np.unique(threads[order], return_index=True)
+    first_replies = replies[order][first]
+
+    n_threads = len(thread_index)
+    reply_ids = np.full(n_threads, None, dtype=object)
+    reply_ids[answered] = thread_index.data.index.values[first_replies]
+    responder_codes = np.full(n_threads, NO_CODE, dtype='int64')
+    responder_codes[answered] = senders[first_replies]
+    seconds = np.full(n_threads, np.nan)
+    seconds[answered] = latencies[order][first]
+
+    responses = pd.DataFrame({'first_reply': reply_ids},
+                             index=pd.Index(np.arange(n_threads), name='Thread'))
+    responses['responder'] = pd.Categorical.from_codes(responder_codes,
+                                                       compacted.senders.categories)
+    responses['first_response_time'] = pd.to_timedelta(seconds, unit='s')
+    return responses
@@ -0,0 +1,239 @@
+"""
+Reading and writing archive dataframes in CSV or columnar formats.
+
+Columnar formats (Parquet, Feather) keep the Message-ID index, the
+timezone-aware Date column and the other column dtypes, so data read
+from them needs no type inference and null values stay None. They can
+also read a subset of columns, for example skipping Body.
+
+The format of a file is given by its extension: .parquet, .feather or
+.csv (the default).
+
+An archive can also be stored as a directory of monthly Parquet
+partitions (see write_partitions), so that a range of months can be
+read without reading the rest.
+"""
+import datetime
+import os
+
+import pandas as pd
+
+FORMAT_EXTENSIONS = {
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'csv': '.csv',
+}
+
+INDEX_NAME = 'Message-ID'
+
+PARTITION_FORMAT = '%Y-%m'
+
+
+class UnknownFormatException(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def storage_format(path, fmt=None):
+    """
+    Returns the storage format for *path*: *fmt* if given, otherwise
+    the format named by the file extension, defaulting to 'csv'.
+    """
+    if fmt is not None:
+        if fmt not in FORMAT_EXTENSIONS:
+            raise UnknownFormatException(fmt)
+        return fmt
+
+    for name, extension in FORMAT_EXTENSIONS.items():
+        if path.endswith(extension):
+            return name
+    return 'csv'
+
+
+def normalize_dates(frame):
+    """
+    Converts the Date column of a message dataframe to UTC timestamps,
+    which unlike the mixed-offset datetimes produced by parsing can be
+    stored in a columnar file. Modifies *frame* in place and returns it.
+    """
+    frame['Date'] = pd.to_datetime(frame['Date'], errors='coerce', utc=True)
+    return frame
+
+
+def write_archive_data(data, path, fmt=None, encoding='utf-8'):
+    """
+    Writes the message dataframe *data* to *path*.
+    """
+    fmt = storage_format(path, fmt)
+
+    if fmt == 'csv':
+        data.to_csv(path, ",", encoding=encoding)
+        return
+
+    data = data.copy()
+    if INDEX_NAME in data.columns:
+        data.set_index(INDEX_NAME, inplace=True)
+    if 'Date' in data.columns and not is_utc_datetime(data['Date']):
+        normalize_dates(data)
+
+    if fmt == 'parquet':
+        data.to_parquet(path)
+    elif fmt == 'feather':
+        # feather files have no index
+        data.reset_index().to_feather(path)
+
+
+def archive_schema():
+    """
+    Returns the pyarrow schema of a message dataframe, with the
+    Message-ID index as the last field.
+    """
+    import pyarrow as pa
+
+    return pa.schema([('From', pa.string()),
+                      ('Subject', pa.string()),
+                      ('Date', pa.timestamp('ns', tz='UTC')),
+                      ('In-Reply-To', pa.string()),
+                      ('References', pa.string()),
+                      ('Body', pa.string()),
+                      (INDEX_NAME, pa.string())])
+
+
+def write_archive_chunks(frames, path, fmt=None, encoding='utf-8'):
+    """
+    Writes a sequence of message dataframes, such as those produced by
+    mailman.iter_message_dataframes, to a single file at *path*. Each
+    dataframe is written as soon as it is produced, so memory use is
+    bounded by the size of one chunk.
+
+    Supports the 'parquet' and 'csv' formats. Returns the number of
+    messages written.
+    """
+    fmt = storage_format(path, fmt)
+    if fmt not in ['parquet', 'csv']:
+        raise UnknownFormatException(fmt)
+
+    count = 0
+    writer = None
+    try:
+        for i, frame in enumerate(frames):
+            if fmt == 'csv':
+                frame.to_csv(path, ",", encoding=encoding,
+                             mode='w' if i == 0 else 'a', header=(i == 0))
+            else:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                normalize_dates(frame)
+                table = pa.Table.from_pandas(frame, schema=archive_schema(),
+                                             preserve_index=True)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            count += len(frame)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return count
+
+
+def read_archive_data(path, fmt=None, columns=None):
+    """
+    Reads a message dataframe from *path*.
+
+    If *columns* is given, only those columns (and the Message-ID) are read.
+    """
+    fmt = storage_format(path, fmt)
+
+    if fmt == 'csv':
+        if columns is not None:
+            columns = [INDEX_NAME] + [c for c in columns if c != INDEX_NAME]
+        return pd.read_csv(path, usecols=columns)
+
+    if columns is not None:
+        columns = [c for c in columns if c != INDEX_NAME]
+
+    if fmt == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    elif fmt == 'feather':
+        if columns is not None:
+            columns = [INDEX_NAME] + columns
+        return pd.read_feather(path, columns=columns).set_index(INDEX_NAME)
+
+
+def find_archive_data(archive_dir, name):
+    """
+    Returns the path of stored data for list *name* in *archive_dir*,
+    preferring columnar formats over CSV, or None if there is none.
+    """
+    for fmt in ['parquet', 'feather', 'csv']:
+        path = os.path.join(archive_dir, name + FORMAT_EXTENSIONS[fmt])
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_utc_datetime(series):
+    """
+    True if *series* already holds UTC timestamps.
+    """
+    return str(series.dtype) == 'datetime64[ns, UTC]'
+
+
+def write_partitions(data, directory):
+    """
+    Writes the message dataframe *data* to *directory* as one Parquet
+    file per month of the messages' (UTC) dates, named YYYY-MM.parquet.
+    Partitions already in *directory* are replaced.
+
+    Messages without a date are not written. Returns the paths written.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for month, path in list_partitions(directory):
+        os.remove(path)
+
+    data = data.copy()
+    if INDEX_NAME in data.columns:
+        data.set_index(INDEX_NAME, inplace=True)
+    if not is_utc_datetime(data['Date']):
+        normalize_dates(data)
+
+    paths = []
+    for month, frame in data.groupby(data['Date'].dt.strftime(PARTITION_FORMAT)):
+        path = os.path.join(directory, month + FORMAT_EXTENSIONS['parquet'])
+        frame.to_parquet(path)
+        paths.append(path)
+    return paths
+
+
+def partition_month(path):
+    """
+    Returns the month (as a datetime.datetime) of the partition file at
+    *path*, or None if it is not a partition file.
+    """
+    name, extension = os.path.splitext(os.path.basename(path))
+    if extension != FORMAT_EXTENSIONS['parquet']:
+        return None
+    try:
+        return datetime.datetime.strptime(name, PARTITION_FORMAT)
+    except ValueError:
+        return None
+
+
+def list_partitions(directory):
+    """
+    Returns a list of (month, path) pairs for the monthly partitions in
+    *directory*, in month order.
+    """
+    partitions = []
+    for fn in os.listdir(directory):
+        month = partition_month(fn)
+        if month is not None:
+            partitions.append((month, os.path.join(directory, fn)))
+    return sorted(partitions)
@@ -0,0 +1,261 @@
+"""
+A local stand-in for mailing list archive servers, for testing and
+benchmarking the collectors without the internet.
+
+FixtureServer serves synthetic archives for each of its lists:
+
+    /pipermail/LIST/                     pipermail index of YYYY-Month.txt.gz files
+    /mail-archive/text/LIST/             IETF directory of YYYY-MM.mail files
+    /lists.w3.org/Archives/Public/LIST/  W3C index, month and message pages
+
+Responses carry an ETag and honour If-None-Match and Range requests,
+like the real servers. Every response can be delayed by *latency*
+seconds, and a fraction *error_rate* of requests for archive files and
+message pages fail with a 500 error. If *truncate* is set, archive
+files are cut off after a tenth of the declared Content-Length and the
+connection is closed. If *compress* is set, plain text archive files are
+gzipped on the fly, whatever the request's Accept-Encoding.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from email.mime.text import MIMEText
+import calendar
+import cgi
+import email.utils
+import gzip
+import hashlib
+import random
+import StringIO
+import threading
+import time
+
+MONTH_ABBRS = [calendar.month_abbr[m] for m in range(13)]
+
+def synthetic_message(list_name, year, month, n, body_size=1000):
+    """
+    Returns the n-th synthetic message of a month as an email Message.
+    Every message after the first of its month replies to the previous one.
+    """
+    msg = MIMEText(('Message %d of %s in %d-%02d. ' % (n, list_name, year, month)) *
+                   max(1, body_size / 40))
+    msg['From'] = 'Person %d <person%d@example.org>' % (n % 7, n % 7)
+    msg['To'] = '%s@example.org' % list_name
+    msg['Subject'] = 'Topic %d' % (n / 5)
+    msg['Date'] = email.utils.formatdate(
+        calendar.timegm((year, month, 1 + n % 28, n % 24, 0, 0)))
+    msg['Message-ID'] = message_id(list_name, year, month, n)
+    if n > 0:
+        msg['In-Reply-To'] = message_id(list_name, year, month, n - 1)
+    return msg
+
+def message_id(list_name, year, month, n):
+    return '<%d.%d.%d@%s.example.org>' % (year, month, n, list_name)
+
+def mbox_text(messages):
+    return ''.join(['From %s %s\n%s\n\n' % (email.utils.parseaddr(msg['From'])[1],
+                                           time.asctime(email.utils.parsedate(msg['Date'])),
+                                           msg.as_string())
+                    for msg in messages])
+
+def gzipped(text):
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    f.write(text)
+    f.close()
+    return buf.getvalue()
+
+def links_page(hrefs):
+    return '<html><body><table><tbody>\n%s</tbody></table></body></html>\n' % ''.join(
+        ['<tr><td><a href="%s">%s</a></td></tr>\n' % (href, href) for href in hrefs])
+
+def w3c_message_page(msg):
+    return ('<html><body>\n<h1>%s</h1>\n'
+            '<!-- inreplyto="%s" -->\n'
+            '<address class="headers">\n'
+            '<span id="from"><dfn>From</dfn>: %s &lt;<a href="mailto:%s">%s</a>&gt;</span><br />\n'
+            '<span id="date"><dfn>Date</dfn>: %s</span><br />\n'
+            '<span id="to"><dfn>To</dfn>: %s</span><br />\n'
+            '<span id="message-id"><dfn>Message-ID</dfn>: %s</span>\n'
+            '</address>\n<pre id="body">\n%s</pre>\n</body></html>\n') % (
+                cgi.escape(msg['Subject']),
+                (msg['In-Reply-To'] or '').strip('<>'),
+                cgi.escape(email.utils.parseaddr(msg['From'])[0]),
+                email.utils.parseaddr(msg['From'])[1],
+                email.utils.parseaddr(msg['From'])[1],
+                msg['Date'],
+                cgi.escape(msg['To']),
+                cgi.escape(msg['Message-ID']),
+                cgi.escape(msg.get_payload()))
+
+def w3c_month_page(year, month, hrefs):
+    last_day = calendar.monthrange(year, month)[1]
+    return ('<html><body>\n<p><span><a id="end"></a>Last message date</span>: '
+            '<em>%d %s %d 23:59:59 UTC</em></p>\n'
+            '<div class="messages-list"><ul>\n%s</ul></div>\n</body></html>\n') % (
+                last_day, calendar.month_name[month], year,
+                ''.join(['<li><a href="%s">%s</a></li>\n' % (href, href) for href in hrefs]))
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server of synthetic archives for *lists* (list names),
+    each with *months* months of *messages* messages.
+
+    Use start() and stop(), or the server as a context manager. url()
+    gives the archive URL of a list in a given style ('pipermail',
+    'ietf' or 'w3c').
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, lists=('test-list',), months=3, messages=20,
+                 body_size=1000, latency=0, error_rate=0, seed=0, port=0,
+                 truncate=False, compress=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FixtureRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.truncate = truncate
+        self.compress = compress
+        self.random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        # path -> (content, content type, whether it is an archive file)
+        self.resources = {}
+        for list_name in lists:
+            self._add_list(list_name, months, messages, body_size)
+
+    def _add_list(self, list_name, months, messages, body_size):
+        pipermail = '/pipermail/%s/' % list_name
+        ietf = '/mail-archive/text/%s/' % list_name
+        w3c = '/lists.w3.org/Archives/Public/%s/' % list_name
+
+        gz_names, mail_names, w3c_months = [], [], []
+        for i in range(months):
+            year, month = 2001 + i / 12, 1 + i % 12
+            msgs = [synthetic_message(list_name, year, month, n, body_size)
+                    for n in range(messages)]
+            text = mbox_text(msgs)
+
+            gz_name = '%d-%s.txt.gz' % (year, calendar.month_name[month])
+            self.resources[pipermail + gz_name] = (gzipped(text), 'application/x-gzip', True)
+            gz_names.append(gz_name)
+
+            mail_name = '%d-%02d.mail' % (year, month)
+            self.resources[ietf + mail_name] = (text, 'text/plain', True)
+            mail_names.append(mail_name)
+
+            month_dir = '%d%s/' % (year, MONTH_ABBRS[month])
+            hrefs = []
+            for n, msg in enumerate(msgs):
+                href = '%04d.html' % n
+                self.resources[w3c + month_dir + href] = (w3c_message_page(msg), 'text/html', True)
+                hrefs.append(href)
+            self.resources[w3c + month_dir] = (w3c_month_page(year, month, hrefs), 'text/html', False)
+            w3c_months.append(month_dir)
+
+        self.resources[pipermail] = (links_page(gz_names), 'text/html', False)
+        self.resources[ietf] = (links_page(mail_names), 'text/html', False)
+        self.resources[w3c] = (links_page(w3c_months), 'text/html', False)
+
+    def url(self, list_name, style='pipermail'):
+        prefix = {'pipermail': '/pipermail/',
+                  'ietf': '/mail-archive/text/',
+                  'w3c': '/lists.w3.org/Archives/Public/'}[style]
+        return 'http://127.0.0.1:%d%s%s/' % (self.server_address[1], prefix, list_name)
+
+    def reset_stats(self):
+        """
+        Resets the counts of requests, archive files served, errors
+        injected and bytes sent.
+        """
+        with self._lock:
+            self.stats = {'requests': 0, 'files': 0, 'not_modified': 0,
+                          'errors': 0, 'bytes': 0}
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def inject_error(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency)
+
+        resource = server.resources.get(self.path.split('?')[0])
+        if resource is None:
+            return self._respond(404, '')
+        content, content_type, is_file = resource
+
+        if is_file and server.inject_error():
+            server.count('errors')
+            return self._respond(500, '')
+
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            server.count('not_modified')
+            return self._respond(304, '', {'ETag': etag})
+
+        status, headers = 200, {'ETag': etag, 'Content-Type': content_type}
+        if is_file and server.compress and content_type == 'text/plain':
+            headers['Content-Encoding'] = 'gzip'
+            content = gzipped(content)
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') in (None, etag):
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(content):
+                return self._respond(416, '')
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, len(content) - 1, len(content))
+            status, content = 206, content[start:]
+
+        if is_file:
+            server.count('files')
+        if is_file and server.truncate:
+            return self._respond(status, content, headers, send=len(content) / 10)
+        server.count('bytes', len(content))
+        self._respond(status, content, headers)
+
+    def _respond(self, status, content, headers=None, send=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if send is None:
+            self.wfile.write(content)
+        else:
+            # a dropped connection, part way through the body
+            self.server.count('bytes', send)
+            self.wfile.write(content[:send])
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
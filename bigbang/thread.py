@@ -1,6 +1,12 @@
+from bigbang.compact import CompactArchive
+from bigbang.compact import NO_CODE
 from bigbang.utils import clean_message
+import numpy as np
+import pandas as pd
 
-class Thread:
+class Thread(object):
+
+    __slots__ = ('root', 'known_root')
 
     def __init__(self, root, known_root=True):
         """Form a thread object. root: the node of the message that start the thread
@@ -13,66 +19,91 @@ class Thread:
         """Return the root node."""
         return self.root
 
+    def _first(self):
+        """Return the node of the first message in our data set"""
+        if(self.known_root):
+            return self.root
+        else:
+            return self.root.get_successors()[0]
+
     def get_num_messages(self):
         """Return the number of messages in the thread"""
+        num_nodes = self._first().summary()['num_nodes']
         if(self.known_root):
-            return self.root.properties()[0]
+            return num_nodes
         else:
-            return 1 + self.root.get_successors()[0].properties()[0]
+            return 1 + num_nodes
 
     def get_num_people(self):
         """Return the number of people in the thread"""
-        if(self.known_root):
-            return len(self.root.properties()[1])
-        else:
-            return len(self.root.get_successors()[0].properties()[1])
+        return len(self._first().summary()['senders'])
 
     def get_duration(self):
         """Return the time duration of the thread"""
-        if(self.known_root):
-            r = self.root
-        else:
-            r = self.root.get_successors()[0]
-        l = r.properties()[2]
-        l_time = sorted([i.data["Date"] for i in l])
-        return l_time[len(l) - 1] - r.data["Date"]
+        r = self._first()
+        return max(i.data["Date"] for i in r.summary()['leaves']) - r.data["Date"]
 
     def get_leaves(self):
-        if(self.known_root):
-            r = self.root
-        else:
-            r = self.root.get_successors()[0]
-        return r.properties()[2]
+        return self._first().summary()['leaves']
 
     def get_not_leaves(self):
-        if(self.known_root):
-            r = self.root
-        else:
-            r = self.root.get_successors()[0]
-        return r.properties()[4]
-            
+        return self._first().summary()['not_leaves']
+
     def get_content(self):
-        if(self.known_root):
-            r = self.root
-        else:
-            r = self.root.get_successors()[0]
-        return r.properties()[3]
+        """Return the cleaned bodies of the messages. They are not kept,
+        so this reads and cleans them on every call."""
+        return list(self._first().iter_content())
+
+
+class MessageFields(dict):
+    """
+    The fields of a message, as a dict that does not hold its Body.
+    Looking up 'Body' reads the body through *index* (an object with a
+    get_body(message_id) method, such as a ThreadIndex) every time, so
+    that thread Nodes don't keep the bodies of their messages in memory.
+    """
+
+    __slots__ = ('message_id', 'index')
+
+    def __init__(self, fields, message_id, index):
+        dict.__init__(self, fields)
+        self.message_id = message_id
+        self.index = index
 
+    def __missing__(self, key):
+        if key == 'Body':
+            return self.index.get_body(self.message_id)
+        raise KeyError(key)
 
-class Node:
+    def __contains__(self, key):
+        return key == 'Body' or dict.__contains__(self, key)
 
-    def __init__(self, ID, data=None, parent=None):
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class Node(object):
+
+    __slots__ = ('id', 'parent', 'successors', 'data', 'index', '_summary')
+
+    def __init__(self, ID, data=None, parent=None, index=None):
         """
         Form a Node object.
         ID: Message ID, data: Information about that message, parent: the
-        message's reply-to
+        message's reply-to, index: an object with a get_body(message_id)
+        method, such as a ThreadIndex or an index of the raw archive
+        files (see bigbang.mbox_index), to read the message body from,
+        if data has none
         """
         self.id = ID
         self.parent = parent
         self.successors = list()
         self.data = data
-        self.processed = False
-        self.prop = dict()
+        self.index = index
+        self._summary = None
 
     def add_successor(self, successor):
         """Add a node which has a message that is a reply to this node"""
@@ -87,40 +118,296 @@ class Node:
         return self.successors
 
     def get_data(self):
-        """Return the Information about this message"""
-        return self.data
+        """Return the Information about this message as a dict, with its
+        body read from the index if the data does not include it"""
+        if self.data is None:
+            return None
+        data = dict(self.data)
+        data['Body'] = self.get_body()
+        return data
+
+    def get_body(self):
+        """Return the body of this message"""
+        if self.data is not None:
+            body = self.data.get('Body')
+            if body is not None:
+                return body
+        if self.index is not None:
+            return self.index.get_body(self.id)
+        return None
 
     def get_parent(self):
         """Return Information in the data set about this message"""
         return self.parent
 
-    def properties(self):
-        """Return various properties about the tree with this node as root."""
+    def walk(self):
+        """Yield the nodes of the tree with this node as root, depth
+        first, using a stack rather than recursion so that long reply
+        chains do not reach the recursion limit"""
         visited = set()
-        seen_email = set()
-        leaves = []
-        not_leaves = []
-        content = []
-        def explore(node):
-            num = 1
-            duration = 0
-            seen_email.add(node.data['From'])
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node in visited:
+                continue
             visited.add(node)
-            content.append(clean_message(node.data['Body']))
-            if(len(node.get_successors()) == 0):
-                leaves.append(node)
-            else: not_leaves.append(node)
-            for s in node.get_successors():
-                if(s not in visited):
-                    seen_email.add(s.data['From'])
-                    num += explore(s)
-            return num
-        if(not self.processed):
-            num_nodes = explore(self)
-            self.prop['num_nodes'] = num_nodes
-            self.prop['email_adrress'] = seen_email
-            self.prop['leaves'] = leaves
-            self.prop['content'] = content
-            self.prop['not_leaves'] = not_leaves
-            self.processed =  True
-        return [self.prop['num_nodes'], self.prop['email_adrress'], self.prop['leaves'], self.prop['content'], self.prop['not_leaves']]
+            yield node
+            stack.extend(reversed(node.successors))
+
+    def summary(self):
+        """Return a dict of the number of nodes ('num_nodes'), senders,
+        leaves and not_leaves of the tree with this node as root.
+        It is computed once, without reading any message body."""
+        if self._summary is None:
+            senders = set()
+            leaves = []
+            not_leaves = []
+            for node in self.walk():
+                senders.add(node.data['From'])
+                if(len(node.successors) == 0):
+                    leaves.append(node)
+                else: not_leaves.append(node)
+            self._summary = {'num_nodes': len(leaves) + len(not_leaves),
+                             'senders': senders,
+                             'leaves': leaves,
+                             'not_leaves': not_leaves}
+        return self._summary
+
+    def iter_content(self):
+        """Yield the cleaned body of each message of the tree with this
+        node as root"""
+        for node in self.walk():
+            yield clean_message(node.get_body())
+
+    def properties(self):
+        """Return various properties about the tree with this node as root."""
+        summary = self.summary()
+        return [summary['num_nodes'], summary['senders'], summary['leaves'],
+                list(self.iter_content()), summary['not_leaves']]
+
+
+METRIC_COLUMNS = ['root', 'known_root', 'size', 'depth', 'senders',
+                  'start', 'end', 'duration', 'median_reply_latency']
+
+
+class ThreadIndex(object):
+    """
+    The threads of the messages of the dataframe *data* (an Archive's
+    data, indexed by Message-ID), as arrays computed in linear time
+    from a CompactArchive of it.
+
+    A message's parent is the message named by its In-Reply-To or,
+    failing that, by the last of its References that is in the archive,
+    whatever their order in the data. Messages replying to the same
+    missing message share a thread with an unknown root.
+
+    Attributes:
+    parents -- the position of each message's parent, or NO_CODE
+    roots -- the position of the root message of each message's thread
+    thread_ids -- the number of each message's thread, numbered in the
+        order of their first messages in the data
+    missing_roots -- for each thread, the Message-ID of the missing
+        message its roots reply to, or None if its root is known
+
+    Thread and Node objects are only built on request, by thread() and
+    threads(). The data of their Nodes are MessageFields, which hold the
+    fields of their messages except the Body, and read the Body from the
+    data or *index* when it is looked up.
+
+    *index* is an index of the raw archive files (see bigbang.mbox_index)
+    to read message bodies from if the data has none.
+    """
+
+    def __init__(self, data, compacted=None, index=None):
+        compacted = compacted if compacted is not None else CompactArchive(data)
+        self.data = data
+        self.index = index
+        self.compacted = compacted
+
+        n = len(data)
+        positions = np.arange(n)
+        parents = compacted.parents()
+        roots = compacted.roots(parents)
+
+        # roots replying to a missing message share a thread, keyed by
+        # that message's ID code after the positions
+        missing = np.where(parents[roots] == NO_CODE,
+                           compacted.missing_parents()[roots], NO_CODE)
+        keys = np.where(missing == NO_CODE, roots, n + missing)
+        self.thread_ids, thread_keys = pd.factorize(keys)
+        self.missing_roots = [compacted.message_id(key - n) if key >= n else None
+                              for key in thread_keys]
+
+        # cut reply cycles, whose messages are their own roots
+        parents[roots == positions] = NO_CODE
+        self.parents = parents
+        self.roots = roots
+
+        # the positions of the messages of each thread, in data order
+        self._members = np.argsort(self.thread_ids, kind='mergesort')
+        self._offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.thread_ids, minlength=len(thread_keys)))])
+
+    def __len__(self):
+        return len(self.missing_roots)
+
+    def members(self, t):
+        """Return the positions in the data of the messages of thread t"""
+        return self._members[self._offsets[t]:self._offsets[t + 1]]
+
+    def first_members(self):
+        """Return the position of the first message of each thread"""
+        return self._members[self._offsets[:-1]]
+
+    def depths(self):
+        """
+        Return the depth of each message in its thread: 0 for roots,
+        and one more than its parent's for replies. Computed by pointer
+        jumping, summing the distances jumped.
+        """
+        has_parent = self.parents != NO_CODE
+        ancestors = np.where(has_parent, self.parents, np.arange(len(self.parents)))
+        depths = has_parent.astype('int64')
+        while True:
+            jumped = ancestors[ancestors]
+            if np.array_equal(jumped, ancestors):
+                return depths
+            depths = depths + depths[ancestors]
+            ancestors = jumped
+
+    def reply_latencies(self):
+        """
+        Return the time in seconds from the parent of each message to
+        the message, or NaN for messages without a parent.
+        """
+        dates = self.compacted.dates
+        replies = self.parents != NO_CODE
+        latencies = np.full(len(dates), np.nan)
+        latencies[replies] = dates[replies] - dates[self.parents[replies]]
+        return latencies
+
+    def metrics(self):
+        """
+        Return a dataframe with a row of measures for each thread,
+        computed on the arrays without building Threads:
+
+        root -- the Message-ID of the thread root; for a thread with an
+            unknown root, the missing message its roots reply to
+        known_root -- whether the root message is in the archive
+        size -- the number of messages of the thread in the archive
+        depth -- the length of its longest reply chain in the archive
+        senders -- the number of distinct senders
+        start, end, duration -- the dates of its first and last messages
+            and the time between them
+        median_reply_latency -- the median time from a message to a
+            reply to it, or NaT if the thread has no replies
+        """
+        n_threads = len(self)
+        thread_ids = self.thread_ids
+        message_ids = self.data.index.values
+
+        roots = self.roots[self.first_members()]
+        known_root = np.array([missing is None for missing in self.missing_roots])
+        root_ids = np.where(known_root, message_ids[roots],
+                            np.array(self.missing_roots, dtype=object))
+
+        # distinct (thread, sender) pairs, coded as single integers
+        senders = self.compacted.senders.codes
+        n_senders = len(self.compacted.senders.categories)
+        has_sender = senders != NO_CODE
+        pairs = pd.unique(thread_ids[has_sender] * np.int64(n_senders) + senders[has_sender])
+        distinct_senders = np.bincount(pairs // n_senders, minlength=n_threads)
+
+        dates = pd.Series(self.compacted.dates).groupby(thread_ids)
+        start = pd.to_datetime(dates.min().values, unit='s', utc=True)
+        end = pd.to_datetime(dates.max().values, unit='s', utc=True)
+
+        depths = pd.Series(self.depths()).groupby(thread_ids).max().values
+        latency = pd.Series(self.reply_latencies()).groupby(thread_ids).median().values
+
+        metrics = pd.DataFrame({'root': root_ids,
+                                'known_root': known_root,
+                                'size': np.bincount(thread_ids, minlength=n_threads),
+                                'depth': depths,
+                                'senders': distinct_senders},
+                               index=pd.Index(np.arange(n_threads), name='Thread'))
+        # dates are assigned afterwards, as the DataFrame constructor
+        # would box tz-aware dates one by one
+        metrics['start'] = start
+        metrics['end'] = end
+        metrics['duration'] = end - start
+        metrics['median_reply_latency'] = pd.to_timedelta(latency, unit='s')
+        return metrics[METRIC_COLUMNS]
+
+    def thread_of(self, message_id):
+        """Return the number of the thread of the message with message_id"""
+        return self.thread_ids[self.data.index.get_loc(message_id)]
+
+    def to_frame(self):
+        """
+        Return a dataframe, indexed by Message-ID, of the Message-IDs of
+        each message's parent (or None) and thread root, and its thread
+        number.
+        """
+        message_ids = self.data.index.values
+        parents = np.where(self.parents == NO_CODE, None,
+                           message_ids[np.maximum(self.parents, 0)])
+        return pd.DataFrame({'Parent': parents,
+                             'Root': message_ids[self.roots],
+                             'Thread': self.thread_ids},
+                            index=self.data.index, columns=['Parent', 'Root', 'Thread'])
+
+    def get_body(self, message_id):
+        """Return the body of the message with message_id, from the data
+        or, if the data does not include it, from the index"""
+        if 'Body' in self.data.columns:
+            body = self.data.loc[message_id, 'Body']
+            if isinstance(body, pd.Series):
+                body = body.iloc[0]
+            if body is not None:
+                return body
+        if self.index is not None:
+            return self.index.get_body(message_id)
+        return None
+
+    def records(self, positions=None):
+        """
+        Return the fields of the messages at positions (by default, of
+        all messages) as a list of MessageFields, which read the Body on
+        request. They are built column by column, as iterating over the
+        rows of the dataframe is slow.
+        """
+        data = self.data if positions is None else self.data.iloc[positions]
+        names = [name for name in data.columns if name != 'Body']
+        columns = [data[name].tolist() for name in names]
+        return [MessageFields(zip(names, values), message_id, self)
+                for message_id, values in zip(data.index, zip(*columns))]
+
+    def thread(self, t):
+        """Return thread t as a Thread of Nodes"""
+        members = self.members(t)
+        nodes = dict(zip(members, [Node(record.message_id, record, index=self)
+                                   for record in self.records(members)]))
+        return self._link(t, nodes)
+
+    def threads(self):
+        """Return all the threads as Threads of Nodes, in order"""
+        nodes = [Node(record.message_id, record, index=self) for record in self.records()]
+        return [self._link(t, nodes) for t in range(len(self))]
+
+    def _link(self, t, nodes):
+        members = self.members(t)
+        placeholder = None
+        if self.missing_roots[t] is not None:
+            placeholder = Node(self.missing_roots[t])
+
+        for i in members:
+            node = nodes[i]
+            parent = nodes[self.parents[i]] if self.parents[i] != NO_CODE else placeholder
+            if parent is not None:
+                node.parent = parent
+                parent.add_successor(node)
+
+        if placeholder is not None:
+            return Thread(placeholder, known_root=False)
+        return Thread(nodes[self.roots[members[0]]])
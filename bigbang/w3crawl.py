@@ -1,11 +1,13 @@
-import urllib2
 import urllib
 import gzip
+import itertools
 import re
 import os
 import urlparse
 import logging
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+from HTMLParser import HTMLParser
 from email.mime.text import MIMEText
 import email
 import email.parser
@@ -13,47 +15,93 @@ import mailbox
 import time
 import bigbang.mailman
 import dateutil
+import requests
+from multiprocessing.pool import ThreadPool
+from . import fetch
 from . import parse
 
+CHECKPOINT_SUFFIX = '.checkpoint'
+# prefix of the checkpoint lines recording the size of the mbox file
+SIZE_PREFIX = '#size '
+# messages written to an mbox file between checkpoints
+CHECKPOINT_INTERVAL = 50
+
+# requests per second to the W3C archives, for politeness
+DEFAULT_RATE = 1.0
+DEFAULT_WORKERS = 4
+
+# fields of a message page, the selector that finds each one, and
+# whether a warning is logged if it is missing
+MESSAGE_FIELDS = [('body', '#body', True),
+                  ('from', '#from', True),
+                  ('from_address', '#from a', True),
+                  ('subject', 'h1', True),
+                  ('message_id', '#message-id', True),
+                  ('date', '#date', True),
+                  ('to', '#to', False),
+                  ('cc', '#cc', False)]
+
+# hypermail records the Message-ID replied to in a comment
+in_reply_to_exp = re.compile(r'^\s*inreplyto="([^"]*)"\s*$')
+
 class W3cMailingListArchivesParser(email.parser.Parser):
     parse = None
     # doesn't yet implement the file version
 
     # takes the full HTML of a single message page; returns an email Message
     # currently returns an mboxMessage, with appropriate From separator line
-    # TODO: parse To, CC (Archived-At?, others?) headers
+    # TODO: parse other headers (Archived-At?)
     # TODO: support headersonly option
     # TODO: ignore spam (has separate error message in w3c archives)
     def parsestr(self, text, headersonly=None):
+        return self._message_from_fields(self._extract_fields(text))
+
+    def _extract_fields(self, text):
+        """
+        Returns a dict of the texts of the page's MESSAGE_FIELDS, as
+        UTF-8 strings, and its 'in_reply_to' Message-ID or None.
+        """
         soup = BeautifulSoup(text)
-        body = self._text_for_selector(soup, '#body')
-        msg = MIMEText(body, 'plain', 'utf-8')
 
-        from_text = self._parse_dfn_header(
-            self._text_for_selector(
-                soup,
-                '#from'))
+        fields = {}
+        for field, selector, required in MESSAGE_FIELDS:
+            fields[field] = self._text_for_selector(soup, selector, warn=required)
+
+        fields['in_reply_to'] = None
+        for comment in soup.find_all(text=lambda text: isinstance(text, Comment)):
+            match = in_reply_to_exp.match(comment)
+            if match:
+                fields['in_reply_to'] = unescape_html(match.group(1)).encode('utf-8')
+                break
+
+        return fields
+
+    def _message_from_fields(self, fields):
+        msg = MIMEText(fields['body'], 'plain', 'utf-8')
+
+        from_text = self._parse_dfn_header(fields['from'])
         from_name = from_text.split('<')[0].strip()
-        from_address = self._text_for_selector(soup, '#from a')
+        from_address = fields['from_address']
 
         from_addr = email.utils.formataddr((from_name, from_address))
         msg['From'] = from_addr
 
-        subject = self._text_for_selector(soup, 'h1')
+        subject = fields['subject']
         msg['Subject'] = subject
 
-        message_id = self._parse_dfn_header(
-            self._text_for_selector(
-                soup,
-                '#message-id'))
+        message_id = self._parse_dfn_header(fields['message_id'])
         msg['Message-ID'] = message_id.strip()
 
-        message_date = self._parse_dfn_header(
-            self._text_for_selector(
-                soup,
-                '#date'))
+        message_date = self._parse_dfn_header(fields['date'])
         msg['Date'] = message_date.strip()
 
+        for header, field in [('To', 'to'), ('Cc', 'cc')]:
+            if fields[field]:
+                msg[header] = ' '.join(self._parse_dfn_header(fields[field]).split())
+
+        if fields['in_reply_to']:
+            msg['In-Reply-To'] = '<%s>' % fields['in_reply_to']
+
         mbox_message = mailbox.mboxMessage(msg)
         mbox_message.set_from(
             from_address,
@@ -69,37 +117,219 @@ class W3cMailingListArchivesParser(email.parser.Parser):
             logging.warning("Split failed on %s", header_text)
             return ''
 
-    def _text_for_selector(self, soup, selector):
+    def _text_for_selector(self, soup, selector, warn=True):
         results = soup.select(selector)
         if results:
             result = results[0].get_text()
         else:
             result = ''
-            logging.warning('No matching text for selector %s', selector)
+            if warn:
+                logging.warning('No matching text for selector %s', selector)
 
         return unicode(result).encode('utf-8')
 
+class FastW3cMailingListArchivesParser(W3cMailingListArchivesParser):
+    """
+    Parses W3C message pages like W3cMailingListArchivesParser, producing
+    identical messages, but extracts the fields in a single streaming
+    pass over the page instead of building and querying a document tree.
+    """
+
+    def _extract_fields(self, text):
+        if not isinstance(text, unicode):
+            text = UnicodeDammit(text, is_html=True).unicode_markup
+
+        extractor = W3cPageExtractor()
+        extractor.feed(text)
+        extractor.close()
+
+        fields = {}
+        for field, selector, required in MESSAGE_FIELDS:
+            if field in extractor.texts:
+                fields[field] = u''.join(extractor.texts[field]).encode('utf-8')
+            else:
+                fields[field] = ''
+                if required:
+                    logging.warning('No matching text for selector %s', selector)
+
+        fields['in_reply_to'] = extractor.in_reply_to
+        if fields['in_reply_to'] is not None:
+            fields['in_reply_to'] = fields['in_reply_to'].encode('utf-8')
+
+        return fields
+
+# elements with no end tag
+VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                           'input', 'link', 'meta', 'param', 'source', 'wbr'])
+
+# element ids of the MESSAGE_FIELDS
+FIELD_IDS = {'body': 'body',
+             'from': 'from',
+             'message-id': 'message_id',
+             'date': 'date',
+             'to': 'to',
+             'cc': 'cc'}
+
+class W3cPageExtractor(HTMLParser):
+    """
+    Collects the text of the first element matching each of the
+    MESSAGE_FIELDS selectors, decoding entities as BeautifulSoup does,
+    and the In-Reply-To Message-ID from hypermail comments.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        # field name -> list of text pieces
+        self.texts = {}
+        # [field name, tag, depth of nested tags of the same name]
+        # for each field element currently open
+        self.regions = []
+        self.in_reply_to = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+
+        for region in self.regions:
+            if region[1] == tag:
+                region[2] += 1
+
+        field = None
+        if tag == 'h1':
+            field = 'subject'
+        elif tag == 'a' and any(region[0] == 'from' for region in self.regions):
+            field = 'from_address'
+        else:
+            for name, value in attrs:
+                if name == 'id' and value in FIELD_IDS:
+                    field = FIELD_IDS[value]
+
+        if field is not None and field not in self.texts:
+            self.texts[field] = []
+            self.regions.append([field, tag, 1])
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+
+        for region in self.regions:
+            if region[1] == tag:
+                region[2] -= 1
+        self.regions = [region for region in self.regions if region[2] > 0]
+
+    def handle_data(self, data):
+        for region in self.regions:
+            self.texts[region[0]].append(data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else u'&' + name)
+
+    def handle_charref(self, name):
+        if name[0] in 'xX':
+            codepoint = int(name[1:], 16)
+        else:
+            codepoint = int(name)
+
+        data = None
+        if codepoint < 256:
+            try:
+                data = bytearray([codepoint]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = unichr(codepoint)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or u'\ufffd')
+
+    def handle_comment(self, data):
+        if self.in_reply_to is None:
+            match = in_reply_to_exp.match(data)
+            if match:
+                self.in_reply_to = unescape_html(match.group(1))
+
+def unescape_html(text):
+    return HTMLParser().unescape(text)
+
+DEFAULT_PARSER = FastW3cMailingListArchivesParser
+
 def normalize_mailing_list_url(url):
     if not url.endswith('/'):
         return url + '/'
     
     return url
 
-def collect_from_url(url, base_arch_dir="archives", notes=None):
+def fetch_message(message_url, session=None, limiter=None, parser=DEFAULT_PARSER):
+    """
+    Fetches the W3C archive page of a single message and parses it with
+    an instance of *parser*. Returns a tuple of an mboxMessage and the
+    size of the page in bytes.
+    """
+    html, validators = fetch.get_page(message_url, session=session, limiter=limiter)
+    return parser().parsestr(html), len(html)
+
+def try_fetch_message(message_url, session=None, limiter=None):
+    """
+    Returns a tuple (message, size, error) of fetch_message's result, or
+    of the exception it raised.
+    """
+    try:
+        message, size = fetch_message(message_url, session, limiter)
+        return message, size, None
+    except Exception as e:
+        logging.warning('Failed to fetch %s: %s', message_url, e)
+        return None, 0, e
+
+def successful_fetches(linked_results, failures, stats):
+    """
+    Yields the (message page URL, message) pairs of the successful
+    fetches among (message page URL, (message, size, error)) tuples,
+    and appends the errors of the others to the list *failures*. The
+    messages and bytes fetched are added to *stats*.
+    """
+    for message_link, (message, size, error) in linked_results:
+        if error is None:
+            stats['files'] += 1
+            stats['bytes'] += size
+            yield message_link, message
+        else:
+            failures.append(error)
+
+def collect_from_url(url, base_arch_dir="archives", notes=None,
+                     workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+                     session=None, limiter=None, stats=None):
     """
     Collects W3C mailing list archives from a particular mailing list URL.
 
+    Message pages are fetched and parsed by a pool of *workers* threads
+    while the messages already parsed are written to the mbox file of
+    their month. Requests reuse the connections of *session* and are
+    made at most *rate* per second, or within the limits of *limiter*
+    (a fetch.HostLimiter) if one is given.
+
+    If *stats* is a dict, the number of message pages fetched ('files')
+    and skipped as already collected ('not_modified'), the bytes
+    fetched and the number of failed fetches ('failures') are stored in
+    it, as by mailman.collect_archive_from_url.
+
     Logs an error and returns False if no messages can be collected.
     """
     url = normalize_mailing_list_url(url)
     list_name = bigbang.mailman.get_list_name(url)
     logging.info("Getting W3C list archive for %s", list_name)
 
+    session = session or fetch.new_session(pool_size=workers)
+    limiter = limiter or fetch.HostLimiter(rate=rate)
+    stats = stats if stats is not None else {}
+    for key in ['files', 'not_modified', 'bytes', 'failures']:
+        stats[key] = 0
+
     try:
-        response = urllib2.urlopen(url)
-        html = response.read()
+        html, validators = fetch.get_page(url, session=session, limiter=limiter)
         soup = BeautifulSoup(html)
-    except urllib2.HTTPError as exception:
+    except requests.HTTPError as exception:
         logging.exception('Error in loading W3C list archive page for %s', url)
         return False
 
@@ -118,56 +348,165 @@ def collect_from_url(url, base_arch_dir="archives", notes=None):
     arc_dir = bigbang.mailman.archive_directory(base_arch_dir, list_name)
     bigbang.mailman.populate_provenance(directory=arc_dir, list_name=list_name, list_url=url, notes=notes)
 
-    for link in time_period_indices:
-        link_url = urlparse.urljoin(url, link)
-        response = urllib2.urlopen(link_url)
-        html = response.read()
-        soup = BeautifulSoup(html)
-
-        end_date_string = soup.select(
-            '#end')[0].parent.parent.select('em')[0].get_text()
-        end_date = dateutil.parser.parse(end_date_string)
-        year_month_mbox = end_date.strftime('%Y-%m') + '.mbox'
-        mbox_path = os.path.join(arc_dir, year_month_mbox)
+    pool = ThreadPool(workers)
+    try:
+        for link in time_period_indices:
+            link_url = urlparse.urljoin(url, link)
+            html, validators = fetch.get_page(link_url, session=session, limiter=limiter)
+            soup = BeautifulSoup(html)
 
-        # looks like we've already downloaded this timeperiod
-        if os.path.isfile(mbox_path):
-            logging.info(
-                'Looks like %s already exists, moving on.', mbox_path)
-            continue
-        logging.info('Downloading messages to archive to %s.', mbox_path)
+            end_date_string = soup.select(
+                '#end')[0].parent.parent.select('em')[0].get_text()
+            end_date = dateutil.parser.parse(end_date_string)
+            year_month_mbox = end_date.strftime('%Y-%m') + '.mbox'
+            mbox_path = os.path.join(arc_dir, year_month_mbox)
 
-        message_links = list()
-        messages = list()
+            message_links = list()
 
-        anchors = soup.select('div.messages-list a')
-        for anchor in anchors:
-            if anchor.get('href'):
-                message_url = urlparse.urljoin(link_url, anchor.get('href'))
-                message_links.append(message_url)
+            anchors = soup.select('div.messages-list a')
+            for anchor in anchors:
+                if anchor.get('href'):
+                    message_url = urlparse.urljoin(link_url, anchor.get('href'))
+                    message_links.append(message_url)
 
-        for message_link in message_links:
-            response = urllib2.urlopen(message_link)
-            html = response.read()
+            fetched = read_checkpoint(mbox_path)
+            if fetched is None:
+                if os.path.isfile(mbox_path):
+                    # collected in full before checkpoints were kept
+                    logging.info(
+                        'Looks like %s already exists, moving on.', mbox_path)
+                    stats['not_modified'] += len(message_links)
+                    continue
+                fetched = set()
 
-            message = W3cMailingListArchivesParser().parsestr(html)
-            messages.append(message)
-            time.sleep(1)  # wait between loading messages, for politeness
+            missing_links = [message_link for message_link in message_links
+                             if message_link not in fetched]
+            stats['not_modified'] += len(message_links) - len(missing_links)
+            if not missing_links:
+                logging.info('No new messages for %s, moving on.', mbox_path)
+                continue
+            logging.info('Downloading %d messages to archive to %s.',
+                         len(missing_links), mbox_path)
 
-        mbox = mailbox.mbox(mbox_path)
-        mbox.lock()
+            results = pool.imap(
+                lambda message_link: try_fetch_message(message_link, session, limiter),
+                missing_links)
+            failures = []
+            append_to_mbox(successful_fetches(itertools.izip(missing_links, results),
+                                              failures, stats),
+                           mbox_path)
 
-        try:
-            for message in messages:
-                mbox.add(message)
-            mbox.flush()
-        finally:
-            mbox.unlock()
+            stats['failures'] += len(failures)
+            if failures:
+                # the messages fetched are checkpointed; the rest are
+                # fetched again by the next crawl
+                logging.error('Failed to fetch %d messages for %s', len(failures), mbox_path)
+                raise failures[0]
 
-        logging.info('Saved %s', year_month_mbox)
+            logging.info('Saved %s', year_month_mbox)
+    except:
+        # don't wait for the fetches still queued
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
     # assumes all archives were downloaded if no exceptions have been thrown
     provenance = bigbang.mailman.access_provenance(arc_dir)
     provenance['complete'] = True
     bigbang.mailman.update_provenance(arc_dir, provenance)
 
+def checkpoint_path(mbox_path):
+    return mbox_path + CHECKPOINT_SUFFIX
+
+def read_checkpoint(mbox_path):
+    """
+    Returns the set of message page URLs recorded as written to the mbox
+    file at *mbox_path*, or None if it has no checkpoint.
+    """
+    recorded = read_checkpoint_state(mbox_path)
+    return recorded[0] if recorded is not None else None
+
+def read_checkpoint_state(mbox_path):
+    """
+    Returns a tuple of the set of message page URLs recorded in the
+    checkpoint of the mbox file at *mbox_path* and the size of the file
+    once they were written, or None if it has no checkpoint.
+
+    Each batch of URLs is followed by the size of the file; URLs after
+    the last size were cut short and are left out.
+    """
+    path = checkpoint_path(mbox_path)
+    if not os.path.isfile(path):
+        return None
+
+    links, batch, size = set(), [], 0
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(SIZE_PREFIX):
+                links.update(batch)
+                batch = []
+                size = int(line[len(SIZE_PREFIX):])
+            elif line:
+                batch.append(line)
+    return links, size
+
+def append_to_mbox(linked_messages, mbox_path):
+    """
+    Appends messages to the mbox file at *mbox_path* as they become
+    available, from an iterable of (message page URL, message) pairs.
+
+    Every CHECKPOINT_INTERVAL messages, and at the end, the mbox file is
+    synced and the URLs of the messages written since are recorded in
+    the month's checkpoint file with the new size of the mbox file. An
+    interrupted crawl resumes by fetching only the messages not recorded,
+    after truncating the mbox file to its recorded size, and a later
+    crawl can pick up messages added to the month since.
+    """
+    recorded = read_checkpoint_state(mbox_path)
+    mbox_size = os.path.getsize(mbox_path) if os.path.isfile(mbox_path) else 0
+    if recorded is not None and mbox_size > recorded[1]:
+        # messages written after the last checkpoint; they are fetched again
+        logging.info('Truncating %s to its last checkpoint', mbox_path)
+        with open(mbox_path, 'r+b') as f:
+            f.truncate(recorded[1])
+
+    # create the checkpoint first, so an mbox file without one is always
+    # a month collected in full
+    with open(checkpoint_path(mbox_path), 'a') as checkpoint:
+        if recorded is None:
+            checkpoint.write('%s%d\n' % (SIZE_PREFIX, mbox_size))
+            checkpoint.flush()
+
+        mbox = mailbox.mbox(mbox_path)
+        mbox.lock()
+        pending = []
+
+        def record():
+            mbox.flush()
+            for message_link in pending:
+                checkpoint.write(message_link + '\n')
+            checkpoint.write('%s%d\n' % (SIZE_PREFIX, os.path.getsize(mbox_path)))
+            checkpoint.flush()
+            del pending[:]
+
+        try:
+            for message_link, message in linked_messages:
+                try:
+                    mbox.add(message)
+                except:
+                    # the message may be partly written; it and the ones
+                    # since the last checkpoint are truncated on resume
+                    del pending[:]
+                    raise
+                pending.append(message_link)
+                if len(pending) >= CHECKPOINT_INTERVAL:
+                    record()
+        finally:
+            if pending:
+                record()
+            mbox.unlock()
+            mbox.close()
@@ -0,0 +1,93 @@
+from bigbang.testing import FixtureServer
+import bigbang.mailman as mailman
+import bigbang.w3crawl as w3crawl
+import logging
+import argparse
+import shutil
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=r"""
+Measures the throughput of the mailing list collectors against a local
+fixture server of synthetic archives.
+
+Each mode collects every list from the server into a fresh directory.
+The 'pipermail-unchanged' mode collects the pipermail archives a second
+time, when every file is unchanged.
+
+For example:
+
+python bin/benchmark_collectors.py --lists 4 --months 12 --workers 8 --latency 0.05
+
+""")
+
+parser.add_argument('--modes', type=str, nargs='*', default=['pipermail', 'pipermail-unchanged', 'ietf', 'w3c'], help='Collector modes to benchmark')
+
+parser.add_argument('--lists', type=int, default=2, help='Number of mailing lists on the server')
+
+parser.add_argument('--months', type=int, default=6, help='Number of months of archives per list')
+
+parser.add_argument('--messages', type=int, default=50, help='Number of messages per month')
+
+parser.add_argument('--body-size', type=int, default=2000, help='Approximate size of message bodies in bytes')
+
+parser.add_argument('--latency', type=float, default=0, help='Delay in seconds before each response')
+
+parser.add_argument('--error-rate', type=float, default=0, help='Fraction of file requests that fail with a server error')
+
+parser.add_argument('--workers', type=int, default=4, help='Number of download threads per list')
+
+parser.add_argument('--parallel-lists', type=int, default=1, help='Number of lists collected at once')
+
+parser.add_argument('--rate', type=float, default=100, help='Requests per second to the server when crawling W3C archives')
+
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.ERROR)
+
+def collect(server, list_names, style, archive_dir, args):
+    urls_file = tempfile.NamedTemporaryFile(suffix='.txt')
+    urls_file.write('\n'.join([server.url(name, style) for name in list_names]))
+    urls_file.flush()
+
+    if style == 'w3c':
+        for name in list_names:
+            w3crawl.collect_from_url(server.url(name, style), archive_dir,
+                                     workers=args.workers, rate=args.rate)
+    else:
+        mailman.collect_from_file(urls_file.name, archive_dir=archive_dir,
+                                  workers=args.workers, lists=args.parallel_lists)
+    urls_file.close()
+
+def main(args):
+    list_names = ['list-%d' % i for i in range(args.lists)]
+    server = FixtureServer(lists=list_names, months=args.months,
+                           messages=args.messages, body_size=args.body_size,
+                           latency=args.latency, error_rate=args.error_rate)
+    server.start()
+
+    print "%-20s %8s %8s %9s %8s %10s %8s %8s" % ('mode', 'requests', 'files', 'unchanged', 'errors', 'wall (s)', 'files/s', 'MB/s')
+    try:
+        for mode in args.modes:
+            style = mode.split('-')[0]
+            archive_dir = tempfile.mkdtemp()
+            try:
+                if mode == 'pipermail-unchanged':
+                    collect(server, list_names, style, archive_dir, args)
+
+                server.reset_stats()
+                start = time.time()
+                collect(server, list_names, style, archive_dir, args)
+                wall = time.time() - start
+            finally:
+                shutil.rmtree(archive_dir)
+
+            stats = server.stats
+            print "%-20s %8d %8d %9d %8d %10.2f %8.1f %8.2f" % (
+                mode, stats['requests'], stats['files'], stats['not_modified'], stats['errors'], wall,
+                stats['files'] / wall, stats['bytes'] / wall / 1024 ** 2)
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main(args)
@@ -0,0 +1,46 @@
+import bigbang.w3crawl as w3crawl
+import logging
+import argparse
+import time
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=r"""
+Compares the speed of the W3C message page parsers on saved pages, and
+checks that they produce identical messages.
+
+For example:
+
+python bin/benchmark_w3c_parser.py tests/data/w3c-message.html -n 200
+
+""")
+
+parser.add_argument('pages', type=str, nargs='*', default=['tests/data/w3c-message.html'], help='Paths of saved W3C message pages')
+
+parser.add_argument('-n', '--repeat', type=int, default=100, help='Number of times each page is parsed')
+
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.ERROR)
+
+PARSERS = [('BeautifulSoup', w3crawl.W3cMailingListArchivesParser),
+           ('fast', w3crawl.FastW3cMailingListArchivesParser)]
+
+def main(args):
+    pages = [open(path, 'rb').read() for path in args.pages]
+
+    results = {}
+    for name, parser_class in PARSERS:
+        start = time.time()
+        for i in range(args.repeat):
+            messages = [parser_class().parsestr(page) for page in pages]
+        elapsed = time.time() - start
+        results[name] = [(message.get_from(), message.as_string()) for message in messages]
+
+        parsed = args.repeat * len(pages)
+        print "%-14s %8.3f ms/page %8.1f pages/s" % (name, 1000 * elapsed / parsed, parsed / elapsed)
+
+    for path, slow, fast in zip(args.pages, results['BeautifulSoup'], results['fast']):
+        if slow != fast:
+            print "Messages differ for %s" % (path)
+
+if __name__ == "__main__":
+    main(args)
@@ -19,6 +19,14 @@ or
 
 python bin/collect_mail.py -f examples/urls.txt
 
+Monthly archive files can be downloaded concurrently, e.g.:
+
+python bin/collect_mail.py -u http://mail.python.org/pipermail/scipy-dev/ --workers 8 --per-host 4
+
+and several lists from a file can be collected at once, e.g.:
+
+python bin/collect_mail.py -f examples/urls.txt --lists 8 --per-host 4 --rate 5 --report report.csv
+
 """)
 parser.add_argument('-u', type=str, help='URL of mailman archive')
 
@@ -28,6 +36,20 @@ parser.add_argument('--archives', type=str, help='Path to a specified directory
 
 parser.add_argument('--notes', type=str, help='Notes to record regarding provenance')
 
+parser.add_argument('--workers', type=int, default=1, help='Number of archive files to download concurrently')
+
+parser.add_argument('--per-host', type=int, default=None, help='Maximum number of concurrent requests to a single host')
+
+parser.add_argument('--unzip', action='store_true', help='Also write decompressed copies of .txt.gz archive files')
+
+parser.add_argument('--lists', type=int, default=1, help='Number of mailing lists to collect at once when reading URLs from a file')
+
+parser.add_argument('--rate', type=float, default=None, help='Maximum number of requests per second to a single host (W3C archives default to 1)')
+
+parser.add_argument('--report', type=str, help='Path of a CSV file for the per-list collection report')
+
+parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet', 'feather'], help='Storage format for the collected messages of each list')
+
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.INFO)
@@ -38,17 +60,24 @@ def main(args):
     if args.notes:
         notes = args.notes
 
+    download_options = {'workers': args.workers, 'per_host_limit': args.per_host,
+                        'unzip': args.unzip, 'fmt': args.format, 'rate': args.rate}
+
     if args.u:
         if args.archives:
-            mailman.collect_from_url(args.u, archive_dir=args.archives, notes=notes)
+            mailman.collect_from_url(args.u, archive_dir=args.archives, notes=notes, **download_options)
         else:
-            mailman.collect_from_url(args.u, notes=notes)
+            mailman.collect_from_url(args.u, notes=notes, **download_options)
         sys.exit()
     elif args.f:
+        download_options['lists'] = args.lists
         if args.archives:
-            mailman.collect_from_file(args.f, archive_dir=args.archives, notes=notes)
+            report = mailman.collect_from_file(args.f, archive_dir=args.archives, notes=notes, **download_options)
         else:
-            mailman.collect_from_file(args.f, notes=notes)
+            report = mailman.collect_from_file(args.f, notes=notes, **download_options)
+
+        if args.report:
+            report.to_csv(args.report, encoding='utf-8', index=False)
 
 if __name__ == "__main__":
     main(args)
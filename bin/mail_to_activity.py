@@ -21,6 +21,8 @@ python bin/mail_to_activity.py --archives ../archives
 
 parser.add_argument('--archives', type=str, help='Path to a specified directory of downloaded mail archives', required=True)
 
+parser.add_argument('--with-bodies', action='store_true', help='Parse message bodies as well as headers; activity needs only the headers, so by default bodies are skipped.')
+
 parser.add_argument('-f', '--force', action='store_true', help='Overwrite existing -activity.csv files; by default this is false and directories with an existing file are skipped.')
 
 args = parser.parse_args()
@@ -38,8 +40,10 @@ def main(args):
             if os.path.isfile(out_path): # if file already exists, skip
                 continue
         try:
-            archives = mailman.open_list_archives(subdirectory, args.archives)
-            activity = bigbang.archive.Archive(archives).get_activity()
+            archives = mailman.open_list_archives(subdirectory, args.archives,
+                                                  headers_only=not args.with_bodies)
+            # the sparse matrix, as only the sums per sender are needed
+            activity = bigbang.archive.Archive(archives).get_activity(sparse=True)
             # sum the message count, rather than by date, to prevent enormous, sparse files
             activity = pd.DataFrame(activity.sum(0), columns=['Message Count'])
 
@@ -23,6 +23,7 @@ config = {
         'nose',
         'numpy',
         'pandas',
+        'pyarrow',
         'python-dateutil',
         'python-Levenshtein',
         'pytz',
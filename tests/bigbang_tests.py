@@ -1,15 +1,32 @@
 from nose.tools import *
 from testfixtures import LogCapture
 from bigbang import repo_loader
+from bigbang.cache import ArchiveCache
+from bigbang.thread import Node
+from bigbang.thread import Thread
+from bigbang.testing import FixtureServer
 import bigbang.archive as archive
+import bigbang.compact as compact
+import bigbang.fetch as fetch
 import bigbang.mailman as mailman
+import bigbang.mbox_index as mbox_index
 import bigbang.parse as parse
 import bigbang.process as process
+import bigbang.replies as replies
 import bigbang.utils as utils
+import bigbang.w3crawl as w3crawl
+from contextlib import closing
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import gzip
 import mailbox
 import os
 import networkx as nx
 import pandas as pd
+import requests
+import shutil
+import tempfile
+import time
 
 from config.config import CONFIG
 
@@ -143,3 +160,781 @@ def test_empty_list_compute_activity_issue_246():
     with assert_raises(mailman.MissingDataException):
         empty_archive = archive.Archive(df)
         activity = empty_archive.get_activity()
+
+def test_open_compressed_list_archives():
+    archives_dir = tempfile.mkdtemp()
+    try:
+        list_dir = os.path.join(archives_dir, 'compressed-list')
+        os.makedirs(list_dir)
+        plain_path = os.path.join(CONFIG.test_data_path, '2001-November.txt')
+        with open(plain_path, 'rb') as f, \
+             closing(gzip.open(os.path.join(list_dir, '2001-November.txt.gz'), 'wb')) as gz:
+            shutil.copyfileobj(f, gz)
+
+        compressed = mailman.open_list_archives('compressed-list', archive_dir=archives_dir)
+        plain = mailman.open_list_archives('2001-November.txt', archive_dir=CONFIG.test_data_path, mbox=True)
+
+        assert compressed.shape == plain.shape, \
+            "Compressed archive read differently from uncompressed archive"
+        assert (compressed.index == plain.index).all(), \
+            "Compressed archive has different messages from uncompressed archive"
+
+        mailman.unzip_archive('compressed-list', archive_dir=archives_dir)
+
+        assert os.path.isfile(os.path.join(list_dir, '2001-November.txt')), \
+            "unzip_archive did not write a decompressed copy"
+        assert len(mailman.list_archive_files(list_dir)) == 1, \
+            "Both the compressed archive and its decompressed copy were listed"
+    finally:
+        shutil.rmtree(archives_dir)
+
+def test_parallel_open_list_archives():
+    archives_dir = tempfile.mkdtemp()
+    try:
+        list_dir = os.path.join(archives_dir, 'parallel-list')
+        os.makedirs(list_dir)
+        shutil.copy(os.path.join(CONFIG.test_data_path, '2001-November.txt'), list_dir)
+        shutil.copy(os.path.join(CONFIG.test_data_path, 'bigbang-dev-test.txt'),
+                    os.path.join(list_dir, '2001-10.mbox'))
+
+        serial = mailman.open_list_archives('parallel-list', archive_dir=archives_dir)
+        parallel = mailman.open_list_archives('parallel-list', archive_dir=archives_dir, workers=2)
+
+        assert serial.equals(parallel), \
+            "Archives parsed in parallel differ from archives parsed serially"
+        assert serial.index[0] in mailman.open_archive_file(os.path.join(list_dir, '2001-10.mbox')).index, \
+            "Archive files were not concatenated in month order"
+    finally:
+        shutil.rmtree(archives_dir)
+
+def test_archive_cache():
+    archives_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        list_dir = os.path.join(archives_dir, 'cached-list')
+        os.makedirs(list_dir)
+        shutil.copy(os.path.join(CONFIG.test_data_path, '2001-November.txt'), list_dir)
+
+        cache = ArchiveCache(cache_dir)
+        parsed = mailman.open_list_archives('cached-list', archive_dir=archives_dir, cache=cache)
+
+        assert len(cache.index['entries']) == 1, "Parsed archive file was not cached"
+
+        accented = os.path.join(list_dir, 'caf\xc3\xa9.txt')
+        shutil.copy(os.path.join(CONFIG.test_data_path, '2001-November.txt'), accented)
+        key = cache.key(accented)
+        cache.flush()
+        reloaded = ArchiveCache(cache_dir)
+        assert reloaded.key(accented) == key, "Non-ASCII path keyed differently after reload"
+        assert len(reloaded.index['files']) == 2, "Non-ASCII path not found in the reloaded index"
+        os.remove(accented)
+
+        cached = mailman.open_list_archives('cached-list', archive_dir=archives_dir,
+                                            cache=ArchiveCache(cache_dir))
+
+        assert parsed.equals(cached), "Cached archive differs from parsed archive"
+
+        cache.invalidate()
+
+        assert len(cache.index['entries']) == 0, "Cache was not invalidated"
+        assert os.listdir(cache_dir) == ['index.json'], "Cached files were not removed"
+    finally:
+        shutil.rmtree(archives_dir)
+        shutil.rmtree(cache_dir)
+
+def test_columnar_storage():
+    arx = archive.Archive("bigbang-dev-test.txt", archive_dir="tests/data", mbox=True)
+    storage_dir = tempfile.mkdtemp()
+    try:
+        for extension in ['.parquet', '.feather']:
+            path = os.path.join(storage_dir, 'test' + extension)
+            arx.save(path)
+
+            arx2 = archive.load(path)
+
+            assert arx2.data.equals(arx.data), \
+                "Archive restored from %s differs from original" % extension
+            assert arx2.data['Date'].dtype == arx.data['Date'].dtype, \
+                "Archive restored from %s has different date type" % extension
+
+            headers = archive.load(path, columns=['From', 'Date', 'In-Reply-To'])
+
+            assert 'Body' not in headers.data.columns, \
+                "Column selection from %s read unrequested columns" % extension
+            assert (headers.data.index == arx.data.index).all(), \
+                "Column selection from %s has nonidentical index" % extension
+    finally:
+        shutil.rmtree(storage_dir)
+
+def test_messages_to_storage_in_chunks():
+    path = os.path.join(CONFIG.test_data_path, '2001-November.txt')
+    chunks = list(mailman.iter_message_dataframes(mailman.iter_mbox(path), chunksize=50))
+
+    assert [len(chunk) for chunk in chunks] == [50, 50, 50, 14], \
+        "Messages were not split into chunks of the requested size"
+
+    storage_dir = tempfile.mkdtemp()
+    try:
+        parquet_path = os.path.join(storage_dir, 'chunks.parquet')
+        count = mailman.messages_to_storage(mailman.iter_mbox(path), parquet_path, chunksize=50)
+
+        assert count == 164, "Wrong number of messages written"
+
+        stored = archive.load(parquet_path)
+        whole = archive.Archive(mailman.messages_to_dataframe(mailman.iter_mbox(path)))
+
+        assert stored.data.equals(whole.data), \
+            "Messages stored in chunks differ from messages loaded at once"
+    finally:
+        shutil.rmtree(storage_dir)
+
+def test_get_text_decoding_paths():
+    plain = MIMEText(u'caf\xe9 plain'.encode('utf-8'), 'plain')
+    del plain['Content-Type']
+    plain['Content-Type'] = 'text/plain'
+    html = MIMEText('<p>html <b>only</b></p>', 'html', 'us-ascii')
+
+    with_plain = MIMEMultipart('alternative')
+    with_plain.attach(plain)
+    with_plain.attach(html)
+
+    html_only = MIMEMultipart('alternative')
+    html_only.attach(MIMEText('<p>html <b>only</b></p>', 'html', 'us-ascii'))
+
+    decoder = mailman.BodyDecoder()
+
+    assert mailman.get_text(with_plain, decoder) == u'caf\xe9 plain', \
+        "Undeclared UTF-8 text part decoded incorrectly"
+    assert "html **only**" in mailman.get_text(html_only, decoder), \
+        "HTML-only message not converted to text"
+
+    assert decoder.counts['utf-8'] == 1, "UTF-8 fast path not counted"
+    assert decoder.counts['html'] == 1, "HTML conversion not counted"
+    assert decoder.counts['declared'] == 1, "Declared charset path not counted"
+    assert decoder.counts['detected'] == 0, "Statistical detection used unnecessarily"
+
+def test_detected_single_byte_charsets_not_reused():
+    french = u"Le caf\xe9 de la r\xe9union \xe9tait tr\xe8s agr\xe9able, d\xe9j\xe0 pr\xeat. " * 3
+    russian = u"\u041f\u0440\u0438\u0432\u0435\u0442, \u043a\u0430\u043a \u0434\u0435\u043b\u0430? " * 5
+    japanese = u"\u3053\u3093\u306b\u3061\u306f\u3001\u4e16\u754c\u3002" * 5
+
+    decoder = mailman.BodyDecoder()
+
+    assert decoder.decode(french.encode('iso-8859-1')) == french, "Latin-1 text not detected"
+    assert decoder.decode(russian.encode('koi8-r')) == russian, \
+        "KOI8-R text decoded with the charset of an earlier message"
+    assert decoder.decode(japanese.encode('euc-jp')) == japanese, "EUC-JP text not detected"
+    assert decoder.decode(japanese.encode('euc-jp')) == japanese, "EUC-JP text not decoded"
+
+    assert decoder.counts['cached'] == 1, "Detected multi-byte charset not reused"
+    assert decoder.counts['detected'] == 3, "Single-byte charset reused"
+
+def test_date_parser():
+    parser = parse.DateParser()
+    dates = ['Tue, 20 Nov 2001 10:03:12 -0500 (EST)',
+             'Tue, 20 Nov 2001 10:03:12 -0500 (EST)',
+             'Tue, 20 Nov 2001 15:03:12 --0000',
+             'not a date']
+
+    epochs = parser.epochs(dates)
+
+    assert list(epochs[:3]) == [1006268592] * 3, "Dates parsed to wrong epoch"
+    assert epochs[3] == parse.MISSING_EPOCH, "Unparseable date not marked missing"
+    assert parser.counts['memo'] == 1, "Repeated date string not memoized"
+    assert parser.counts['dateutil'] == 1, "Malformed timezone not left to dateutil"
+
+    datetimes = parse.epochs_to_datetimes(epochs)
+
+    assert str(datetimes.dtype) == 'datetime64[ns, UTC]', "Dates not converted to UTC timestamps"
+    assert pd.isnull(datetimes[3]), "Missing date not converted to NaT"
+
+    parser = parse.DateParser(max_memo=2)
+    parser.epochs(['Tue, 20 Nov 2001 10:03:%02d -0500' % s for s in range(10)])
+
+    assert len(parser.memo) <= 2, "Date memo not bounded"
+
+
+def test_interleave_by_host():
+    urls = ['http://a.org/1/', 'http://a.org/2/', 'http://a.org/3/',
+            'http://b.org/1/', 'https://c.org/1/']
+
+    interleaved = mailman.interleave_by_host(urls)
+
+    assert interleaved == ['http://a.org/1/', 'http://b.org/1/', 'https://c.org/1/',
+                           'http://a.org/2/', 'http://a.org/3/'], \
+        "Lists not interleaved across hosts"
+
+
+def test_conditional_downloads():
+    download_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=1, messages=10) as server:
+            path = [p for p in server.resources if p.endswith('.mail')][0]
+            url = 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+            file_path = os.path.join(download_dir, 'a.txt')
+
+            first = fetch.download_to_file(fetch.Download(url, file_path))
+            again = fetch.download_to_file(fetch.Download(url, file_path, first.validators))
+
+            assert again.status == 'not-modified', "Unchanged file not answered with a 304"
+            with open(file_path) as f:
+                assert f.read() == server.resources[path][0], "Unchanged file not kept"
+
+            content, content_type, is_file = server.resources[path]
+            server.resources[path] = (content + 'More text\n', content_type, is_file)
+            changed = fetch.download_to_file(fetch.Download(url, file_path, first.validators))
+
+            assert changed.status == 'downloaded', "Changed file not downloaded"
+            assert changed.validators['etag'] != first.validators['etag'], "ETag not updated"
+            with open(file_path) as f:
+                assert f.read() == content + 'More text\n', "Changed file not replaced"
+
+            # an interrupted transfer of the earlier version
+            partial = fetch.Download(url, os.path.join(download_dir, 'b.txt'), first.validators)
+            with open(partial.part_path, 'w') as f:
+                f.write(content[:100])
+            fetch.download_to_file(partial)
+
+            assert partial.status == 'downloaded', "Changed file resumed with If-Range"
+            with open(partial.path) as f:
+                assert f.read() == content + 'More text\n', "Changed file not downloaded in full"
+    finally:
+        shutil.rmtree(download_dir)
+
+
+def test_resumed_compressed_download_restarts():
+    download_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=1, messages=10, compress=True) as server:
+            path = [p for p in server.resources if p.endswith('.mail')][0]
+            url = 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+
+            first = fetch.download_to_file(fetch.Download(url, os.path.join(download_dir, 'a.txt')))
+            with open(first.path) as f:
+                text = f.read()
+
+            # an earlier transfer of the file, interrupted
+            download = fetch.Download(url, os.path.join(download_dir, 'b.txt'), first.validators)
+            with open(download.part_path, 'w') as f:
+                f.write(text[:100])
+            fetch.download_to_file(download)
+
+            assert download.status == 'downloaded', "Encoded partial response appended"
+            with open(download.path) as f:
+                assert f.read() == text, "Restarted download differs"
+    finally:
+        shutil.rmtree(download_dir)
+
+
+def test_host_limiter_rate():
+    limiter = fetch.HostLimiter(rate=50)
+    start = time.time()
+    for i in range(6):
+        with limiter.slot('http://a.org/%d' % i):
+            pass
+        with limiter.slot('http://b.org/%d' % i):
+            pass
+
+    assert time.time() - start >= 0.09, "Requests to a host not rate limited"
+
+
+def test_w3c_checkpoint_resume():
+    arc_dir = tempfile.mkdtemp()
+    try:
+        mbox_path = os.path.join(arc_dir, '2015-01.mbox')
+        links = ['http://lists.w3.org/Archives/Public/test/2015Jan/%04d.html' % i
+                 for i in range(3)]
+        messages = []
+        for i in range(3):
+            msg = MIMEText('Body %d' % i)
+            msg['Message-ID'] = '<m%d@example.org>' % i
+            messages.append(mailbox.mboxMessage(msg))
+
+        assert w3crawl.read_checkpoint(mbox_path) is None, "Checkpoint found for new month"
+
+        def interrupted():
+            for pair in zip(links, messages)[:2]:
+                yield pair
+            raise IOError('connection lost')
+
+        assert_raises(IOError, w3crawl.append_to_mbox, interrupted(), mbox_path)
+        assert w3crawl.read_checkpoint(mbox_path) == set(links[:2]), \
+            "Checkpoint does not record the messages written"
+
+        # a crash after a message is written but before it is checkpointed
+        unrecorded = mailbox.mbox(mbox_path)
+        unrecorded.add(messages[2])
+        unrecorded.close()
+
+        w3crawl.append_to_mbox(zip(links, messages)[2:], mbox_path)
+        ids = [m['Message-ID'] for m in mailbox.mbox(mbox_path)]
+
+        assert ids == ['<m0@example.org>', '<m1@example.org>', '<m2@example.org>'], \
+            "Resumed month does not hold each message once"
+    finally:
+        shutil.rmtree(arc_dir)
+
+
+def test_w3c_crawl_checkpoints_despite_errors():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=1, messages=20, error_rate=0.3) as server:
+            with assert_raises(requests.HTTPError):
+                w3crawl.collect_from_url(server.url('alpha', 'w3c'), archive_dir, rate=1000)
+            mbox_path = os.path.join(archive_dir, 'alpha', '2001-01.mbox')
+
+            assert server.stats['errors'] > 0, "No fetch errors injected"
+            assert len(mailbox.mbox(mbox_path)) == 20 - server.stats['errors'], \
+                "Messages fetched before an error not written"
+            assert len(w3crawl.read_checkpoint(mbox_path)) == 20 - server.stats['errors'], \
+                "Messages fetched before an error not checkpointed"
+
+            server.error_rate = 0
+            w3crawl.collect_from_url(server.url('alpha', 'w3c'), archive_dir, rate=1000)
+
+            assert len(mailbox.mbox(mbox_path)) == 20, "Failed messages not fetched again"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_w3c_message_parsers():
+    with open(os.path.join(CONFIG.test_data_path, 'w3c-message.html'), 'rb') as f:
+        page = f.read()
+
+    slow = w3crawl.W3cMailingListArchivesParser().parsestr(page)
+    fast = w3crawl.FastW3cMailingListArchivesParser().parsestr(page)
+
+    assert fast.as_string() == slow.as_string(), "Fast parser message differs"
+    assert fast.get_from() == slow.get_from(), "Fast parser From line differs"
+    assert fast['Message-ID'] == '<54BF8374.9070000@example.org>', "Message-ID not parsed"
+    assert fast['In-Reply-To'] == '<CAEkH2z=Xq9Yk@mail.example.com>', "In-Reply-To not parsed"
+    assert fast['Cc'] == 'www-style list <www-style@w3.org>, bob@example.net', "Cc not parsed"
+    assert 'Neither & both' in fast.get_payload(decode=True), "Body entities not decoded"
+
+
+def test_collect_from_fixture_server():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=3, messages=10) as server:
+            for style in ['pipermail', 'ietf']:
+                stats = {}
+                mailman.collect_from_url(server.url('alpha', style),
+                                         archive_dir=os.path.join(archive_dir, style),
+                                         workers=2, stats=stats)
+                data = pd.read_csv(os.path.join(archive_dir, style, 'alpha.csv'))
+
+                assert stats['files'] == 3, "Not all %s archive files collected" % style
+                assert len(data) == 30, "Not all %s messages parsed" % style
+
+            server.reset_stats()
+            stats = {}
+            mailman.collect_from_url(server.url('alpha'),
+                                     archive_dir=os.path.join(archive_dir, 'pipermail'),
+                                     workers=2, stats=stats)
+
+            assert server.stats['not_modified'] == 4, "Unchanged archives not requested conditionally"
+            assert stats['bytes'] == 0, "Unchanged archive files transferred again"
+
+            server.error_rate = 1
+            stats = {}
+            mailman.collect_from_url(server.url('alpha'),
+                                     archive_dir=os.path.join(archive_dir, 'failing'),
+                                     stats=stats)
+            provenance = mailman.access_provenance(os.path.join(archive_dir, 'failing', 'alpha'))
+
+            assert stats['failures'] == 3, "Server errors not counted as failures"
+            assert not provenance.get('complete'), "Failed collection marked complete"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_compressed_responses_decoded():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=2, messages=10, compress=True) as server:
+            stats = {}
+            mailman.collect_from_url(server.url('alpha', 'ietf'), archive_dir=archive_dir,
+                                     stats=stats)
+
+            assert stats['files'] == 2 and stats['failures'] == 0, \
+                "Compressed responses not collected"
+            assert len(mailman.open_list_archives('alpha', archive_dir)) == 20, \
+                "Compressed response stored without decoding"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_truncated_downloads_not_kept():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=2, messages=10, truncate=True) as server:
+            stats = {}
+            mailman.collect_from_url(server.url('alpha'), archive_dir=archive_dir, stats=stats)
+            arc_dir = os.path.join(archive_dir, 'alpha')
+            provenance = mailman.access_provenance(arc_dir)
+
+            assert stats['failures'] == 2, "Truncated downloads not counted as failures"
+            assert not [f for f in os.listdir(arc_dir) if f.endswith('.txt.gz')], \
+                "Truncated download renamed into place"
+            assert not provenance.get('files'), "Validators saved for failed downloads"
+
+            server.truncate = False
+            stats = {}
+            mailman.collect_from_url(server.url('alpha'), archive_dir=archive_dir, stats=stats)
+
+            assert stats['files'] == 2 and stats['failures'] == 0, \
+                "Truncated downloads not collected again"
+            assert len(mailman.open_list_archives('alpha', archive_dir)) == 20, \
+                "Collected archives incomplete"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_w3c_crawl_from_fixture_server():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=2, messages=5) as server:
+            w3crawl.collect_from_url(server.url('alpha', 'w3c'), archive_dir, rate=1000)
+            messages = list(mailbox.mbox(os.path.join(archive_dir, 'alpha', '2001-02.mbox')))
+
+            assert len(messages) == 5, "Not all W3C messages crawled"
+            assert messages[1]['In-Reply-To'] == messages[0]['Message-ID'], \
+                "W3C reply not threaded"
+
+            server.reset_stats()
+            w3crawl.collect_from_url(server.url('alpha', 'w3c'), archive_dir, rate=1000)
+
+            assert server.stats['files'] == 0, "Checkpointed W3C messages fetched again"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def crawl_w3c_lists_at_once(**options):
+    """
+    Collects two W3C lists of the fixture server at once, returning the
+    report and the rate of requests made to the server.
+    """
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha', 'beta'], months=1, messages=5) as server:
+            urls_file = os.path.join(archive_dir, 'urls.txt')
+            with open(urls_file, 'w') as f:
+                f.write('%s\n%s\n' % (server.url('alpha', 'w3c'), server.url('beta', 'w3c')))
+
+            start = time.time()
+            report = mailman.collect_from_file(urls_file, archive_dir=archive_dir,
+                                               workers=4, lists=2, **options)
+            # the first request needs no token
+            return report, (server.stats['requests'] - 1) / (time.time() - start)
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_w3c_lists_share_host_rate():
+    default_rate = w3crawl.DEFAULT_RATE
+    w3crawl.DEFAULT_RATE = 20
+    try:
+        report, rate = crawl_w3c_lists_at_once()
+    finally:
+        w3crawl.DEFAULT_RATE = default_rate
+
+    assert list(report['files']) == [5, 5], "W3C lists not collected"
+    assert rate <= 22, "Lists on one W3C host crawled faster than the default rate"
+
+
+def test_w3c_lists_share_rate_option():
+    report, rate = crawl_w3c_lists_at_once(rate=20)
+
+    assert list(report['files']) == [5, 5], "W3C lists not collected"
+    assert rate <= 22, "Lists on one W3C host crawled faster than --rate"
+
+
+def test_w3c_collection_options():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=1, messages=10) as server:
+            start = time.time()
+            stats = {}
+            mailman.collect_from_url(server.url('alpha', 'w3c'), archive_dir=archive_dir,
+                                     workers=4, rate=1000, stats=stats)
+
+            # at the default rate of one request per second this takes 12s
+            assert time.time() - start < 6, "Rate not passed on to the W3C crawl"
+            assert len(mailbox.mbox(os.path.join(archive_dir, 'alpha', '2001-01.mbox'))) == 10, \
+                "Not all W3C messages crawled"
+            assert stats['files'] == 10 and stats['bytes'] > 0 and stats['failures'] == 0, \
+                "W3C crawl not reported"
+
+            mailman.collect_from_url(server.url('alpha', 'w3c'), archive_dir=archive_dir,
+                                     workers=4, rate=1000, stats=stats)
+
+            assert stats['files'] == 0 and stats['not_modified'] == 10, \
+                "Checkpointed W3C messages not reported as unchanged"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_lazy_archive_date_ranges():
+    archive_dir = tempfile.mkdtemp()
+    try:
+        with FixtureServer(lists=['alpha'], months=6, messages=10) as server:
+            mailman.collect_from_url(server.url('alpha', 'ietf'), archive_dir=archive_dir)
+
+        full = archive.Archive(mailman.load_data('alpha', archive_dir=archive_dir))
+        expected = full.between('2001-03-01', '2001-05-01').data
+
+        assert len(expected) == 20, "Archive.between selected wrong messages"
+        assert len(full.since('2001-06-01').data) + len(full.until('2001-06-01').data) == 60, \
+            "Archive.since and until do not split the archive"
+
+        lazy = archive.LazyArchive(os.path.join(archive_dir, 'alpha'))
+        arx = lazy.between('2001-03-01', '2001-05-01')
+
+        assert arx.data.equals(expected), "LazyArchive range differs from Archive range"
+        assert len(lazy.loaded) == 4, "LazyArchive loaded months far outside the range"
+
+        assert_raises(mailman.MissingDataException, full.between, '1990-01-01', '1991-01-01')
+        assert_raises(mailman.MissingDataException, lazy.between, '2001-03-01', '2001-03-01')
+
+        full.save_partitions(os.path.join(archive_dir, 'parts'))
+        lazy = archive.LazyArchive(os.path.join(archive_dir, 'parts'))
+        arx = lazy.between('2001-03-01', '2001-05-01')
+
+        assert arx.data.equals(expected), "Partitioned range differs from Archive range"
+        assert len(lazy.loaded) == 2, "Partitions outside the range loaded"
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def test_mbox_index_bodies_on_demand():
+    arc_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(arc_dir, '2001-November.txt')
+        shutil.copy(os.path.join(CONFIG.test_data_path, '2001-November.txt'), path)
+        parsed = mailman.open_archive_file(path)
+
+        index = mbox_index.MboxIndex(path)
+
+        assert index.message_ids() == list(parsed.index), "Index does not find every message"
+        message_id = parsed.index[10]
+        assert index.get_body(message_id) == parsed['Body'][10], "Indexed body differs"
+        assert mbox_index.MboxIndex(path).messages == index.messages, "Saved index not reloaded"
+
+        arx = archive.Archive(parsed.drop('Body', axis=1),
+                              index=mbox_index.ArchiveIndex(arc_dir))
+
+        assert arx.get_body(message_id) == parsed['Body'][10], "Archive body not read from index"
+        node = [t for t in arx.get_threads() if t.known_root][0].get_root()
+        assert node.get_data()['Body'] == index.get_body(node.get_id()), \
+            "Node body not read from index"
+        assert node.get_data()['Body'] is not None, "Node body missing"
+    finally:
+        shutil.rmtree(arc_dir)
+
+
+def test_headers_only_loading():
+    full = mailman.open_list_archives('bigbang-dev-test.txt',
+                                      archive_dir=CONFIG.test_data_path, mbox=True)
+    headers = mailman.open_list_archives('bigbang-dev-test.txt',
+                                         archive_dir=CONFIG.test_data_path, mbox=True,
+                                         headers_only=True)
+
+    assert headers['Body'].isnull().all(), "Bodies parsed in headers-only mode"
+    assert headers.drop('Body', axis=1).equals(full.drop('Body', axis=1)), \
+        "Headers-only mode parsed different headers"
+
+    arx = archive.Archive(headers)
+    assert arx.get_activity().equals(archive.Archive(full).get_activity()), \
+        "Headers-only activity differs"
+
+
+def test_compact_archive():
+    arx = archive.Archive('bigbang-dev-test.txt', archive_dir=CONFIG.test_data_path, mbox=True)
+    compacted = arx.get_compact()
+
+    pd.util.testing.assert_frame_equal(compacted.activity(), arx.get_activity())
+
+    ids = compacted.ids
+    replies = [None if code == compact.NO_CODE else ids[code] for code in compacted.reply_codes]
+    assert replies == list(arx.data['In-Reply-To']), "Reply codes do not decode to In-Reply-To"
+    assert len(set(compacted.roots())) == len(arx.get_threads()), \
+        "Thread roots differ from threads"
+
+    report = compact.memory_report(arx.data, compacted)
+    assert report['bytes']['compact'] < report['bytes']['data'], "Compact form is not smaller"
+
+
+def test_archive_construction_without_copy():
+    data = mailman.open_list_archives('bigbang-dev-test.txt',
+                                      archive_dir=CONFIG.test_data_path, mbox=True)
+    data['Extra'] = float('nan')
+
+    copied = archive.Archive(data)
+    uncopied = archive.Archive(data.copy(), copy=False)
+
+    assert uncopied.data.equals(copied.data), "copy=False changed the archive data"
+    assert copied.data['Extra'].dtype == object and copied.data['Extra'].isnull().all(), \
+        "NaN not converted to None"
+    assert 'Extra' in data.columns and data['Extra'].dtype == float, "Input data modified"
+    assert list(copied.timings.keys())[0] == 'load', "Construction steps not timed"
+
+    repeated = pd.concat([data, data.iloc[:3]])
+    repeated['Body'].values[-1] = 'A different body'
+    assert (archive.duplicated_messages(repeated) == repeated.duplicated().values).all(), \
+        "Duplicates differ from DataFrame.duplicated"
+
+
+def test_sparse_activity():
+    arx = archive.Archive('2001-November.txt', archive_dir=CONFIG.test_data_path, mbox=True)
+    dense = arx.get_activity()
+    sparse = arx.get_activity(sparse=True)
+
+    days = arx.data['Date'].apply(lambda d: d.toordinal())
+    counts = arx.data[days < days.max()].groupby([days, 'From']).size()
+    assert sparse.nnz == len(counts), "Sparse activity stores zeros or misses counts"
+    pd.util.testing.assert_frame_equal(sparse.to_dense(), dense)
+    pd.util.testing.assert_series_equal(sparse.sum(0), dense.sum(0))
+
+    entities = process.resolve_sender_entities(sparse)
+    assert entities == process.resolve_sender_entities(dense), \
+        "Entities differ between sparse and dense activity"
+    assert (sparse.repartition(entities).to_dense().values ==
+            utils.repartition_dataframe(dense, entities).values).all(), \
+        "Sparse repartition differs from repartition_dataframe"
+
+
+def test_thread_index():
+    messages = [('<a@x>', None, None),
+                ('<c@x>', '<b@x>', '<a@x> <b@x>'),  # arrives before its parent
+                ('<b@x>', '<a@x>', '<a@x>'),
+                ('<d@x>', None, '<a@x> <b@x>'),  # only References
+                ('<e@x>', '<gone@x>', None),  # parent missing from the archive
+                ('<f@x>', '<gone@x>', None),
+                ('<g@x>', '<h@x>', None),  # a reply cycle
+                ('<h@x>', '<g@x>', None)]
+    data = pd.DataFrame({'Message-ID': [m[0] for m in messages],
+                         'In-Reply-To': [m[1] for m in messages],
+                         'References': [m[2] for m in messages],
+                         'From': 'someone@example.org', 'Subject': 'Topic', 'Body': None,
+                         'Date': pd.date_range('2001-01-01', periods=len(messages), tz='UTC')})
+    arx = archive.Archive(data)
+
+    frame = arx.get_thread_index().to_frame()
+    assert list(frame['Parent']) == [None, '<b@x>', '<a@x>', '<b@x>', None, None, None, None], \
+        "Parents not resolved from In-Reply-To and References"
+    assert list(frame['Thread']) == [0, 0, 0, 0, 1, 1, 2, 3], "Messages in wrong threads"
+
+    threads = arx.get_threads()
+    assert [t.known_root for t in threads] == [True, False, True, True], \
+        "Wrong threads with unknown roots"
+    assert threads[0].get_num_messages() == 4, "Reply before parent split the thread"
+    assert threads[1].get_root().get_id() == '<gone@x>', "Missing parent not the thread root"
+    assert [n.get_id() for n in threads[1].get_root().get_successors()] == ['<e@x>', '<f@x>'], \
+        "Replies to a missing parent not grouped"
+
+
+def test_thread_nodes_without_bodies():
+    arx = archive.Archive("2001-November.txt", archive_dir="tests/data", mbox=True)
+    node = [t for t in arx.get_threads() if t.known_root][0].get_root()
+
+    assert 'Body' not in node.data.keys(), "Node holds the message body"
+    assert node.data['Body'] == arx.data['Body'][node.get_id()], "Node body not read on lookup"
+    assert node.data['From'] == arx.data['From'][node.get_id()], "Node fields missing"
+    assert node.get_body() == arx.data['Body'][node.get_id()], "Node body not read from data"
+    assert node.get_data()['Body'] == node.get_body(), "Node data without its body"
+
+
+def test_deep_thread_aggregates():
+    class UnreadableIndex(object):
+        def get_body(self, message_id):
+            raise AssertionError("Body read for an aggregate")
+
+    depth = 5000
+    root = node = Node('<0@x>', {'From': 'person0', 'Date': 0, 'Body': None},
+                       index=UnreadableIndex())
+    for i in range(1, depth):
+        child = Node('<%d@x>' % i, {'From': 'person%d' % (i % 3), 'Date': i, 'Body': None},
+                     node, index=UnreadableIndex())
+        node.add_successor(child)
+        node = child
+    t = Thread(root)
+
+    assert t.get_num_messages() == depth, "Wrong message count for a deep thread"
+    assert t.get_num_people() == 3, "Wrong number of people in a deep thread"
+    assert t.get_duration() == depth - 1, "Wrong duration of a deep thread"
+    assert [n.get_id() for n in t.get_leaves()] == ['<%d@x>' % (depth - 1)], \
+        "Wrong leaves of a deep thread"
+
+
+def test_thread_metrics():
+    arx = archive.Archive('2001-November.txt', archive_dir=CONFIG.test_data_path, mbox=True)
+    metrics = arx.thread_metrics()
+    threads = arx.get_threads()
+
+    assert len(metrics) == len(threads), "Not one row of metrics per thread"
+    assert str(metrics['start'].dtype) == 'datetime64[ns, UTC]', "Start dates not UTC dates"
+
+    for t, (i, row) in zip(threads, metrics.iterrows()):
+        assert row['root'] == t.get_root().get_id(), "Wrong thread root"
+        assert row['known_root'] == t.known_root, "Wrong known_root"
+        assert row['size'] == t.get_num_messages() - (0 if t.known_root else 1), \
+            "Wrong thread size"
+        assert row['senders'] == t.get_num_people(), "Wrong number of senders"
+        if t.known_root:
+            assert row['duration'] == t.get_duration(), "Wrong thread duration"
+        assert row['depth'] < row['size'], "Wrong thread depth"
+        assert pd.isnull(row['median_reply_latency']) == (row['depth'] == 0), \
+            "Reply latency of a thread without replies"
+
+    assert metrics['depth'].max() > 1, "No deep threads found"
+
+
+def test_reply_latencies():
+    arx = archive.Archive('2001-November.txt', archive_dir=CONFIG.test_data_path, mbox=True)
+    edges = arx.reply_edges()
+
+    frame = arx.get_thread_index().to_frame()
+    assert len(edges) == frame['Parent'].notnull().sum(), "Not one edge per reply"
+    dates = arx.data['Date']
+    assert (edges['latency'].values ==
+            (dates[edges['message']].values - dates[edges['parent']].values)).all(), \
+        "Wrong reply latencies"
+    assert (edges['parent_sender'].astype(object).values ==
+            arx.data['From'][edges['parent']].values).all(), "Wrong parent senders"
+
+    times = replies.response_times(edges)
+    seconds = pd.Series(edges['latency'].values.astype('int64') / 1e9,
+                        index=edges['sender'].astype(object)).groupby(level=0)
+    assert (times['count'] == seconds.size()).all(), "Wrong reply counts per sender"
+    assert (abs(times['50%'] - pd.to_timedelta(seconds.median(), unit='s')) <
+            pd.Timedelta('1ms')).all(), "Wrong median latency per sender"
+
+    series = replies.rolling_quantiles(edges, window='7D', quantiles=[0.5])
+    assert series['50%'].notnull().any(), "No rolling median latencies"
+
+    first = replies.first_responses(arx.get_thread_index())
+    metrics = arx.thread_metrics()
+    assert (first['first_response_time'].isnull() | (metrics['size'] > 1)).all(), \
+        "Response to a thread without replies"
+    assert first['first_reply'].dropna().isin(edges['message']).all(), \
+        "First reply not a reply"
+
+
+def test_blocked_entity_resolution():
+    senders = ['perry at stsci.edu (Perry Greenfield)',
+               'greenfield at home.com (Perry Greenfield)',  # same name
+               'perry at stsci.edu (Perry)',  # same address
+               'jsaenz at wm.lc.ehu.es (Jon Saenz)',
+               'jsaenzz at wm.lc.ehu.es (J. S.)',  # one letter off
+               'oliphant at ee.byu.edu (Travis Oliphant)']
+    act = pd.DataFrame([[3, 1, 1, 2, 1, 1]], columns=senders)
+
+    entities = process.resolve_sender_entities(act)
+    assert sorted(entities['perry at stsci.edu (Perry Greenfield)']) == sorted(senders[:3]), \
+        "Senders with the same address or name not merged"
+    assert len(entities) == 4, "Distinct senders merged"
+
+    entities = process.resolve_sender_entities(act, lexical_distance=1)
+    assert sorted(entities['jsaenz at wm.lc.ehu.es (Jon Saenz)']) == sorted(senders[3:5]), \
+        "Close addresses not merged"
+    assert len(entities) == 3, "Distinct senders merged"